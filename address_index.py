@@ -0,0 +1,143 @@
+## assign stable ids to the distinct addresses found across returns and tax years
+
+import sys
+import os
+import logging
+import sqlite3
+import hashlib
+import unicodecsv as csv
+
+import extract_addresses
+import normalize_address
+
+logger = logging.getLogger(__name__)
+
+INDEX_DB = "data/address_index.db"
+BATCH_SIZE = 10000
+
+# what makes an address distinct
+hashFields = ['EIN', 'AddrType'] + normalize_address.addressFields
+
+
+def address_hash(itm):
+    key = '\x1f'.join([itm[f] or '' for f in hashFields])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+class AddressIndex():
+    db = None
+
+    def __init__(self, dbname=INDEX_DB):
+        self.db = sqlite3.connect(dbname)
+        self.normalizer = normalize_address.AddressNormalizer()
+        self.setup()
+
+    def setup(self):
+        cur = self.db.cursor()
+        cur.execute("""CREATE TABLE IF NOT EXISTS unique_address (address_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    address_hash TEXT NOT NULL, EIN TEXT, AddrType TEXT, BusinessName TEXT,
+    Addr1 TEXT, Addr2 TEXT, Addr3 TEXT, Locality TEXT, StateorProvince TEXT, Country TEXT, PostalCode TEXT,
+    first_year TEXT, last_year TEXT);
+        """)
+        cur.execute("""CREATE UNIQUE INDEX IF NOT EXISTS unique_address__address_hash__ind on unique_address(address_hash)
+        """)
+        # the tax years each address was filed in, keeps re-indexing a year idempotent
+        cur.execute("""CREATE TABLE IF NOT EXISTS address_year (address_id INTEGER, tax_year TEXT,
+    PRIMARY KEY (address_id, tax_year)) WITHOUT ROWID;
+        """)
+        assert cur.fetchall() is not None, "failed to create the address index tables"
+        self.db.commit()
+
+    def add(self, data, yr):
+        if len(data) == 0:
+            return
+
+        # the extract_addresses.AddressRecord rows of scanFile are read by name
+        data = [itm._asdict() if hasattr(itm, "_fields") else itm for itm in data]
+
+        rows = []
+        years = []
+        for itm in self.normalizer.normalize(data):
+            taxYr = itm['TaxYr'] or str(yr)
+            ahash = address_hash(itm)
+            rows.append([ahash, itm['EIN'], itm['AddrType'], itm['BusinessName']] +
+                [itm[f] for f in normalize_address.addressFields] + [taxYr, taxYr])
+            years.append([taxYr, ahash])
+
+        cur = self.db.cursor()
+        cur.executemany(f"""INSERT INTO unique_address (address_hash, EIN, AddrType, BusinessName,
+            {",".join(normalize_address.addressFields)}, first_year, last_year)
+            VALUES ({",".join(['?' for d in rows[0]])})
+            ON CONFLICT (address_hash) DO
+            UPDATE SET first_year = min(first_year, excluded.first_year), last_year = max(last_year, excluded.last_year)
+            """, rows)
+        cur.executemany("""INSERT INTO address_year (address_id, tax_year)
+            SELECT address_id, ? FROM unique_address WHERE address_hash = ?
+            ON CONFLICT DO NOTHING
+            """, years)
+        self.db.commit()
+
+    def add_csv(self, filename, yr):
+        ctr = 0
+        data = []
+        with open(filename, 'rb') as f:
+            for itm in csv.DictReader(f):
+                # the csv can not tell an empty value from a missing one
+                data.append({k: v if not v == '' else None for (k, v) in itm.items()})
+                ctr += 1
+                if len(data) >= BATCH_SIZE:
+                    self.add(data, yr)
+                    data = []
+        self.add(data, yr)
+
+        return ctr
+
+    def lookup(self, itm):
+        # the address_id of an extracted row, if it has been indexed
+        fixed = self.normalizer.normalize([itm._asdict() if hasattr(itm, "_fields") else dict(itm)])[0]
+        cur = self.db.cursor()
+        cur.execute("""SELECT address_id FROM unique_address WHERE address_hash = ?""", [address_hash(fixed)])
+        res = cur.fetchone()
+
+        return res[0] if res is not None else None
+
+    def count(self):
+        cur = self.db.cursor()
+        cur.execute("""SELECT count(*) FROM unique_address""")
+        return cur.fetchone()[0]
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+def main(args):
+
+    if "--taxyear" in args:
+        taxyrs = [args[args.index("--taxyear") + 1]]
+    else:
+        taxyrs = extract_addresses.years()
+
+    if "--db" in args:
+        dbname = args[args.index("--db") + 1]
+    else:
+        dbname = INDEX_DB
+
+    idx = AddressIndex(dbname)
+    for yr in taxyrs:
+        filename = f"build/address_{yr}.csv"
+        if not os.path.exists(filename):
+            logger.warning(f"{filename} not found")
+            continue
+
+        ctr = idx.add_csv(filename, yr)
+        logger.info(f"indexed {ctr} rows for {yr}, the index holds {idx.count()} unique addresses")
+
+    stats = idx.normalizer.stats()
+    logger.info(f"normalization cache hit rate {stats['hit_rate']:.1%}")
+    idx.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main(sys.argv)
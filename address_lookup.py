@@ -0,0 +1,330 @@
+## look up the extracted addresses of every year by EIN, ZIP code, place or name, and serve them over HTTP
+
+import sys
+import os
+import re
+import json
+import logging
+import sqlite3
+import threading
+import functools
+import urllib.parse
+import http.server
+
+import db_logging
+import address_store
+import extract_addresses
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 1000
+# the number of distinct queries whose results are remembered
+CACHE_SIZE = 1000
+PORT = 8990
+# the indexes and full text index of the addresses of a year, apart from the year DB
+LOOKUP_DB = "data/lookup_{yr}.db"
+
+# the query parameters of the HTTP endpoint and the search arguments they go to
+queryParams = {"ein": "ein", "zip": "postal", "state": "state", "city": "locality", "name": "name"}
+
+
+def year_db(yr):
+    # the run DB of extract_addresses.py, one import_addresses.sh built from the csv before
+    # there was a store, or else the partition of the year in data/address_store
+    for dbname in [f"data/my_{yr}.db", f"data/irs_addresses_{yr}.db"]:
+        if os.path.exists(dbname):
+            return dbname
+
+    # no store is made just to look in it
+    if os.path.exists(os.path.join(address_store.STORE_DIR, "manifest.db")):
+        store = address_store.AddressStore()
+        dbname = store.partition_path(yr)
+        store.close()
+        if dbname is not None and os.path.exists(dbname):
+            return dbname
+
+    return None
+
+
+def name_query(name):
+    # every word of the name as a prefix, quoted so FTS5 operators in it are just text
+    return " ".join(['"' + d.replace('"', '""') + '"*' for d in name.split()])
+
+
+class AddressLookup():
+    # the indexes and full text index of each year are kept in a lookup DB of their own, the
+    # year DB is attached read only as src and never written to
+
+    def __init__(self, taxyrs=None, cache_size=CACHE_SIZE):
+        self.dbs = {}
+        self.paths = {}
+        self.versions = {}
+        self.fts = {}
+        self.keys = {}
+        for yr in taxyrs or extract_addresses.years():
+            dbname = year_db(yr)
+            if dbname is not None:
+                self.dbs[str(yr)] = sqlite3.connect(f"file:{LOOKUP_DB.format(yr=yr)}", uri=True, check_same_thread=False)
+                self.setup(self.dbs[str(yr)])
+                self.attach(str(yr), dbname)
+        # a changed DB has a new version, which keeps stale results out of the cache
+        self.cached_search = functools.lru_cache(maxsize=cache_size)(self._search)
+        self.lock = threading.Lock()
+
+    def setup(self, db):
+        cur = db.cursor()
+        # what each lookup table was last built from
+        cur.execute("""CREATE TABLE IF NOT EXISTS lookup_source (name TEXT PRIMARY KEY, path TEXT, row_count INTEGER, max_rowid INTEGER)""")
+        assert cur.fetchall() is not None, "unable to create the lookup tables"
+        db.commit()
+
+    def attach(self, yr, dbname):
+        cur = self.dbs[yr].cursor()
+        if yr in self.paths:
+            cur.execute("""DETACH DATABASE src""")
+        cur.execute("""ATTACH DATABASE ? as src""", [f"file:{os.path.abspath(dbname)}?mode=ro"])
+        self.paths[yr] = dbname
+
+    def version(self, yr):
+        st = os.stat(self.paths[yr])
+        return (self.paths[yr], st.st_size, st.st_mtime)
+
+    def ensure_indexes(self, yr):
+        # cheap when nothing changed, so it is checked before each uncached query
+        dbname = year_db(yr)
+        if dbname is not None and not dbname == self.paths[yr]:
+            # a new partition of the year was published to the store
+            self.attach(yr, dbname)
+
+        version = self.version(yr)
+        if self.versions.get(yr) == version:
+            return version
+
+        db = self.dbs[yr]
+        self.keys[yr] = self.update_keys(db, yr)
+        self.fts[yr] = self.update_fts(db, yr)
+        db.commit()
+
+        self.versions[yr] = version
+        return version
+
+    def changes(self, db, name, yr):
+        # None when the lookup table is current, the rowid after which rows were only added, or 0 to rebuild it
+        cur = db.cursor()
+        cur.execute("""SELECT count(*), coalesce(max(rowid), 0) FROM src.irs_address""")
+        (rowCount, maxRowid) = cur.fetchone()
+        cur.execute("""SELECT path, row_count, max_rowid FROM lookup_source WHERE name = ?""", [name])
+        res = cur.fetchone()
+        cur.execute("""INSERT INTO lookup_source (name, path, row_count, max_rowid) VALUES (?,?,?,?)
+            ON CONFLICT (name) DO UPDATE SET path = excluded.path, row_count = excluded.row_count, max_rowid = excluded.max_rowid
+            """, [name, self.paths[yr], rowCount, maxRowid])
+        if res == (self.paths[yr], rowCount, maxRowid):
+            return None
+        elif res is None or not res[0] == self.paths[yr]:
+            return 0
+
+        cur.execute("""SELECT count(*) FROM src.irs_address WHERE rowid > ?""", [res[2]])
+        added = cur.fetchone()[0]
+        # rows were deleted, say by an incremental run, when the counts do not add up
+        return res[2] if res[1] + added == rowCount else 0
+
+    def update_keys(self, db, yr):
+        # a store partition already has the lookup indexes, other year DBs get a copy of the columns
+        # they cover, under the same name so the same index DDL applies
+        cur = db.cursor()
+        names = [re.search(r'EXISTS (\w+)', d).group(1) for d in db_logging.lookupIndexes]
+        cur.execute(f"""SELECT count(*) FROM src.sqlite_master WHERE type = 'index' and
+            name IN ({",".join(['?' for d in names])})""", names)
+        if cur.fetchone()[0] == len(names):
+            cur.execute("""DROP TABLE IF EXISTS main.irs_address""")
+            cur.execute("""DELETE FROM lookup_source WHERE name = 'keys'""")
+            return "src.irs_address"
+
+        cur.execute("""CREATE TABLE IF NOT EXISTS main.irs_address (EIN TEXT, PostalCode TEXT, StateorProvince TEXT, Locality TEXT)""")
+        for cmd in db_logging.lookupIndexes:
+            cur.execute(cmd)
+        after = self.changes(db, "keys", yr)
+        if after is not None:
+            if after == 0:
+                logger.info(f"building the lookup indexes of {yr}")
+                cur.execute("""DELETE FROM main.irs_address""")
+            cur.execute("""INSERT INTO main.irs_address (rowid, EIN, PostalCode, StateorProvince, Locality)
+                SELECT rowid, EIN, PostalCode, StateorProvince, Locality FROM src.irs_address WHERE rowid > ?""", [after])
+
+        return "main.irs_address"
+
+    def update_fts(self, db, yr):
+        cur = db.cursor()
+        try:
+            # contentless, the names stay in the year DB and only the rowids come back
+            cur.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS main.irs_address_fts USING fts5(BusinessName, content='')""")
+        except sqlite3.OperationalError as e:
+            logger.warning(f"no full text index for {yr}, names are matched with LIKE: {e}")
+            return False
+
+        after = self.changes(db, "fts", yr)
+        if after is None:
+            return True
+        elif after == 0:
+            logger.info(f"building the full text index of {yr}")
+            cur.execute("""INSERT INTO irs_address_fts (irs_address_fts) VALUES ('delete-all')""")
+        cur.execute("""INSERT INTO irs_address_fts (rowid, BusinessName)
+            SELECT rowid, BusinessName FROM src.irs_address WHERE rowid > ?""", [after])
+
+        return True
+
+    def where(self, yr, ein=None, postal=None, state=None, locality=None, name=None):
+        # k is the table with the lookup indexes, a the rows of the year DB
+        conds = []
+        params = []
+        if ein:
+            conds.append("k.EIN = ?")
+            params.append(ein.replace("-", ""))
+        if postal:
+            # a ZIP matches its ZIP+4 codes as well
+            conds.append("k.PostalCode >= ? and k.PostalCode < ?")
+            params += [postal, postal[:-1] + chr(ord(postal[-1]) + 1)]
+        if state:
+            conds.append("k.StateorProvince = ? COLLATE NOCASE")
+            params.append(state)
+        if locality:
+            conds.append("k.Locality = ? COLLATE NOCASE")
+            params.append(locality)
+        if name and self.fts.get(yr):
+            conds.append("k.rowid IN (SELECT rowid FROM main.irs_address_fts WHERE irs_address_fts MATCH ?)")
+            params.append(name_query(name))
+        elif name:
+            conds.append("a.BusinessName LIKE ?")
+            params.append(f"%{name}%")
+
+        return conds, params
+
+    def _search(self, filters, after, limit, versions):
+        # pages run through the years in order, then by rowid, after is the (year, rowid) a page ended on
+        filters = dict(filters)
+        rows = []
+        for yr in [d[0] for d in versions]:
+            if after is not None and yr < after[0]:
+                continue
+
+            (conds, params) = self.where(yr, **filters)
+            conds.append("k.rowid > ?")
+            params.append(after[1] if after is not None and yr == after[0] else 0)
+            cur = self.dbs[yr].cursor()
+            cur.execute(f"""SELECT k.rowid, {",".join([f"a.{d}" for d in db_logging.addressColumns])}
+                FROM {self.keys[yr]} k JOIN src.irs_address a ON a.rowid = k.rowid
+                WHERE {" and ".join(conds)} ORDER BY k.rowid LIMIT ?""", params + [limit + 1 - len(rows)])
+            rows += [(yr, d) for d in cur.fetchall()]
+            if len(rows) > limit:
+                break
+
+        page = rows[:limit]
+        more = len(rows) > limit
+        return (tuple([d[1][1:] for d in page]), f"{page[-1][0]}:{page[-1][1][0]}" if more else None)
+
+    def search(self, ein=None, postal=None, state=None, locality=None, name=None, years=None, after=None, limit=PAGE_SIZE):
+        # returns a page of rows as dicts and the after token of the next page, None on the last page
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+        filters = tuple([(k, v) for (k, v) in [("ein", ein), ("postal", postal), ("state", state),
+            ("locality", locality), ("name", name)] if v])
+        if after:
+            (yr, rowid) = after.split(":")
+            after = (yr, int(rowid))
+
+        with self.lock:
+            versions = tuple([(yr, self.ensure_indexes(yr)) for yr in sorted(self.dbs)
+                              if years is None or yr in [str(d) for d in years]])
+            (rows, nextAfter) = self.cached_search(filters, after, limit, versions)
+
+        return {"rows": [dict(zip(db_logging.addressColumns, d)) for d in rows], "after": nextAfter}
+
+    def stats(self):
+        info = self.cached_search.cache_info()
+        return {"hits": info.hits, "misses": info.misses, "size": info.currsize}
+
+    def close(self):
+        for db in self.dbs.values():
+            db.close()
+
+
+class LookupHandler(http.server.BaseHTTPRequestHandler):
+    # GET /addresses?ein=&zip=&state=&city=&name=&year=2019,2020&after=&limit=
+    lookup = None
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        if not url.path == "/addresses":
+            self.send_error(404)
+            return
+
+        query = {k: v[-1] for (k, v) in urllib.parse.parse_qs(url.query).items()}
+        args = {arg: query[k] for (k, arg) in queryParams.items() if k in query}
+        if "year" in query:
+            args["years"] = query["year"].split(",")
+        try:
+            res = self.lookup.search(after=query.get("after"), limit=query.get("limit", PAGE_SIZE), **args)
+        except (ValueError, sqlite3.OperationalError) as e:
+            self.send_error(400, f"{e}")
+            return
+
+        body = json.dumps(res).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def serve(lookup, port=PORT, host="127.0.0.1"):
+    LookupHandler.lookup = lookup
+    server = http.server.ThreadingHTTPServer((host, port), LookupHandler)
+    logger.info(f"serving {len(lookup.dbs)} years of addresses on http://{host}:{port}/addresses")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main(args):
+
+    if "--taxyear" in args:
+        taxyrs = args[args.index("--taxyear") + 1].split(",")
+    else:
+        taxyrs = extract_addresses.years()
+
+    lookup = AddressLookup(taxyrs)
+
+    # build or bring up to date the indexes of each year and stop
+    if "--build" in args:
+        for yr in sorted(lookup.dbs):
+            lookup.ensure_indexes(yr)
+            logger.info(f"indexed {yr}")
+
+    elif "--serve" in args:
+        if "--port" in args:
+            port = int(args[args.index("--port") + 1])
+        else:
+            port = PORT
+        serve(lookup, port)
+
+    else:
+        args = {arg: args[args.index("--" + k) + 1] for (k, arg) in queryParams.items() if "--" + k in args}
+        res = lookup.search(**args)
+        for itm in res["rows"]:
+            print(json.dumps(itm))
+        if res["after"] is not None:
+            logger.info(f"more rows follow, after {res['after']}")
+
+    lookup.close()
+    logger.info("All Done")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main(sys.argv)
@@ -0,0 +1,233 @@
+## keep counts of the extracted addresses by ZIP, state, tax year and address type, with the IRS ZIP statistics beside them
+
+import sys
+import os
+import io
+import re
+import csv
+import glob
+import zlib
+import logging
+import sqlite3
+import zipfile
+
+import address_lookup
+import extract_addresses
+
+logger = logging.getLogger(__name__)
+
+ROLLUP_DB = "data/address_rollups.db"
+# the SOI ZIP code files get_data.sh get_irs_zipstats downloads
+ZIPSTATS_FILES = "zipcode*.zip"
+
+# the ZIP codes the SOI files use for state totals and for everything else
+zipTotals = ["00000", "99999"]
+
+# the columns the rollups are counted from, a change in any of them folds its return in again
+rollupColumns = ["TaxYr", "StateorProvince", "PostalCode", "AddrType", "EIN", "NumEmployees"]
+
+
+def setup_rollups(db):
+    cur = db.cursor()
+    # the returns of each year DB folded into the rollups, by a checksum of their rows so a changed return is folded in again
+    cur.execute("""CREATE TABLE IF NOT EXISTS rollup_return (source TEXT, return_file TEXT, crc INTEGER,
+    PRIMARY KEY (source, return_file)) WITHOUT ROWID;
+    """)
+    # what each return adds to each group, so a return can be taken out again and organizations counted once
+    cur.execute("""CREATE TABLE IF NOT EXISTS rollup_contrib (source TEXT, return_file TEXT, tax_year TEXT, state TEXT,
+    zip5 TEXT, addr_type TEXT, ein TEXT, addresses INTEGER, employees INTEGER,
+    PRIMARY KEY (source, return_file, tax_year, state, zip5, addr_type)) WITHOUT ROWID;
+    """)
+    cur.execute("""CREATE INDEX IF NOT EXISTS rollup_contrib__group__ind on rollup_contrib(tax_year, state, zip5, addr_type)
+    """)
+    # NumEmployees is given once per return, so employees count each return once in a group
+    cur.execute("""CREATE TABLE IF NOT EXISTS address_rollup (tax_year TEXT, state TEXT, zip5 TEXT, addr_type TEXT,
+    orgs INTEGER, returns INTEGER, addresses INTEGER, employees INTEGER,
+    PRIMARY KEY (tax_year, state, zip5, addr_type)) WITHOUT ROWID;
+    """)
+    cur.execute("""CREATE TABLE IF NOT EXISTS state_rollup (tax_year TEXT, state TEXT, addr_type TEXT,
+    orgs INTEGER, returns INTEGER, addresses INTEGER, employees INTEGER,
+    PRIMARY KEY (tax_year, state, addr_type)) WITHOUT ROWID;
+    """)
+    # the SOI individual income tax statistics of each ZIP code, summed over the AGI classes
+    cur.execute("""CREATE TABLE IF NOT EXISTS irs_zip_stats (tax_year TEXT, state TEXT, zip5 TEXT,
+    returns_filed REAL, agi REAL, source_file TEXT,
+    PRIMARY KEY (tax_year, state, zip5)) WITHOUT ROWID;
+    """)
+    cur.execute("""CREATE VIEW IF NOT EXISTS address_rollup_zip_stats AS
+    SELECT r.*, z.returns_filed, z.agi
+        FROM address_rollup r
+        LEFT JOIN irs_zip_stats z ON z.tax_year = r.tax_year and z.state = r.state and z.zip5 = r.zip5
+    """)
+    assert cur.fetchall() is not None, "unable to create the rollup tables"
+    db.commit()
+
+
+def row_crc(*values):
+    # the order of the rows of a return does not matter, their sum is taken
+    return zlib.crc32("\x1f".join(["" if d is None else str(d) for d in values]).encode("utf-8"))
+
+
+def update_year(db, yr, rebuild=False):
+    # fold the returns added, changed or removed in a year DB since the last update into the rollups
+    dbname = address_lookup.year_db(yr)
+    if dbname is None:
+        logger.warning(f"no address DB for {yr}")
+        return None
+
+    source = str(yr)
+    cur = db.cursor()
+    cur.execute("""ATTACH DATABASE ? as src""", [dbname])
+    if rebuild:
+        # a CRC no return has, so every return is folded in again and the removed ones still found
+        cur.execute("""UPDATE rollup_return SET crc = 'rebuild' WHERE source = ?""", [source])
+
+    # the returns the year DB holds now, keyed by a checksum of their rows so a republished partition,
+    # a re-imported csv or a rerun with --normalize is folded in again wherever the rows changed
+    db.create_function("row_crc", len(rollupColumns), row_crc, deterministic=True)
+    cur.execute("""DROP TABLE IF EXISTS temp.src_return""")
+    cur.execute("""CREATE TEMP TABLE src_return (return_file TEXT PRIMARY KEY, crc INTEGER)""")
+    cur.execute(f"""INSERT INTO src_return SELECT ReturnFile, sum(row_crc({",".join(rollupColumns)}))
+        FROM src.irs_address WHERE ReturnFile is not NULL GROUP BY ReturnFile""")
+
+    cur.execute("""DROP TABLE IF EXISTS temp.dirty_return""")
+    cur.execute("""CREATE TEMP TABLE dirty_return (return_file TEXT PRIMARY KEY, present INTEGER)""")
+    cur.execute("""INSERT INTO dirty_return
+        SELECT s.return_file, 1 FROM src_return s
+            WHERE NOT EXISTS (SELECT 1 FROM rollup_return r WHERE r.source = ? and r.return_file = s.return_file and r.crc is s.crc)
+        """, [source])
+    cur.execute("""INSERT INTO dirty_return
+        SELECT r.return_file, 0 FROM rollup_return r
+            WHERE r.source = ? and NOT EXISTS (SELECT 1 FROM src_return s WHERE s.return_file = r.return_file)
+        """, [source])
+    cur.execute("""SELECT sum(present), count(*) - sum(present) FROM dirty_return""")
+    (changed, removed) = cur.fetchone()
+
+    # take out what the returns added before and put in what they add now
+    cur.execute("""DROP TABLE IF EXISTS temp.dirty_group""")
+    cur.execute("""CREATE TEMP TABLE dirty_group (tax_year TEXT, state TEXT, zip5 TEXT, addr_type TEXT,
+        PRIMARY KEY (tax_year, state, zip5, addr_type))""")
+    cur.execute("""INSERT OR IGNORE INTO dirty_group
+        SELECT c.tax_year, c.state, c.zip5, c.addr_type FROM rollup_contrib c JOIN dirty_return d ON d.return_file = c.return_file
+            WHERE c.source = ?""", [source])
+    cur.execute("""DELETE FROM rollup_contrib WHERE source = ? and return_file IN (SELECT return_file FROM dirty_return)""", [source])
+    cur.execute("""INSERT INTO rollup_contrib (source, return_file, tax_year, state, zip5, addr_type, ein, addresses, employees)
+        SELECT ?, a.ReturnFile, coalesce(nullif(a.TaxYr, ''), ?), upper(coalesce(a.StateorProvince, '')),
+            coalesce(substr(a.PostalCode, 1, 5), ''), coalesce(a.AddrType, ''),
+            max(a.EIN), count(*), max(cast(a.NumEmployees as integer))
+            FROM src.irs_address a JOIN dirty_return d ON d.return_file = a.ReturnFile
+            WHERE d.present = 1
+            GROUP BY a.ReturnFile, 3, 4, 5, 6
+        """, [source, source])
+    cur.execute("""INSERT OR IGNORE INTO dirty_group
+        SELECT c.tax_year, c.state, c.zip5, c.addr_type FROM rollup_contrib c JOIN dirty_return d ON d.return_file = c.return_file
+            WHERE c.source = ?""", [source])
+
+    # recount only the groups the returns touched
+    cur.execute("""DELETE FROM address_rollup WHERE (tax_year, state, zip5, addr_type) IN (SELECT * FROM dirty_group)""")
+    cur.execute("""INSERT INTO address_rollup (tax_year, state, zip5, addr_type, orgs, returns, addresses, employees)
+        SELECT c.tax_year, c.state, c.zip5, c.addr_type, count(DISTINCT c.ein), count(DISTINCT c.return_file),
+            sum(c.addresses), sum(c.employees)
+            FROM rollup_contrib c JOIN dirty_group g
+                ON g.tax_year = c.tax_year and g.state = c.state and g.zip5 = c.zip5 and g.addr_type = c.addr_type
+            GROUP BY c.tax_year, c.state, c.zip5, c.addr_type
+        """)
+    cur.execute("""DELETE FROM state_rollup WHERE (tax_year, state, addr_type) IN (SELECT tax_year, state, addr_type FROM dirty_group)""")
+    cur.execute("""INSERT INTO state_rollup (tax_year, state, addr_type, orgs, returns, addresses, employees)
+        SELECT tax_year, state, addr_type, count(DISTINCT ein), count(DISTINCT return_file), sum(addresses), sum(employees)
+            FROM (SELECT c.tax_year, c.state, c.addr_type, c.return_file, max(c.ein) as ein,
+                    sum(c.addresses) as addresses, max(c.employees) as employees
+                FROM rollup_contrib c
+                WHERE (c.tax_year, c.state, c.addr_type) IN (SELECT tax_year, state, addr_type FROM dirty_group)
+                GROUP BY c.tax_year, c.state, c.addr_type, c.source, c.return_file)
+            GROUP BY tax_year, state, addr_type
+        """)
+    cur.execute("""SELECT count(*) FROM dirty_group""")
+    groups = cur.fetchone()[0]
+
+    cur.execute("""DELETE FROM rollup_return WHERE source = ? and return_file IN (SELECT return_file FROM dirty_return WHERE present = 0)""", [source])
+    cur.execute("""INSERT INTO rollup_return (source, return_file, crc)
+        SELECT ?, s.return_file, s.crc FROM src_return s JOIN dirty_return d ON d.return_file = s.return_file
+        ON CONFLICT (source, return_file) DO UPDATE SET crc = excluded.crc
+        """, [source])
+    db.commit()
+    cur.execute("""DETACH DATABASE src""")
+
+    logger.info(f"{yr}: {changed or 0} new or changed and {removed or 0} removed returns, {groups} groups recounted")
+    return {"changed": changed or 0, "removed": removed or 0, "groups": groups}
+
+
+def zip_stats(zipfilename):
+    # the agi files of the SOI ZIP code data, one row per ZIP code and AGI class
+    totals = {}
+    with zipfile.ZipFile(zipfilename, "r") as zf:
+        members = [d for d in zf.namelist() if d.lower().endswith("zpallagi.csv")]
+        if len(members) == 0:
+            logger.warning(f"no zpallagi.csv in {zipfilename}")
+        for member in members:
+            with zf.open(member) as f:
+                for row in csv.DictReader(io.TextIOWrapper(f, encoding="latin-1")):
+                    # the column names change case between years
+                    row = {k.strip().lower(): v for (k, v) in row.items() if k is not None}
+                    zip5 = row["zipcode"].strip().zfill(5)
+                    if zip5 in zipTotals:
+                        continue
+                    key = (row["state"].strip().upper(), zip5)
+                    (n1, agi) = totals.get(key, (0.0, 0.0))
+                    totals[key] = (n1 + float(row["n1"] or 0), agi + float(row["a00100"] or 0))
+
+    return totals
+
+
+def load_zip_stats(db, pattern=ZIPSTATS_FILES):
+    ctr = 0
+    for zipfilename in sorted(glob.glob(pattern)):
+        m = re.search(r'(\d{4})', os.path.basename(zipfilename))
+        if m is None:
+            continue
+
+        totals = zip_stats(zipfilename)
+        cur = db.cursor()
+        cur.executemany("""INSERT INTO irs_zip_stats (tax_year, state, zip5, returns_filed, agi, source_file) VALUES (?,?,?,?,?,?)
+            ON CONFLICT (tax_year, state, zip5) DO
+            UPDATE SET returns_filed = excluded.returns_filed, agi = excluded.agi, source_file = excluded.source_file
+            """, [[m.group(1), k[0], k[1], v[0], v[1], zipfilename] for (k, v) in totals.items()])
+        db.commit()
+        logger.info(f"{zipfilename}: statistics of {len(totals)} ZIP codes for {m.group(1)}")
+        ctr += len(totals)
+
+    return ctr
+
+
+def main(args):
+
+    if "--taxyear" in args:
+        taxyrs = [args[args.index("--taxyear") + 1]]
+    else:
+        taxyrs = extract_addresses.years()
+
+    if "--db" in args:
+        dbname = args[args.index("--db") + 1]
+    else:
+        dbname = ROLLUP_DB
+
+    db = sqlite3.connect(dbname)
+    db.execute("PRAGMA synchronous=OFF")
+    setup_rollups(db)
+
+    # also load the SOI ZIP code statistics, --zipstats "zipcode*.zip"
+    if "--zipstats" in args:
+        load_zip_stats(db, args[args.index("--zipstats") + 1])
+
+    # fold every return in again rather than only the new ones
+    rebuild = "--rebuild" in args
+    for yr in taxyrs:
+        update_year(db, yr, rebuild=rebuild)
+
+    db.close()
+    logger.info("All Done")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main(sys.argv)
@@ -0,0 +1,195 @@
+## one store for the addresses of every year, a partition per tax year listed in a manifest
+
+import sys
+import os
+import glob
+import logging
+import sqlite3
+import unicodecsv as csv
+
+import db_logging
+
+logger = logging.getLogger(__name__)
+
+STORE_DIR = "data/address_store"
+BATCH_SIZE = 10000
+
+# built on each partition before it is swapped in
+partitionIndexes = db_logging.addressIndexes + db_logging.lookupIndexes
+
+manifestColumns = ["tax_year", "path", "generation", "row_count", "return_count",
+    "source", "source_archive", "extract_version", "publish_time"]
+
+
+class AddressStore():
+
+    def __init__(self, store_dir=STORE_DIR):
+        self.store_dir = store_dir
+        os.makedirs(store_dir, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(store_dir, "manifest.db"))
+        self.setup()
+
+    def setup(self):
+        cur = self.db.cursor()
+        cur.execute("""CREATE TABLE IF NOT EXISTS address_partition (tax_year TEXT PRIMARY KEY, path TEXT, generation INTEGER,
+    row_count INTEGER, return_count INTEGER, source TEXT, source_archive TEXT, extract_version TEXT,
+    publish_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+        """)
+        assert cur.fetchall() is not None, "unable to create the store manifest"
+        self.db.commit()
+
+    def partitions(self, years=None):
+        cur = self.db.cursor()
+        cur.execute(f"""SELECT {",".join(manifestColumns)} FROM address_partition ORDER BY tax_year""")
+        parts = [dict(zip(manifestColumns, d)) for d in cur.fetchall()]
+        if years is not None:
+            years = [str(d) for d in years]
+            parts = [d for d in parts if d["tax_year"] in years]
+
+        return parts
+
+    def partition_path(self, yr):
+        parts = self.partitions([yr])
+        return os.path.join(self.store_dir, parts[0]["path"]) if len(parts) > 0 else None
+
+    def publish(self, yr, srcdb=None, csvfile=None, source_archive=None, extract_version=None):
+        # write the year to a new partition file and point the manifest at it in one step, readers of
+        # the old partition keep reading it until they close it
+        yr = str(yr)
+        parts = self.partitions([yr])
+        generation = parts[0]["generation"] + 1 if len(parts) > 0 else 1
+        name = f"addresses_{yr}.{generation}.db"
+        path = os.path.join(self.store_dir, name)
+        tmpname = path + ".tmp"
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+
+        db = sqlite3.connect(tmpname)
+        db.execute("PRAGMA journal_mode=OFF")
+        db.execute("PRAGMA synchronous=OFF")
+        cur = db.cursor()
+        cur.execute(f"""CREATE TABLE irs_address ({", ".join([f"{d} TEXT" for d in db_logging.addressColumns])})""")
+        if srcdb is not None:
+            cur.execute("""ATTACH DATABASE ? as src""", [srcdb])
+            cur.execute(f"""INSERT INTO irs_address SELECT {",".join(db_logging.addressColumns)} FROM src.irs_address ORDER BY rowid""")
+            db.commit()
+            cur.execute("""DETACH DATABASE src""")
+            source = srcdb
+        else:
+            self.load_csv(db, csvfile)
+            source = csvfile
+        for cmd in partitionIndexes:
+            cur.execute(cmd)
+        cur.execute("""SELECT count(*), count(DISTINCT ReturnFile) FROM irs_address""")
+        (rowCount, returnCount) = cur.fetchone()
+        db.commit()
+        db.close()
+
+        with open(tmpname, "rb") as f:
+            os.fsync(f.fileno())
+        os.replace(tmpname, path)
+
+        # the swap, no other partition is touched
+        cur = self.db.cursor()
+        cur.execute("""INSERT INTO address_partition (tax_year, path, generation, row_count, return_count, source, source_archive, extract_version)
+            VALUES (?,?,?,?,?,?,?,?)
+            ON CONFLICT (tax_year) DO
+            UPDATE SET path = excluded.path, generation = excluded.generation, row_count = excluded.row_count,
+                return_count = excluded.return_count, source = excluded.source, source_archive = excluded.source_archive,
+                extract_version = excluded.extract_version, publish_time = CURRENT_TIMESTAMP
+            """, [yr, name, generation, rowCount, returnCount, source, source_archive, extract_version])
+        self.db.commit()
+        self.remove_unused(yr)
+
+        logger.info(f"published {rowCount} rows of {returnCount} returns for {yr} as {name}")
+        return rowCount
+
+    def load_csv(self, db, csvfile):
+        cur = db.cursor()
+        insert = f"""INSERT INTO irs_address VALUES ({",".join(['?' for d in db_logging.addressColumns])})"""
+        data = []
+        with open(csvfile, "rb") as f:
+            for itm in csv.DictReader(f):
+                # the csv can not tell an empty value from a missing one
+                data.append([itm[c] if not itm[c] == '' else None for c in db_logging.addressColumns])
+                if len(data) >= BATCH_SIZE:
+                    cur.executemany(insert, data)
+                    data = []
+        cur.executemany(insert, data)
+        db.commit()
+
+    def remove_unused(self, yr):
+        # earlier generations and partitions left by a publish that did not finish
+        current = self.partition_path(yr)
+        for itm in glob.glob(os.path.join(self.store_dir, f"addresses_{yr}.*.db*")):
+            if not itm == current:
+                os.remove(itm)
+
+    def query(self, where="1 = 1", params=[], years=None, columns=db_logging.addressColumns):
+        # only the partitions of the years asked for are opened, rows come with the year of their partition
+        for part in self.partitions(years):
+            path = os.path.join(self.store_dir, part["path"])
+            db = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+            try:
+                for row in db.execute(f"""SELECT {",".join(columns)} FROM irs_address WHERE {where}""", params):
+                    yield (part["tax_year"],) + row
+            finally:
+                db.close()
+
+    def attach(self, years):
+        # a connection with an irs_address view over the partitions, for ad hoc SQL across a few years
+        parts = self.partitions(years)
+        db = sqlite3.connect("file::memory:", uri=True)
+        limit = db.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+        if len(parts) > limit:
+            db.close()
+            raise ValueError(f"at most {limit} partitions can be attached, use query")
+
+        selects = []
+        for part in parts:
+            path = os.path.join(self.store_dir, part["path"])
+            db.execute(f"""ATTACH DATABASE ? as p{part['tax_year']}""", [f"file:{path}?mode=ro"])
+            selects.append(f"""SELECT '{part['tax_year']}' as partition_year, * FROM p{part['tax_year']}.irs_address""")
+        if len(selects) > 0:
+            db.execute(f"""CREATE TEMP VIEW irs_address AS {" UNION ALL ".join(selects)}""")
+
+        return db
+
+    def close(self):
+        self.db.close()
+
+
+def main(args):
+
+    store = AddressStore()
+
+    if "--taxyear" in args:
+        taxyrs = args[args.index("--taxyear") + 1].split(",")
+    else:
+        taxyrs = [d["tax_year"] for d in store.partitions()]
+
+    # publish the run DB of extract_addresses.py, or the csv when there is no run DB
+    if "--publish" in args:
+        for yr in taxyrs:
+            if os.path.exists(f"data/my_{yr}.db"):
+                store.publish(yr, srcdb=f"data/my_{yr}.db")
+            elif os.path.exists(f"build/address_{yr}.csv"):
+                store.publish(yr, csvfile=f"build/address_{yr}.csv")
+            else:
+                logger.warning(f"nothing to publish for {yr}")
+
+    # the partition file of a year, for use from the shell
+    elif "--path" in args:
+        for yr in taxyrs:
+            print(store.partition_path(yr) or "")
+
+    else:
+        for part in store.partitions(taxyrs):
+            print("\t".join([str(part[d]) for d in manifestColumns]))
+
+    store.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main(sys.argv)
@@ -0,0 +1,190 @@
+## add downloaded return XML files to the year archive in place
+
+import sys
+import os
+import time
+import glob
+import zlib
+import struct
+import logging
+import zipfile
+import concurrent.futures
+
+import extract_addresses
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 2000
+COMPRESS_LEVEL = 6
+
+
+def _prepare(item, existing, level):
+    # runs in a worker thread, zlib lets go of the GIL while it works
+    (member, src, dateTime) = item
+    if isinstance(src, str):
+        with open(src, "rb") as f:
+            data = f.read()
+        dateTime = time.localtime(os.path.getmtime(src))[:6]
+    else:
+        data = src
+
+    crc = zlib.crc32(data)
+    if existing.get(member) == crc:
+        return member, crc, len(data), None, dateTime
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    return member, crc, len(data), compressed, dateTime
+
+
+class ReturnArchive():
+    # appends members after the last one and rewrites only the central directory,
+    # members already present with the same CRC are skipped and changed ones replaced
+
+    def __init__(self, archivefile, workers=None, level=COMPRESS_LEVEL):
+        self.archivefile = archivefile
+        self.backup = archivefile + ".cdir"
+        self.level = level
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers or os.cpu_count())
+        self.counts = {"added": 0, "replaced": 0, "skipped": 0}
+
+        if os.path.exists(self.backup):
+            recover(archivefile)
+
+        if os.path.exists(archivefile):
+            self.zf = zipfile.ZipFile(archivefile, "a")
+            self.save_backup()
+        else:
+            self.zf = zipfile.ZipFile(archivefile, "w")
+        self.existing = {d.filename: d.CRC for d in self.zf.infolist()}
+
+    def save_backup(self):
+        # the old central directory is overwritten by the first new member,
+        # keep a copy until the new one is safely written
+        with open(self.archivefile, "rb") as f:
+            f.seek(self.zf.start_dir)
+            tail = f.read()
+        with open(self.backup, "wb") as f:
+            f.write(struct.pack("<Q", self.zf.start_dir))
+            f.write(tail)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def add(self, items):
+        # items are (member name, file path or bytes, zip date_time or None)
+        for i in range(0, len(items), BATCH_SIZE):
+            batch = items[i:i + BATCH_SIZE]
+            prepared = self.pool.map(lambda d: _prepare(d, self.existing, self.level), batch)
+            for (member, crc, size, compressed, dateTime) in prepared:
+                if compressed is None:
+                    self.counts["skipped"] += 1
+                    continue
+                self.write(member, crc, size, compressed, dateTime)
+
+        return self.counts
+
+    def write(self, member, crc, size, compressed, dateTime):
+        zf = self.zf
+        old = zf.NameToInfo.get(member)
+        if old is not None:
+            # the old bytes stay in the file but nothing refers to them any more
+            zf.filelist.remove(old)
+            self.counts["replaced"] += 1
+        else:
+            self.counts["added"] += 1
+
+        zinfo = zipfile.ZipInfo(member, dateTime or time.localtime()[:6])
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        zinfo.external_attr = 0o644 << 16
+        zinfo.file_size = size
+        zinfo.compress_size = len(compressed)
+        zinfo.CRC = crc
+
+        zf.fp.seek(zf.start_dir)
+        zinfo.header_offset = zf.start_dir
+        zf.fp.write(zinfo.FileHeader(zinfo.file_size > zipfile.ZIP64_LIMIT))
+        zf.fp.write(compressed)
+        zf.start_dir = zf.fp.tell()
+
+        zf.filelist.append(zinfo)
+        zf.NameToInfo[member] = zinfo
+        zf._didModify = True
+        self.existing[member] = crc
+
+    def close(self):
+        self.pool.shutdown()
+        self.zf.close()
+        if os.path.exists(self.backup):
+            os.remove(self.backup)
+
+
+def recover(archivefile):
+    # put back the central directory of an append that did not finish
+    backup = archivefile + ".cdir"
+    with open(backup, "rb") as f:
+        (startDir,) = struct.unpack("<Q", f.read(8))
+        tail = f.read()
+
+    logger.warning(f"restoring the central directory of {archivefile} from an interrupted append")
+    with open(archivefile, "r+b") as f:
+        f.seek(startDir)
+        f.write(tail)
+        f.truncate()
+    os.remove(backup)
+
+
+def year_files(yr, wd="tmpdata"):
+    # the members are named {yr}/{seg}/{file}, as zip -r from tmpdata named them
+    files = sorted(glob.glob(f"{wd}/{yr}/*/*.xml"))
+    return [(os.path.relpath(d, wd), d, None) for d in files]
+
+
+def package_year(yr, wd="tmpdata", workers=None, keep=False):
+    items = year_files(yr, wd)
+    if len(items) == 0:
+        logger.info(f"no XML files found for {yr}")
+        return {}
+
+    archivefile = f"{wd}/irs_f990_{yr}.zip"
+    logger.info(f"archiving {len(items)} returns into {archivefile}")
+    archive = ReturnArchive(archivefile, workers=workers)
+    counts = archive.add(items)
+    archive.close()
+    logger.info(f"{yr}: {counts}")
+
+    # every file is now in the archive, either added or already there
+    if not keep:
+        for (member, path, dateTime) in items:
+            os.remove(path)
+
+    return counts
+
+
+def main(args):
+
+    if "--taxyear" in args:
+        taxyrs = [args[args.index("--taxyear") + 1]]
+    else:
+        taxyrs = extract_addresses.years()
+
+    if "--workers" in args:
+        workers = int(args[args.index("--workers") + 1])
+    else:
+        workers = None
+
+    if "--wd" in args:
+        wd = args[args.index("--wd") + 1]
+    else:
+        wd = "tmpdata"
+
+    keep = "--keep" in args
+
+    for yr in taxyrs:
+        package_year(yr, wd=wd, workers=workers, keep=keep)
+
+    logger.info("All Done")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main(sys.argv)
@@ -0,0 +1,82 @@
+## time the per return field extraction of each scanFile engine
+
+import sys
+import io
+import time
+import zipfile
+import logging
+
+import extract_addresses
+
+logger = logging.getLogger(__name__)
+
+
+def load_returns(archivefile, sampleSize=1000):
+    # hold the raw bytes in memory so only the extraction is timed
+    with zipfile.ZipFile(archivefile, "r") as zf:
+        files = [d for d in zf.namelist() if d.endswith(".xml")][:sampleSize]
+        return [(d, zf.read(d)) for d in files]
+
+
+def time_engine(engine, returns, rounds=3):
+    reader = extract_addresses.engines[engine]
+    results = []
+    best = None
+    for i in range(rounds):
+        results = []
+        starttm = time.perf_counter()
+        for (name, raw) in returns:
+            try:
+                results.append(reader(io.BytesIO(raw)))
+            except Exception:
+                results.append(None)
+        duration = time.perf_counter() - starttm
+        if best is None or duration < best:
+            best = duration
+
+    return best, results
+
+
+def main(args):
+
+    if len(args) < 2:
+        usage()
+        return
+
+    archivefile = args[1]
+
+    if "--sampleSize" in args:
+        sampleSize = int(args[args.index("--sampleSize") + 1])
+    else:
+        sampleSize = 1000
+
+    if "--rounds" in args:
+        rounds = int(args[args.index("--rounds") + 1])
+    else:
+        rounds = 3
+
+    returns = load_returns(archivefile, sampleSize=sampleSize)
+    if len(returns) == 0:
+        logger.warning(f"no returns found in {archivefile}")
+        return
+
+    logger.info(f"timing {len(returns)} returns from {archivefile}, best of {rounds}")
+
+    reference = None
+    baseline = None
+    for engine in extract_addresses.engines:
+        (duration, results) = time_engine(engine, returns, rounds=rounds)
+        per_return = duration / len(returns) * 1000000
+        if reference is None:
+            (reference, baseline) = (results, duration)
+        same = "same" if results == reference else "DIFFERENT"
+        logger.info(f"{engine:>8}: {per_return:9.1f} us/return  {baseline / duration:5.2f}x  output {same}")
+
+
+def usage():
+    logger.warning("usage: python3 bench_extract.py tmpdata/irs_f990_2019.zip [--sampleSize 1000] [--rounds 3]")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main(sys.argv)
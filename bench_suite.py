@@ -0,0 +1,253 @@
+## time each stage of an extraction on a synthetic corpus and compare it to a saved baseline
+
+import sys
+import os
+import io
+import time
+import shutil
+import sqlite3
+import logging
+import resource
+import statistics
+import tempfile
+import zipfile
+import subprocess
+import multiprocessing
+import concurrent.futures
+
+import db_logging
+import extract_addresses
+import make_corpus
+
+logger = logging.getLogger(__name__)
+
+BENCH_DB = "data/bench.db"
+YEAR = 2019
+# slower than the baseline by more than this, or by more than the spread of the rounds, is reported as a regression
+TOLERANCE = 0.10
+# the timed rounds of each stage, after one to warm up, and more until MIN_SECONDS have gone by
+ROUNDS = 5
+MIN_SECONDS = 2.0
+
+stages = ["read", "parse", "csv", "sqlite", "scan_year"]
+
+
+def peak_rss():
+    # kilobytes on linux, for this process and any worker processes it waited on
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def read_members(archivefile):
+    with zipfile.ZipFile(archivefile, "r") as zf:
+        return [(d, zf.read(d)) for d in zf.namelist() if d.endswith(".xml")]
+
+
+def parse_members(members, engine):
+    data = []
+    for (name, raw) in members:
+        # scanFile wants a zip handle, so feed it one made of this single member
+        zf = MemberZip(name, raw)
+        (newData, unknownTags) = extract_addresses.scanFile(name, zf=zf, engine=engine)
+        data += newData
+
+    return data
+
+
+class MemberZip():
+    # just enough of a ZipFile for scanFile to open one in memory member
+
+    def __init__(self, name, raw):
+        self.name = name
+        self.raw = raw
+
+    def open(self, name):
+        f = io.BytesIO(self.raw)
+        f.name = name
+        return f
+
+
+def stage_input(stage, archivefile, engine):
+    # what a stage starts from, made once and not timed
+    members = read_members(archivefile)
+    if stage in ["csv", "sqlite"]:
+        return members, parse_members(members, engine)
+
+    return members, None
+
+
+def time_stage(stage, archivefile, engine, workers, members, data):
+    rows = 0
+    starttm = time.perf_counter()
+
+    if stage == "read":
+        read_members(archivefile)
+    elif stage == "parse":
+        rows = len(parse_members(members, engine))
+    elif stage == "csv":
+        rows = len(data)
+        ocsv = extract_addresses.csvData(YEAR, refresh=True)
+        ocsv.save_data(data)
+        ocsv.close()
+    elif stage == "sqlite":
+        # each round loads the rows into an empty DB
+        rows = len(data)
+        dbname = f"data/bench_{YEAR}.db"
+        if os.path.exists(dbname):
+            os.remove(dbname)
+        starttm = time.perf_counter()
+        dblog = db_logging.DBLOG(dbname=dbname, bulk=True)
+        dblog.save_data(data)
+        dblog.close()
+    elif stage == "scan_year":
+        # the whole pipeline, as extract_addresses.py runs it, less the publish to the address store
+        extract_addresses.scan_year(YEAR, refresh=True, workers=workers, engine=engine, store=False)
+
+    return time.perf_counter() - starttm, rows
+
+
+def run_stage(stage, archivefile, workdir, engine, workers, rounds=ROUNDS):
+    # runs in a fresh process so the peak RSS belongs to this stage alone, an untimed round
+    # first warms the page cache and the imports, then the best of the timed rounds counts
+    os.chdir(workdir)
+    logging.disable(logging.WARNING)
+    (members, data) = stage_input(stage, archivefile, engine)
+    time_stage(stage, archivefile, engine, workers, members, data)
+
+    # a stage of a few milliseconds takes many rounds before its best time stops moving
+    times = []
+    starttm = time.perf_counter()
+    while len(times) < rounds or time.perf_counter() - starttm < MIN_SECONDS:
+        (seconds, rows) = time_stage(stage, archivefile, engine, workers, members, data)
+        times.append(seconds)
+
+    # how far the typical round is from the best, a noisy stage gets that much more tolerance
+    spread = statistics.median(times) / min(times) - 1 if min(times) > 0 else 0.0
+    return {"stage": stage, "returns": len(members), "rows": rows, "seconds": min(times), "spread": spread,
+            "rounds": len(times), "peak_rss_kb": peak_rss()}
+
+
+def setup_results(db):
+    cur = db.cursor()
+    cur.execute("""CREATE TABLE IF NOT EXISTS bench_result (run_id INTEGER, run_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    revision TEXT, corpus TEXT, stage TEXT, engine TEXT, workers INTEGER, returns INTEGER, rows INTEGER,
+    seconds REAL, returns_per_sec REAL, rows_per_sec REAL, peak_rss_kb INTEGER, baseline INTEGER DEFAULT 0);
+    """)
+    assert cur.fetchall() is not None, "unable to create the bench_result table"
+    db.commit()
+
+
+def revision():
+    try:
+        res = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+    except OSError:
+        return None
+
+    return res.stdout.strip() or None
+
+
+def baseline_for(db, corpus, stage, engine, workers):
+    cur = db.cursor()
+    cur.execute("""SELECT returns_per_sec, peak_rss_kb, revision FROM bench_result
+        WHERE baseline = 1 and corpus = ? and stage = ? and engine = ? and workers = ?
+        ORDER BY run_id DESC LIMIT 1""", [corpus, stage, engine, workers])
+
+    return cur.fetchone()
+
+
+def run_suite(returns=2000, seed=1, engine="tree", workers=1, selected=stages, save_baseline=False, bench_db=BENCH_DB, rounds=ROUNDS):
+    corpus = f"seed{seed}_n{returns}"
+    workdir = tempfile.mkdtemp(prefix="bench_")
+    try:
+        for d in ["tmpdata", "build", "data"]:
+            os.makedirs(os.path.join(workdir, d))
+        archivefile = make_corpus.make_corpus(os.path.join(workdir, f"tmpdata/irs_f990_{YEAR}.zip"), returns=returns, yr=YEAR, seed=seed)
+
+        results = []
+        # a pool process is daemonic and could not start the scan_year workers
+        ctx = multiprocessing.get_context("spawn")
+        for stage in selected:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+                results.append(pool.submit(run_stage, stage, archivefile, workdir, engine, workers, rounds).result())
+    finally:
+        shutil.rmtree(workdir)
+
+    if os.path.dirname(bench_db):
+        os.makedirs(os.path.dirname(bench_db), exist_ok=True)
+    db = sqlite3.connect(bench_db)
+    setup_results(db)
+    cur = db.cursor()
+    cur.execute("""SELECT coalesce(max(run_id), 0) + 1 FROM bench_result""")
+    runId = cur.fetchone()[0]
+    rev = revision()
+
+    regressions = 0
+    for res in results:
+        returnsPerSec = res["returns"] / res["seconds"] if res["seconds"] > 0 else None
+        rowsPerSec = res["rows"] / res["seconds"] if res["seconds"] > 0 else None
+        msg = ""
+        base = baseline_for(db, corpus, res["stage"], engine, workers)
+        if base is not None and returnsPerSec is not None:
+            change = returnsPerSec / base[0] - 1
+            msg = f"{change:+7.1%} vs {base[2]}"
+            if change < -max(TOLERANCE, res["spread"]):
+                msg += "  REGRESSION"
+                regressions += 1
+        logger.info(f"{res['stage']:>9}: {res['seconds']:8.3f} s  {returnsPerSec or 0:9.0f} returns/s  " +
+            f"{rowsPerSec or 0:9.0f} rows/s  {res['peak_rss_kb'] / 1024:7.1f} MB  best of {res['rounds']} " +
+            f"spread {res['spread']:.0%}  {msg}")
+
+        cur.execute("""INSERT INTO bench_result (run_id, revision, corpus, stage, engine, workers, returns, rows,
+            seconds, returns_per_sec, rows_per_sec, peak_rss_kb, baseline) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)""",
+            [runId, rev, corpus, res["stage"], engine, workers, res["returns"], res["rows"], res["seconds"],
+             returnsPerSec, rowsPerSec, res["peak_rss_kb"], 1 if save_baseline else 0])
+    db.commit()
+    db.close()
+
+    return results, regressions
+
+
+def main(args):
+
+    if "--returns" in args:
+        returns = int(args[args.index("--returns") + 1])
+    else:
+        returns = 2000
+
+    if "--seed" in args:
+        seed = int(args[args.index("--seed") + 1])
+    else:
+        seed = 1
+
+    if "--engine" in args:
+        engine = args[args.index("--engine") + 1]
+    else:
+        engine = "tree"
+
+    if "--workers" in args:
+        workers = int(args[args.index("--workers") + 1])
+    else:
+        workers = 1
+
+    if "--rounds" in args:
+        rounds = int(args[args.index("--rounds") + 1])
+    else:
+        rounds = ROUNDS
+
+    if "--stages" in args:
+        selected = args[args.index("--stages") + 1].split(",")
+    else:
+        selected = stages
+
+    (results, regressions) = run_suite(returns=returns, seed=seed, engine=engine, workers=workers,
+        selected=selected, save_baseline="--baseline" in args, rounds=rounds)
+
+    if regressions > 0:
+        logger.warning(f"{regressions} stages are slower than the baseline by more than {TOLERANCE:.0%} and their spread")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main(sys.argv)
@@ -0,0 +1,278 @@
+## build data/listing.db from the IRS indexes, the S3 listing and the returns held locally
+
+import sys
+import os
+import csv
+import json
+import logging
+import sqlite3
+import zipfile
+import itertools
+
+import extract_addresses
+
+logger = logging.getLogger(__name__)
+
+LISTING_DB = "data/listing.db"
+S3_CATALOG = "data/s3_catalog.db"
+INDEX_DIR = "index"
+RETURN_DIR = "tmpdata"
+# rows are upserted in batches of this size
+BATCH_SIZE = 10000
+# an object_id with the _public.xml suffix
+OBJECT_LENGTH = 29
+
+# the columns of index_{yr}.csv, in order
+filingColumns = ["return_id", "filing_type", "ein", "tax_period", "sub_date",
+    "taxpayer_name", "return_type", "dln", "object_id"]
+
+# the filings columns the keys of index_{yr}.json go to
+jsonColumns = {
+    "EIN": "ein",
+    "TaxPeriod": "tax_period",
+    "SubmittedOn": "sub_date",
+    "OrganizationName": "taxpayer_name",
+    "FormType": "return_type",
+    "DLN": "dln",
+    "ObjectId": "object_id"
+    }
+
+
+def setup_listing(db):
+    cur = db.cursor()
+    cur.execute("""CREATE TABLE IF NOT EXISTS filings (return_id TEXT, filing_type TEXT, ein text, tax_period TEXT,
+    sub_date TEXT, taxpayer_name TEXT, return_type TEXT, dln TEXT, object_id TEXT );
+    """)
+    cur.execute("""CREATE TABLE IF NOT EXISTS retrieve_log (path TEXT);
+    """)
+    cur.execute("""CREATE TABLE IF NOT EXISTS local_index (object_id TEXT, fullpath TEXT, taxyr TEXT );
+    """)
+    cur.execute("""CREATE TABLE IF NOT EXISTS aws_listing (date TEXT, time TEXT, size INTEGER, path TEXT PRIMARY KEY);
+    """)
+    cur.execute("""CREATE UNIQUE INDEX IF NOT EXISTS retrieve_log__path__ind ON retrieve_log(path)
+    """)
+    cur.execute("""CREATE UNIQUE INDEX IF NOT EXISTS local_index__fullpath__ind ON local_index(fullpath)
+    """)
+    assert cur.fetchall() is not None, "unable to create the listing tables"
+
+    # filings built by the old shell pipeline had no unique key, keep the last copy of each
+    cur.execute("""SELECT 1 FROM sqlite_master WHERE name = 'filings__object_id__uind'""")
+    if cur.fetchone() is None:
+        cur.execute("""DELETE FROM filings WHERE object_id is NULL or
+            rowid NOT IN (SELECT max(rowid) FROM filings GROUP BY object_id)""")
+        logger.info(f"removed {cur.rowcount} duplicate filings")
+        cur.execute("""DROP INDEX IF EXISTS filings__object_id__ind""")
+        cur.execute("""CREATE UNIQUE INDEX filings__object_id__uind on filings(object_id)""")
+    db.commit()
+
+
+def public_name(objectId):
+    objectId = objectId.strip()
+    if objectId == "":
+        return None
+    elif objectId.endswith("_public.xml"):
+        return objectId
+
+    return objectId + "_public.xml"
+
+
+def batches(rows, size=BATCH_SIZE):
+    it = iter(rows)
+    while True:
+        batch = list(itertools.islice(it, size))
+        if len(batch) == 0:
+            return
+        yield batch
+
+
+def upsert(db, sql, rows):
+    # returns the rows read and the rows inserted or changed
+    cur = db.cursor()
+    read = 0
+    before = db.total_changes
+    for batch in batches(rows):
+        cur.executemany(sql, batch)
+        read += len(batch)
+    db.commit()
+
+    return read, db.total_changes - before
+
+
+def csv_filings(indexfile, counts):
+    with open(indexfile, "r", newline="", encoding="utf-8", errors="replace") as f:
+        for row in csv.reader(f):
+            if len(row) == len(filingColumns) and row[-1].upper() == "OBJECT_ID":
+                continue
+            elif not len(row) == len(filingColumns):
+                counts["bad"] += 1
+                continue
+
+            row[-1] = public_name(row[-1])
+            if row[-1] is None:
+                counts["bad"] += 1
+                continue
+            yield row
+
+
+def json_filings(indexfile, counts):
+    with open(indexfile, "r", encoding="utf-8", errors="replace") as f:
+        index = json.load(f)
+
+    # a single key, Filings{yr}, holding the list of filings
+    for filings in index.values():
+        for itm in filings:
+            row = dict.fromkeys(filingColumns)
+            for (k, col) in jsonColumns.items():
+                row[col] = itm.get(k)
+            row["object_id"] = public_name(row["object_id"] or "")
+            if row["object_id"] is None:
+                counts["bad"] += 1
+                continue
+            yield [row[d] for d in filingColumns]
+
+
+def filing_upsert(prefer):
+    # prefer "excluded" to let the new values win, or "filings" to only fill in missing ones
+    other = "filings" if prefer == "excluded" else "excluded"
+    updates = ", ".join([f"{d} = coalesce({prefer}.{d}, {other}.{d})" for d in filingColumns[:-1]])
+    changes = " or ".join([f"coalesce({prefer}.{d}, {other}.{d}) is not filings.{d}" for d in filingColumns[:-1]])
+
+    return f"""INSERT INTO filings ({",".join(filingColumns)}) VALUES ({",".join(['?' for d in filingColumns])})
+        ON CONFLICT (object_id) DO UPDATE SET {updates} WHERE {changes}"""
+
+
+def load_indexes(db, taxyrs, indexdir=INDEX_DIR):
+    # the csv values win, the json only adds filings and fills in what the csv is missing
+    sources = [("csv", csv_filings, filing_upsert("excluded")), ("json", json_filings, filing_upsert("filings"))]
+
+    counts = {"read": 0, "changed": 0, "bad": 0}
+    for yr in taxyrs:
+        for (sfx, reader, sql) in sources:
+            indexfile = f"{indexdir}/index_{yr}.{sfx}"
+            if not os.path.exists(indexfile) or os.path.getsize(indexfile) == 0:
+                continue
+
+            (read, changed) = upsert(db, sql, reader(indexfile, counts))
+            logger.info(f"{indexfile}: {read} filings, {changed} new or changed")
+            counts["read"] += read
+            counts["changed"] += changed
+
+    return counts
+
+
+def load_aws_listing(db, s3db=S3_CATALOG):
+    # merge the most recent S3 scan, see s3_indexer.py
+    if not os.path.exists(s3db):
+        logger.warning(f"{s3db} not found")
+        return {"changed": 0, "filings": 0}
+
+    cur = db.cursor()
+    before = db.total_changes
+    cur.execute("""ATTACH DATABASE ? as s3""", [s3db])
+    cur.execute("""INSERT INTO aws_listing (date, time, size, path)
+        SELECT date(object_date), time(object_date), size, key
+            FROM s3.s3_listing s
+            WHERE s.key > ''
+        ON CONFLICT (path) DO
+        UPDATE SET date = excluded.date, time = excluded.time, size = excluded.size
+            WHERE not (date is excluded.date and time is excluded.time and size is excluded.size)
+        """)
+    changed = db.total_changes - before
+    db.commit()
+    cur.execute("""DETACH DATABASE s3""")
+
+    # returns in the bucket that are in no index yet
+    before = db.total_changes
+    cur.execute("""INSERT INTO filings (object_id, tax_period, return_type)
+        SELECT path, substr(path, 1, 4) || '00', 'AWS listing'
+            FROM aws_listing
+            WHERE length(path) = ?
+        ON CONFLICT (object_id) DO NOTHING
+        """, [OBJECT_LENGTH])
+    filings = db.total_changes - before
+    db.commit()
+    logger.info(f"{changed} new or changed S3 listing rows, {filings} filings only in the S3 listing")
+
+    return {"changed": changed, "filings": filings}
+
+
+def local_returns(yr, returndir=RETURN_DIR):
+    # the loose downloads of the year and the members of its archive, relative to returndir
+    for (dirpath, dirnames, filenames) in os.walk(os.path.join(returndir, str(yr))):
+        for name in filenames:
+            yield [name, os.path.relpath(os.path.join(dirpath, name), returndir), str(yr)]
+
+    archivefile = f"{returndir}/irs_f990_{yr}.zip"
+    if os.path.exists(archivefile) and os.path.getsize(archivefile) > 0:
+        with zipfile.ZipFile(archivefile, "r") as zf:
+            for d in zf.infolist():
+                if not d.is_dir():
+                    yield [os.path.basename(d.filename), d.filename, str(yr)]
+
+
+def load_local(db, taxyrs, returndir=RETURN_DIR):
+    counts = {"read": 0, "changed": 0, "retrieved": 0}
+    for yr in taxyrs:
+        rows = list(local_returns(yr, returndir))
+        (read, changed) = upsert(db, """INSERT INTO local_index (object_id, fullpath, taxyr) VALUES (?,?,?)
+            ON CONFLICT (fullpath) DO NOTHING""", rows)
+        # some returns are held under more than one year
+        (found, retrieved) = upsert(db, """INSERT INTO retrieve_log (path) VALUES (?)
+            ON CONFLICT (path) DO NOTHING""", [[d] for d in sorted(set([d[0] for d in rows if d[0].endswith(".xml")]))])
+        logger.info(f"{yr}: {read} local returns, {changed} new to local_index and {retrieved} to retrieve_log")
+        counts["read"] += read
+        counts["changed"] += changed
+        counts["retrieved"] += retrieved
+
+    return counts
+
+
+def build_listing(taxyrs, indexes=True, aws=True, local=True, dbname=LISTING_DB, s3db=S3_CATALOG):
+    db = sqlite3.connect(dbname)
+    db.execute("PRAGMA synchronous=OFF")
+    setup_listing(db)
+
+    counts = {}
+    if local:
+        counts["local"] = load_local(db, taxyrs)
+    if indexes:
+        counts["indexes"] = load_indexes(db, taxyrs)
+    if aws:
+        counts["aws"] = load_aws_listing(db, s3db)
+    db.close()
+
+    return counts
+
+
+def main(args):
+
+    if "--taxyear" in args:
+        taxyrs = args[args.index("--taxyear") + 1].split()
+    else:
+        taxyrs = extract_addresses.years()
+
+    if "--db" in args:
+        dbname = args[args.index("--db") + 1]
+    else:
+        dbname = LISTING_DB
+
+    if "--s3db" in args:
+        s3db = args[args.index("--s3db") + 1]
+    else:
+        s3db = S3_CATALOG
+
+    # with none of --indexes, --aws or --local everything is loaded
+    selected = [d for d in ["--indexes", "--aws", "--local"] if d in args]
+    if len(selected) == 0:
+        selected = ["--indexes", "--aws", "--local"]
+
+    counts = build_listing(taxyrs, indexes="--indexes" in selected, aws="--aws" in selected,
+        local="--local" in selected, dbname=dbname, s3db=s3db)
+    logger.info(counts)
+
+    logger.info("All Done")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main(sys.argv)
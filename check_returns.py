@@ -0,0 +1,187 @@
+## check the returns inside the year archives for truncation and bad CRCs
+
+import sys
+import os
+import zlib
+import logging
+import sqlite3
+import zipfile
+import multiprocessing
+
+import extract_addresses
+import return_index
+
+logger = logging.getLogger(__name__)
+
+LISTING_DB = "data/listing.db"
+SHARD_SIZE = 1000
+BLOCK_SIZE = 256 * 1024
+# enough of the end of a return to hold the closing tag and trailing whitespace
+TAIL_SIZE = 64
+
+closingTag = b"</Return>"
+
+
+def tail_ok(tail):
+    return tail.rstrip().endswith(closingTag)
+
+
+def check_stored(f, start, size, full):
+    # a stored member can be checked from its last bytes alone
+    if not full:
+        f.seek(start + max(0, size - TAIL_SIZE))
+        return f.read(min(size, TAIL_SIZE)), None, min(size, TAIL_SIZE)
+
+    f.seek(start)
+    data = f.read(size)
+    return data[-TAIL_SIZE:], zlib.crc32(data), size
+
+
+def check_deflated(f, start, compressSize):
+    # inflate in blocks, keeping only the running CRC and the last bytes
+    f.seek(start)
+    inflater = zlib.decompressobj(-15)
+    crc = 0
+    tail = b""
+    remaining = compressSize
+    while remaining > 0:
+        block = f.read(min(BLOCK_SIZE, remaining))
+        if len(block) == 0:
+            break
+        remaining -= len(block)
+        data = inflater.decompress(block)
+        crc = zlib.crc32(data, crc)
+        tail = (tail + data)[-TAIL_SIZE:]
+    data = inflater.flush()
+    crc = zlib.crc32(data, crc)
+    tail = (tail + data)[-TAIL_SIZE:]
+
+    return tail, crc, compressSize
+
+
+def check_member(f, member, offset, compressSize, size, crc, compressType, full=False):
+    # returns (status, message, bytes read)
+    try:
+        start = return_index.data_offset(f, offset)
+        if compressType == zipfile.ZIP_STORED:
+            (tail, found, read) = check_stored(f, start, size, full)
+        elif compressType == zipfile.ZIP_DEFLATED:
+            (tail, found, read) = check_deflated(f, start, compressSize)
+        else:
+            return "error", f"unsupported compression {compressType}", 0
+    except (zlib.error, zipfile.BadZipFile) as e:
+        return "error", f"{e}", 0
+
+    if found is not None and not found == crc:
+        return "bad_crc", f"CRC {found:08x} expected {crc:08x}", read
+    elif not tail_ok(tail):
+        return "truncated", repr(tail[-20:]), read
+
+    return "ok", None, read
+
+
+# each worker process keeps its own handle on the archive
+_worker_f = None
+_worker_full = False
+
+def _init_worker(archivefile, full=False):
+    global _worker_f, _worker_full
+    _worker_f = open(archivefile, "rb")
+    _worker_full = full
+
+def _check_shard(shard):
+    results = []
+    for (member, offset, compressSize, size, crc, compressType) in shard:
+        (status, msg, read) = check_member(_worker_f, member, offset, compressSize, size, crc, compressType, full=_worker_full)
+        results.append([member, crc, status, msg, read])
+
+    return results
+
+
+def setup_checks(db):
+    cur = db.cursor()
+    cur.execute("""CREATE TABLE IF NOT EXISTS return_check (member TEXT, archive TEXT, taxyr TEXT, object_id TEXT,
+    crc INTEGER, status TEXT, msg TEXT, check_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (archive, member));
+    """)
+    cur.execute("""CREATE INDEX IF NOT EXISTS return_check__taxyr__status__ind on return_check(taxyr, status)
+    """)
+    assert cur.fetchall() is not None, "unable to create the return_check table"
+    db.commit()
+
+
+def checked(db, archivefile):
+    # members already found good, by CRC so a replaced member is checked again
+    cur = db.cursor()
+    cur.execute("""SELECT member, crc FROM return_check WHERE archive = ? and status = 'ok'""", [archivefile])
+
+    return {d[0]: d[1] for d in cur.fetchall()}
+
+
+def save_checks(db, archivefile, yr, results):
+    cur = db.cursor()
+    cur.executemany("""INSERT INTO return_check (member, archive, taxyr, object_id, crc, status, msg) VALUES (?,?,?,?,?,?,?)
+    ON CONFLICT (archive, member) DO
+    UPDATE SET crc = excluded.crc, status = excluded.status, msg = excluded.msg, check_time = CURRENT_TIMESTAMP
+    """, [[d[0], archivefile, str(yr), return_index.object_id(d[0]), d[1], d[2], d[3]] for d in results])
+    db.commit()
+
+
+def check_year(yr, workers=4, full=False, recheck=False, listing_db=LISTING_DB):
+    archivefile = return_index.archive_file(yr)
+    if not os.path.exists(archivefile):
+        logger.warning(f"{archivefile} not found")
+        return {}
+
+    db = sqlite3.connect(listing_db)
+    setup_checks(db)
+    done = {} if recheck else checked(db, archivefile)
+
+    with zipfile.ZipFile(archivefile, "r") as zf:
+        members = [(d.filename, d.header_offset, d.compress_size, d.file_size, d.CRC, d.compress_type)
+                   for d in zf.infolist() if d.filename.endswith(".xml") and not done.get(d.filename) == d.CRC]
+
+    shards = [members[i:i + SHARD_SIZE] for i in range(0, len(members), SHARD_SIZE)]
+    logger.info(f"checking {len(members)} returns of {archivefile} in {len(shards)} shards using {workers} workers")
+
+    counts = {}
+    bytesRead = 0
+    with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(archivefile, full)) as pool:
+        for results in pool.imap_unordered(_check_shard, shards):
+            for (member, crc, status, msg, read) in results:
+                counts[status] = counts.get(status, 0) + 1
+                bytesRead += read
+                if not status == "ok":
+                    logger.info(f"{member}: {status} {msg}")
+            save_checks(db, archivefile, yr, results)
+    db.close()
+
+    logger.info(f"{yr}: {counts}, read {bytesRead} bytes")
+    return counts
+
+
+def main(args):
+
+    if "--taxyear" in args:
+        taxyrs = [args[args.index("--taxyear") + 1]]
+    else:
+        taxyrs = extract_addresses.years()
+
+    if "--workers" in args:
+        workers = int(args[args.index("--workers") + 1])
+    else:
+        workers = os.cpu_count()
+
+    # stored members are only tail checked unless the CRC is asked for as well
+    full = "--crc" in args
+    recheck = "--recheck" in args
+
+    for yr in taxyrs:
+        check_year(yr, workers=workers, full=full, recheck=recheck)
+
+    logger.info("All Done")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main(sys.argv)
@@ -1,32 +1,266 @@
-
 import sys
 import os
+import re
+import json
+import hashlib
+import zipfile
+import threading
+import email.utils
+import concurrent.futures
 
 import logging
 import requests
-import datetime
+import requests.adapters
+import urllib3.util
 import dateutil.parser
 
 logger = logging.getLogger(__name__)
 
+# large files are fetched as ranges of this size in parallel
+CHUNK_SIZE = 32 * 1024 * 1024
+BLOCK_SIZE = 512 * 1024
+RETRIES = 3
+TIMEOUT = 60
+
+# an S3 ETag of a single part upload is the MD5 of the content
+md5Etag = re.compile(r'^"?([0-9a-f]{32})"?$')
+
+
+class SourceChanged(Exception):
+    # the remote file changed part way through a ranged download
+    pass
+
+
+def http_date(ts):
+    return email.utils.formatdate(ts, usegmt=True)
+
+
+def make_session(pool_size, hosts=2, retries=RETRIES):
+    # a session whose connections are kept open and shared between threads
+    retry = urllib3.util.Retry(total=retries, backoff_factor=1,
+        status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["HEAD", "GET"])
+    adapter = requests.adapters.HTTPAdapter(pool_connections=hosts,
+        pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    return session
+
+
+class Downloader():
+
+    def __init__(self, workers=4, files=2, chunk_size=CHUNK_SIZE, check_crc=True):
+        # one pooled session shared by every request
+        self.session = make_session(workers + files, hosts=files)
+
+        # separate pools so a file never waits on its own chunks for a worker
+        self.files = concurrent.futures.ThreadPoolExecutor(max_workers=files)
+        self.chunks = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.chunk_size = chunk_size
+        self.check_crc = check_crc
+        self.lock = threading.Lock()
+
+    def head(self, url, dest):
+        headers = {}
+        if os.path.exists(dest):
+            headers["If-Modified-Since"] = http_date(os.path.getmtime(dest))
+
+        return self.session.head(url, headers=headers, allow_redirects=True, timeout=TIMEOUT)
+
+    def fetch(self, url, dest):
+        try:
+            return self._fetch(url, dest)
+        except SourceChanged:
+            logger.info(f"{url} changed during the download, starting over")
+            self.discard(dest)
+        except Exception as e:
+            # keep the partial file so the next run can resume it
+            logger.warning(f"failed to download {url}: {e}")
+            return "failed"
+
+        # one more try, a file that keeps changing is left for the next run
+        try:
+            return self._fetch(url, dest)
+        except SourceChanged:
+            logger.warning(f"failed to download {url}: it changed again during the download")
+            self.discard(dest)
+            return "failed"
+        except Exception as e:
+            logger.warning(f"failed to download {url}: {e}")
+            return "failed"
+
+    def _fetch(self, url, dest):
+        r = self.head(url, dest)
+        if r.status_code == 304:
+            logger.debug(f"{dest} is up to date")
+            return "not modified"
+        elif not r.status_code == 200:
+            logger.warning(f"failed to download {url}: {r.status_code}")
+            return "failed"
+
+        size = int(r.headers.get("Content-Length", -1))
+        etag = r.headers.get("ETag")
+        lastModified = r.headers.get("Last-Modified")
+
+        # not every server answers a conditional HEAD
+        if os.path.exists(dest) and lastModified is not None and size == os.path.getsize(dest):
+            if dateutil.parser.parse(lastModified).timestamp() <= os.path.getmtime(dest):
+                logger.debug(f"{dest} is up to date")
+                return "not modified"
+
+        if not os.path.exists(os.path.dirname(dest) or "."):
+            os.makedirs(os.path.dirname(dest))
+
+        part = dest + ".part"
+        state = self.load_state(dest, url, size, etag, lastModified)
+        if size > self.chunk_size and r.headers.get("Accept-Ranges") == "bytes":
+            self.fetch_ranges(url, dest, state, etag or lastModified)
+        else:
+            self.fetch_whole(url, part)
+
+        self.verify(part, size, etag, dest)
+
+        # only a complete and checked file gets the real name
+        os.replace(part, dest)
+        if lastModified is not None:
+            ts = dateutil.parser.parse(lastModified).timestamp()
+            os.utime(dest, (ts, ts))
+        if os.path.exists(dest + ".part.json"):
+            os.remove(dest + ".part.json")
+
+        logger.info(f"downloaded {dest}")
+        return "downloaded"
+
+    def load_state(self, dest, url, size, etag, lastModified):
+        # which chunks of a partial download are already on disk
+        state = {"url": url, "size": size, "etag": etag, "last_modified": lastModified,
+                 "chunk_size": self.chunk_size, "done": []}
+        statefile = dest + ".part.json"
+        if os.path.exists(statefile) and os.path.exists(dest + ".part"):
+            with open(statefile, "r") as f:
+                saved = json.load(f)
+            if all([saved.get(k) == state[k] for k in ["url", "size", "etag", "last_modified", "chunk_size"]]):
+                logger.info(f"resuming {dest} with {len(saved['done'])} chunks done")
+                return saved
+
+        self.discard(dest)
+        return state
+
+    def save_state(self, dest, state):
+        statefile = dest + ".part.json"
+        with open(statefile + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(statefile + ".tmp", statefile)
+
+    def discard(self, dest):
+        for itm in [dest + ".part", dest + ".part.json"]:
+            if os.path.exists(itm):
+                os.remove(itm)
+
+    def fetch_whole(self, url, part):
+        with self.session.get(url, stream=True, timeout=TIMEOUT) as req:
+            req.raise_for_status()
+            with open(part, 'wb') as w:
+                for block in req.iter_content(chunk_size=BLOCK_SIZE):
+                    if block:
+                        w.write(block)
+
+    def fetch_ranges(self, url, dest, state, validator):
+        part = dest + ".part"
+        size = state["size"]
+        if not os.path.exists(part):
+            with open(part, "wb") as f:
+                f.truncate(size)
+
+        chunks = [(i, start, min(start + self.chunk_size, size) - 1)
+                  for (i, start) in enumerate(range(0, size, self.chunk_size))
+                  if not i in state["done"]]
+
+        futures = [self.chunks.submit(self.fetch_chunk, url, part, start, end, validator) for (i, start, end) in chunks]
+        failed = None
+        for ((i, start, end), fut) in zip(chunks, futures):
+            # record every chunk that made it, even after a failure, so a resume skips them
+            try:
+                fut.result()
+            except Exception as e:
+                failed = failed or e
+                continue
+            with self.lock:
+                state["done"].append(i)
+                self.save_state(dest, state)
+
+        if failed is not None:
+            raise failed
+
+    def fetch_chunk(self, url, part, start, end, validator):
+        headers = {"Range": f"bytes={start}-{end}"}
+        if validator is not None:
+            headers["If-Range"] = validator
+
+        with self.session.get(url, headers=headers, stream=True, timeout=TIMEOUT) as req:
+            if req.status_code == 200:
+                # the validator no longer matches, the whole file was sent
+                raise SourceChanged(url)
+            req.raise_for_status()
+
+            fd = os.open(part, os.O_WRONLY)
+            try:
+                offset = start
+                for block in req.iter_content(chunk_size=BLOCK_SIZE):
+                    os.pwrite(fd, block, offset)
+                    offset += len(block)
+            finally:
+                os.close(fd)
+
+        if not offset == end + 1:
+            raise IOError(f"short read of bytes {start}-{end} from {url}")
+
+    def verify(self, part, size, etag, dest):
+        if size >= 0 and not os.path.getsize(part) == size:
+            self.discard(dest)
+            raise IOError(f"{dest} is {os.path.getsize(part)} bytes, expected {size}")
+
+        m = md5Etag.match(etag or "")
+        if m is not None:
+            digest = hashlib.md5()
+            with open(part, "rb") as f:
+                for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+                    digest.update(block)
+            if not digest.hexdigest() == m.group(1):
+                self.discard(dest)
+                raise IOError(f"{dest} does not match its ETag checksum")
+
+        if self.check_crc and dest.endswith(".zip"):
+            with zipfile.ZipFile(part, "r") as zf:
+                bad = zf.testzip()
+            if bad is not None:
+                self.discard(dest)
+                raise IOError(f"{dest} has a bad CRC for {bad}")
+
+    def fetch_all(self, items):
+        # items are (url, dest) pairs, returns the outcome of each download
+        futures = {self.files.submit(self.fetch, url, dest): (url, dest) for (url, dest) in items}
+        results = {}
+        for fut in concurrent.futures.as_completed(futures):
+            results[futures[fut]] = fut.result()
+
+        return results
+
+    def close(self):
+        self.files.shutdown()
+        self.chunks.shutdown()
+        self.session.close()
+
 
 def download_newer(url, fpath):
-    # compare the web version of an object and any existing file version of the object to 
-    # conditionally download it  
-    r = requests.head(url)
-    url_time = r.headers['last-modified']
-    url_date = dateutil.parser.parse(url_time)
-    if os.path.exists(fpath):
-        file_time = datetime.datetime.fromtimestamp(os.path.getmtime(fpath))
-    else:
-        file_time = datetime.datetime(1,1,1,0,0,0)
-    
-    if url_date > file_time:
-        if not os.path.exists(os.path.dirname(fpath)):
-            os.makedirs(os.path.dirname(fpath))
-        with open(fpath, 'wb') as fd:
-            for chunk in r.iter_content(4096):
-                fd.write(chunk)
+    # compare the web version of an object and any existing file version of the object to
+    # conditionally download it
+    downloader = Downloader()
+    try:
+        return downloader.fetch(url, fpath)
+    finally:
+        downloader.close()
 
 
 
@@ -35,4 +269,4 @@ def main(args=[]):
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
-    main(sys.argv)
\ No newline at end of file
+    main(sys.argv)
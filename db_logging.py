@@ -3,16 +3,50 @@ import sys
 import os
 import logging
 import sqlite3
+import operator
 
 logger = logging.getLogger(__name__)
 
+# the column order of irs_address, rows are always written in this order
+addressColumns = [
+    "BusinessName", "TaxYr", "Addr1", "Addr2", "Addr3", "Locality",
+    "StateorProvince", "Country", "PostalCode",
+    "AddrType", "EIN", "YearFormation", "NumEmployees", "ReturnFile"
+    ]
+
+# built once the rows are loaded rather than maintained row by row
+addressIndexes = [
+    "CREATE INDEX IF NOT EXISTS irs_address__returnfile__ind on irs_address(ReturnFile)"
+    ]
+
+# the indexes addresses are looked up by, built on each address_store partition
+lookupIndexes = [
+    "CREATE INDEX IF NOT EXISTS irs_address__ein__ind on irs_address(EIN)",
+    "CREATE INDEX IF NOT EXISTS irs_address__postalcode__ind on irs_address(PostalCode)",
+    """CREATE INDEX IF NOT EXISTS irs_address__state__locality__ind
+        on irs_address(StateorProvince COLLATE NOCASE, Locality COLLATE NOCASE)"""
+    ]
+
+# write buffered import errors once this many have accumulated
+ERROR_BUFFER = 1000
+
 class DBLOG():
     db = None
 
-    def __init__(self, dbname, preserve=False):
-        if os.path.isfile(dbname) and dbname.endswith(".db"):
+    def __init__(self, dbname, preserve=False, bulk=False):
+        if os.path.isfile(dbname) and dbname.endswith(".db") and not preserve:
             os.remove(dbname)
         self.db = sqlite3.connect(dbname)
+        self.bulk = bulk
+        self.errors = []
+        self.address_row = operator.itemgetter(*addressColumns)
+        self.insert_address = f"""INSERT INTO irs_address ({",".join(addressColumns)}) 
+            VALUES ({",".join(['?' for d in addressColumns])})"""
+
+        if bulk:
+            # favour load speed, the extraction checkpoints make a lost load recoverable
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=OFF")
         self.setup()
 
     def setup(self):
@@ -23,6 +57,21 @@ class DBLOG():
     BusinessName TEXT ,TaxYr TEXT, Addr1 TEXT, Addr2 TEXT, Addr3 TEXT, 
     Locality TEXT ,StateorProvince TEXT, Country TEXT, PostalCode TEXT,
     AddrType TEXT, EIN TEXT, YearFormation TEXT, NumEmployees TEXT, ReturnFile TEXT );
+        """)
+        # zip members that have already been extracted, so later runs only pick up new ones
+        cur.execute("""CREATE TABLE IF NOT EXISTS extract_manifest (member TEXT PRIMARY KEY, 
+    return_file TEXT, crc INTEGER, size INTEGER, extract_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+        """)
+        # consistent points of a run the outputs can be rolled back to
+        cur.execute("""CREATE TABLE IF NOT EXISTS extract_checkpoint (cid INTEGER PRIMARY KEY AUTOINCREMENT, 
+    member_index INTEGER, member_count INTEGER, csv_offset INTEGER, address_rowid INTEGER, error_fid INTEGER,
+    checkpoint_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+        """)
+        # throughput and the time spent in each stage, as the run goes
+        cur.execute("""CREATE TABLE IF NOT EXISTS run_metrics (mid INTEGER PRIMARY KEY AUTOINCREMENT, tax_year TEXT,
+    elapsed REAL, returns INTEGER, rows INTEGER, failures INTEGER, unknown_tags INTEGER, bytes_read INTEGER,
+    decompress_s REAL, decode_s REAL, parse_s REAL, extract_s REAL, csv_s REAL, sqlite_s REAL,
+    returns_per_sec REAL, rows_per_sec REAL, metric_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
         """)
         # wait for the statements to complete
         assert cur.fetchall() is not None, "failed to create the DB tables"
@@ -35,26 +84,119 @@ class DBLOG():
         if len(data) == 0:
             return
 
-        if type(data[0]) is dict:
-            # extract the fields from the dict
-            flds = list(data[0].keys())
-            data = [list(d.values()) for d in data]
-        else:
-            # use a default series of fields
-            flds = ["EIN", "BusinessName", "TaxYr", "AddrType", "NumEmployees", "YearFormation", "ReturnFile", 
-                "Addr1", "Addr2", "Addr3", "Locality", "StateorProvince", "Country", "PostalCode"]
         cur = self.db.cursor()
-        cur.executemany(f"""INSERT INTO irs_address ({",".join(flds)}) 
-            VALUES ({",".join(['?' for d in flds])})""", data)
-        self.db.commit()
+        self._insert_rows(cur, data)
+        # bulk loads are committed with the next checkpoint
+        if not self.bulk:
+            self.db.commit()
+
+    def _insert_rows(self, cur, data):
+        if len(data) == 0:
+            return
+
+        # AddressRecord tuples are already in column order
+        if type(data[0]) is dict:
+            # pull the fields in column order, whatever order the dict keys are in
+            data = [self.address_row(d) for d in data]
+        cur.executemany(self.insert_address, data)
 
     def log_validity(self, name, msg):
+        if self.bulk:
+            self.errors.append([name, f"{msg}"])
+            if len(self.errors) >= ERROR_BUFFER:
+                self._insert_errors(self.db.cursor())
+                self.db.commit()
+            return
+
         cur = self.db.cursor()
         cur.executemany("""INSERT INTO import_errors (xml_file, msg) VALUES (?,?)""", [[name, f"{msg}"]])
         self.db.commit()
 
+    def _insert_errors(self, cur):
+        if len(self.errors) == 0:
+            return
+
+        cur.executemany("""INSERT INTO import_errors (xml_file, msg) VALUES (?,?)""", self.errors)
+        self.errors = []
+
+    def manifest(self):
+        cur = self.db.cursor()
+        cur.execute("""SELECT member, crc, size FROM extract_manifest""")
+
+        return {d[0]: (d[1], d[2]) for d in cur.fetchall()}
+
+    def save_manifest(self, members):
+        cur = self.db.cursor()
+        self._insert_manifest(cur, members)
+        self.db.commit()
+
+    def _insert_manifest(self, cur, members):
+        # members are (member, return_file, crc, size)
+        if len(members) == 0:
+            return
+
+        cur.executemany("""INSERT INTO extract_manifest (member, return_file, crc, size) VALUES (?,?,?,?)
+            ON CONFLICT (member) DO
+            UPDATE SET crc = excluded.crc, size = excluded.size, extract_time = CURRENT_TIMESTAMP
+            """, members)
+
+    def checkpoint(self, data, members, member_index, member_count, csv_offset):
+        # rows, manifest entries and the position reached all land in one transaction
+        cur = self.db.cursor()
+        self._insert_rows(cur, data)
+        self._insert_manifest(cur, members)
+        self._insert_errors(cur)
+        cur.execute("""INSERT INTO extract_checkpoint (member_index, member_count, csv_offset, address_rowid, error_fid)
+            SELECT ?, ?, ?, (SELECT coalesce(max(rowid), 0) FROM irs_address), (SELECT coalesce(max(fid), 0) FROM import_errors)
+            """, [member_index, member_count, csv_offset])
+        self.db.commit()
+
+    def save_metrics(self, row):
+        cur = self.db.cursor()
+        cur.execute(f"""INSERT INTO run_metrics ({",".join(row.keys())}) VALUES ({",".join(['?' for d in row])})""",
+            list(row.values()))
+        self.db.commit()
+
+    def last_checkpoint(self):
+        cur = self.db.cursor()
+        cur.execute("""SELECT member_index, member_count, csv_offset, address_rowid, error_fid 
+            FROM extract_checkpoint ORDER BY cid DESC LIMIT 1""")
+        res = cur.fetchone()
+        if res is None:
+            return None
+
+        return dict(zip(["member_index", "member_count", "csv_offset", "address_rowid", "error_fid"], res))
+
+    def rollback_to(self, checkpoint):
+        # discard anything written after the checkpoint
+        cur = self.db.cursor()
+        cur.execute("""DELETE FROM irs_address WHERE rowid > ?""", [checkpoint["address_rowid"]])
+        cur.execute("""DELETE FROM import_errors WHERE fid > ?""", [checkpoint["error_fid"]])
+        self.db.commit()
+
+    def forget(self, members):
+        # drop everything recorded for members that are about to be extracted again
+        cur = self.db.cursor()
+        cur.executemany("""DELETE FROM irs_address WHERE ReturnFile = ?""", [[os.path.basename(d)] for d in members])
+        cur.executemany("""DELETE FROM import_errors WHERE xml_file = ?""", [[d] for d in members])
+        cur.executemany("""DELETE FROM extract_manifest WHERE member = ?""", [[d] for d in members])
+        self.db.commit()
+
+    def build_indexes(self):
+        cur = self.db.cursor()
+        for cmd in addressIndexes:
+            cur.execute(cmd)
+        self.db.commit()
+
     def close(self):
+        self._insert_errors(self.db.cursor())
         self.db.commit()
+        self.build_indexes()
+
+        if self.bulk:
+            # fold the WAL back in so the DB is a single file again
+            self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self.db.execute("PRAGMA journal_mode=DELETE")
         self.db.close()
 
 def main(args):
@@ -8,18 +8,40 @@ import glob
 import time
 import xml.etree.ElementTree as ET
 import unicodecsv as csv
-import zipfile
 import logging
 import traceback
 import db_logging
+import normalize_address
+import run_metrics
+import return_source
+import address_store
 import sqlite3
+import multiprocessing
+import collections
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    # parquet output is optional
+    pyarrow = None
 
 # set TMPDIR to be here unless it already is defined
 if "TMPDIR" not in os.environ:
     os.environ["TMPDIR"] = os.path.realpath(__name__)
 
+# bumped when a change alters the rows extracted from the same returns, recorded with each store partition
+EXTRACT_VERSION = "1"
+
+# collect per stage timings and counters of a run, see run_metrics.py
 TIMINGS = False
 
+EFILE_NS = "{http://www.irs.gov/efile}"
+
+# number of returns handed to a worker process at a time, this divides evenly
+# into the 10000 return flush interval of scan_year
+SHARD_SIZE = 1000
+
 addressTags = [
     "AddressUS",
     "USAddress",
@@ -43,6 +65,27 @@ businessContentTags = [
     "BusinessNameLine1Txt/.."
     ]
 
+einTags = [
+    "EIN"
+    ]
+
+taxYrTags = [
+    "TaxYr",
+    "TaxYear"
+    ]
+
+yearFormationTags = [
+    "YearFormation",
+    "FormationYr"
+    ]
+
+numEmployeesTags = [
+    "TotalNbrEmployees",
+    "NumberOfEmployees",
+    "TotalEmployeeCnt",
+    "EmployeeCnt"
+    ]
+
 timestamps = [
     "Timestamp",
     "ReturnTS"
@@ -88,69 +131,131 @@ countryTags = [
     "{http://www.irs.gov/efile}Country"
     ]
 
-csvHeaders = [
-    'BusinessName', 'TaxYr',
-    'Addr1','Addr2','Addr3', 'Locality',
-    'StateorProvince', 'Country', 'PostalCode',
-    'AddrType','EIN','YearFormation','NumEmployees','ReturnFile'
+# the csv columns are the irs_address columns, in the one order rows are built and written in
+csvHeaders = db_logging.addressColumns
+
+# low cardinality columns that are stored dictionary encoded in parquet output
+dictionaryColumns = [
+    'AddrType', 'StateorProvince', 'Country', 'TaxYr'
     ]
 
+# an address row, a tuple in csvHeaders order that the csv, parquet and DB outputs all take as it is
+AddressRecord = collections.namedtuple("AddressRecord", csvHeaders)
+columnIndex = {c: i for (i, c) in enumerate(csvHeaders)}
+# the low cardinality values are interned, so the rows held until a flush share one copy of each
+internColumns = [columnIndex[c] for c in dictionaryColumns]
+
 class csvData():
     exists = False
+    appending = False
 
-    def __init__(self, yr, refresh=False):
+    def __init__(self, yr, refresh=False, append=False):
         self.filename = 'build/address_{}.csv'.format(yr)
         fieldnames = csvHeaders
-        if os.path.exists(self.filename) and refresh is False:
+        if os.path.exists(self.filename) and refresh is False and append is True:
+            # keep the existing rows and add to them
+            self.f = open(self.filename, 'ab')
+            self.writer = csv.writer(self.f)
+            self.appending = True
+        elif os.path.exists(self.filename) and refresh is False:
             self.exists = True
         else:
             self.f = open(self.filename, 'wb')
-            self.writer = csv.DictWriter(self.f, fieldnames=fieldnames)
-            self.writer.writeheader()
+            self.writer = csv.writer(self.f)
+            self.writer.writerow(fieldnames)
             self.exists = False
 
     def save_data(self, data):
-        for itm in data:
-            self.writer.writerow(itm)
+        # AddressRecords are already in column order
+        self.writer.writerows(data)
+
+    def flush(self):
+        # make the rows durable and report how far the file reaches
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        return self.f.tell()
+
+    def size(self):
+        return os.path.getsize(self.filename)
+
+    def truncate(self, offset):
+        self.f.truncate(offset)
+
+    def drop_returns(self, returnFiles):
+        # rewrite the csv without the rows of the given returns
+        self.f.close()
+        tmpname = self.filename + '.tmp'
+        with open(self.filename, 'rb') as src, open(tmpname, 'wb') as dest:
+            reader = csv.reader(src)
+            writer = csv.writer(dest)
+            header = next(reader)
+            writer.writerow(header)
+            col = header.index('ReturnFile')
+            for itm in reader:
+                if not itm[col] in returnFiles:
+                    writer.writerow(itm)
+        os.replace(tmpname, self.filename)
+
+        self.f = open(self.filename, 'ab')
+        self.writer = csv.writer(self.f)
 
     def close(self):
         self.f.close()
 
-def scanFile(irsFile, unknownTags=[], zf=None, data_logger=None):
-    if zf is None:
-        return [], unknownTags
-    else:
-        irsFile=zf.open(irsFile)
+class parquetData():
 
-    try:
-        #need to strip BOM marks if they exist
+    def __init__(self, yr):
+        self.filename = 'build/address_{}.parquet'.format(yr)
+        # write aside and move into place on close so a partial file is never picked up
+        self.tmpname = self.filename + '.tmp'
+        self.schema = pyarrow.schema([(c, pyarrow.string()) for c in csvHeaders])
+        self.writer = pyarrow.parquet.ParquetWriter(self.tmpname, self.schema,
+            use_dictionary=dictionaryColumns, write_statistics=True, compression='zstd')
 
-        root = ET.fromstring(irsFile.read().decode('utf-8-sig'))
+    def save_data(self, data):
+        # every flushed batch becomes a row group with its own column statistics
+        if len(data) == 0:
+            return
+
+        # the csv can not tell an empty value from a missing one, so neither is told apart here
+        columns = [pyarrow.array([d if not d == '' else None for d in col], type=pyarrow.string()) for col in zip(*data)]
+        self.writer.write_table(pyarrow.Table.from_arrays(columns, schema=self.schema))
+
+    def from_csv(self, filename, batchSize=100000):
+        # parquet files can not be appended to, so added rows mean a rewrite from the csv
+        data = []
+        with open(filename, 'rb') as f:
+            for itm in csv.DictReader(f):
+                data.append(AddressRecord._make([itm[c] for c in csvHeaders]))
+                if len(data) >= batchSize:
+                    self.save_data(data)
+                    data = []
+        self.save_data(data)
 
-        # only explicitly grab the root if we passively parse the XML doc
-        # tree = ET.parse(irsFile)
-        # root = tree.getroot()
-    except:
-        # log the errors immediately so we have them if thing truely crash later
-        if data_logger is not None:
-            f = io.StringIO()
-            traceback.print_exc(file=f)
+    def close(self):
+        self.writer.close()
+        os.replace(self.tmpname, self.filename)
 
-            # reset the file pointer to the top
-            f.seek(0)
-            data_logger.log_validity(irsFile.name, f.read())
-            
-        logging.warning("failed to read {}".format(irsFile.name))
-        #return nothing as if the file was readable
-        return [], unknownTags
+def read_parquet(yrs, columns=None, filters=None):
+    # filters such as [('StateorProvince', '=', 'AR')] are checked against the
+    # row group statistics so only matching row groups are read
+    files = ['build/address_{}.parquet'.format(yr) for yr in yrs]
+    files = [d for d in files if os.path.exists(d)]
 
-    parentMap = {c:p for p in root.iter() for c in p}
+    return pyarrow.parquet.ParquetDataset(files, filters=filters).read(columns=columns)
 
-    knownTags = line1Tags + line2Tags + line3Tags + cityTags + stateTags + zipCodeTags + countryTags
-    newUnknownTags = []
+def readFindall(irsFile):
+    # parse the whole return into memory and search it one tag list at a time,
+    # kept as the reference the single pass readers are measured against
+    #need to strip BOM marks if they exist
 
-    data = []
+    root = ET.fromstring(irsFile.read().decode('utf-8-sig'))
 
+    # only explicitly grab the root if we passively parse the XML doc
+    # tree = ET.parse(irsFile)
+    # root = tree.getroot()
+
+    parentMap = {c:p for p in root.iter() for c in p}
 
     # searchNameSpace
     ns = {'efile':'http://www.irs.gov/efile'}
@@ -166,7 +271,7 @@ def scanFile(irsFile, unknownTags=[], zf=None, data_logger=None):
             break
 
     ein = ''
-    for srchTag in ['EIN']:
+    for srchTag in einTags:
         for contentNode in root.findall('.//efile:' + srchTag,  ns):
             ein = contentNode.text
         # stop looking once we find a valid name
@@ -174,7 +279,7 @@ def scanFile(irsFile, unknownTags=[], zf=None, data_logger=None):
             break
 
     taxYr = ''
-    for srchTag in ['TaxYr', 'TaxYear']:
+    for srchTag in taxYrTags:
         for contentNode in root.findall('.//efile:' + srchTag,  ns):
             taxYr = contentNode.text
         # stop looking once we find a valid name
@@ -183,7 +288,7 @@ def scanFile(irsFile, unknownTags=[], zf=None, data_logger=None):
 
     # search for the company establishment year
     yrFormation = ''
-    for srchTag in ['YearFormation','FormationYr']:
+    for srchTag in yearFormationTags:
         for contentNode in root.findall('.//efile:' + srchTag,  ns):
             yrFormation = contentNode.text
         # stop looking once we find a valid valuee
@@ -192,101 +297,503 @@ def scanFile(irsFile, unknownTags=[], zf=None, data_logger=None):
 
     # search for the number of employees
     numEmployees = ''
-    for srchTag in ['TotalNbrEmployees','NumberOfEmployees','TotalEmployeeCnt','EmployeeCnt']:
+    for srchTag in numEmployeesTags:
         for contentNode in root.findall('.//efile:' + srchTag,  ns):
             numEmployees = contentNode.text
         # stop looking once we find a valid value
         if not numEmployees == '':
             break
 
+    addresses = []
     for srchTag in addressContentTags:
         # return for nodes that contain an address component
         for addressNode in root.findall('.//efile:' + srchTag + '/..',  ns):
             #pe = parentMap[addressNode]
-            context =  parentMap[addressNode].tag.replace('{http://www.irs.gov/efile}', '') + "." +  addressNode.tag.replace('{http://www.irs.gov/efile}', '')
-            item = {"EIN":ein, "BusinessName":businessName, "TaxYr": taxYr,
-                    'AddrType': context, 'NumEmployees': numEmployees, 
-                    'YearFormation': yrFormation, 'ReturnFile': os.path.basename(irsFile.name),
-                    'PostalCode': None, 'StateorProvince': None, 'Country': None,
-                    'Locality': None, 'Addr1': None, 'Addr2': None, 'Addr3': None}
-
-            for addressComponent in addressNode:
-                if not addressComponent.tag in knownTags:
-                    if not addressComponent.tag in unknownTags:
-                        unknownTags += [addressComponent.tag]
-                        newUnknownTags += [addressComponent.tag]
-                else:
-                    # line1Tags + line2Tags + line3Tags + cityTags + stateTags + zipCodeTags + countryTags
-                    if addressComponent.tag in zipCodeTags:
-                        item["PostalCode"] = addressComponent.text
-                    elif addressComponent.tag in stateTags:
-                        item["StateorProvince"] = addressComponent.text
-                    elif addressComponent.tag in countryTags:
-                        item["Country"] = addressComponent.text
-                    elif addressComponent.tag in cityTags:
-                        item["Locality"] = addressComponent.text
-                    elif addressComponent.tag in line1Tags:
-                        item["Addr1"] = addressComponent.text
-                    elif addressComponent.tag in line2Tags:
-                        item["Addr2"] = addressComponent.text
-                    elif addressComponent.tag in line3Tags:
-                        item["Addr3"] = addressComponent.text
-            
+            context =  parentMap[addressNode].tag.replace(EFILE_NS, '') + "." +  addressNode.tag.replace(EFILE_NS, '')
+            addresses.append((context, [(c.tag, c.text) for c in addressNode]))
+
+    fields = {"EIN": ein, "BusinessName": businessName, "TaxYr": taxYr,
+              "NumEmployees": numEmployees, "YearFormation": yrFormation}
 
-            ## the special value "RESTRICTED" is used to indicate redacted info
-            if 'Addr1' in item and not item["Addr1"] == "RESTRICTED":
-                data.append(item)
+    return fields, addresses
+
+# the kinds of work done when a node in the dispatch table is closed
+VALUE, FILER_NAME, NAME_CHILD, ADDRESS_CHILD = range(4)
+
+def compileDispatch():
+    # fold the search tag lists into one map of tag -> actions so a return
+    # can be searched in a single walk
+    dispatch = {}
+    for (key, tags) in [("EIN", einTags), ("TaxYr", taxYrTags),
+            ("YearFormation", yearFormationTags), ("NumEmployees", numEmployeesTags)]:
+        for srchTag in tags:
+            dispatch.setdefault(EFILE_NS + srchTag, []).append((VALUE, key))
+
+    for (i, srchTag) in enumerate(businessContentTags):
+        if srchTag.startswith("Filer/"):
+            dispatch.setdefault(EFILE_NS + srchTag.split(":")[1], []).append((FILER_NAME, i))
+        else:
+            dispatch.setdefault(EFILE_NS + srchTag.split("/")[0], []).append((NAME_CHILD, i))
+
+    for (i, srchTag) in enumerate(addressContentTags):
+        dispatch.setdefault(EFILE_NS + srchTag, []).append((ADDRESS_CHILD, i))
+
+    return dispatch
+
+def compileComponents():
+    # address component tag -> item field, in the precedence of the old elif chain
+    components = {}
+    for (fld, tags) in [("PostalCode", zipCodeTags), ("StateorProvince", stateTags),
+            ("Country", countryTags), ("Locality", cityTags), ("Addr1", line1Tags),
+            ("Addr2", line2Tags), ("Addr3", line3Tags)]:
+        for srchTag in tags:
+            components.setdefault(srchTag, fld)
+
+    return components
+
+componentFields = compileComponents()
+componentColumns = {tag: columnIndex[fld] for (tag, fld) in componentFields.items()}
+
+class FieldExtractor():
+    dispatch = compileDispatch()
+    valueTags = {
+        "EIN": [EFILE_NS + t for t in einTags],
+        "TaxYr": [EFILE_NS + t for t in taxYrTags],
+        "YearFormation": [EFILE_NS + t for t in yearFormationTags],
+        "NumEmployees": [EFILE_NS + t for t in numEmployeesTags]
+        }
+
+    def __init__(self):
+        self.lastSeen = {}
+        self.names = [[] for t in businessContentTags]
+        self.addresses = [[] for t in addressContentTags]
+        # node -> {(kind, index): preorder position of its first matching child}
+        self.pending = {}
+
+    def end(self, elem, parent, pos):
+        # called once per node after all of its children, pos is the preorder
+        # position of the node which gives findall's document order
+        if self.pending:
+            found = self.pending.pop(elem, None)
+            if found is not None:
+                for ((kind, i), first) in found.items():
+                    if kind == NAME_CHILD:
+                        self.names[i].append((first, [c.text for c in elem]))
+                    elif parent is not None:
+                        context = parent.tag.replace(EFILE_NS, '') + "." + elem.tag.replace(EFILE_NS, '')
+                        self.addresses[i].append((first, (context, [(c.tag, c.text) for c in elem])))
+
+        actions = self.dispatch.get(elem.tag)
+        if actions is None or parent is None:
+            return
+
+        for (kind, key) in actions:
+            if kind == VALUE:
+                self.lastSeen[elem.tag] = elem.text
+            elif kind == FILER_NAME:
+                if parent.tag == EFILE_NS + "Filer":
+                    self.names[key].append((pos, [c.text for c in elem]))
             else:
-                if not 'Addr1' in item:
-                    logging.info(addressComponent.tag, addressComponent.text)
-                    logging.info(item)
+                self.pending.setdefault(parent, {}).setdefault((kind, key), pos)
+
+    def walk(self, elem, parent=None, pos=0):
+        # post order walk of an in memory tree, returns the last position used
+        last = pos
+        for child in elem:
+            last = self.walk(child, elem, last + 1)
+        self.end(elem, parent, pos)
+
+        return last
+
+    def firstFound(self, key):
+        # mirror the findall loops, the last node of the first tag found wins
+        value = ''
+        for srchTag in self.valueTags[key]:
+            if srchTag in self.lastSeen:
+                value = self.lastSeen[srchTag]
+            if not value == '':
+                break
+
+        return value
+
+    def result(self):
+        businessName = []
+        for found in self.names:
+            for (pos, components) in sorted(found, key=lambda d: d[0]):
+                businessName += components
+            # stop looking once we find a valid name
+            if len(businessName) > 0:
+                businessName = ' // '.join(businessName)
+                break
+
+        fields = {"EIN": self.firstFound("EIN"), "BusinessName": businessName,
+                  "TaxYr": self.firstFound("TaxYr"), "NumEmployees": self.firstFound("NumEmployees"),
+                  "YearFormation": self.firstFound("YearFormation")}
+
+        addresses = [itm for found in self.addresses for (pos, itm) in sorted(found, key=lambda d: d[0])]
+
+        return fields, addresses
+
+def readTree(irsFile):
+    # parse the whole return into memory and search it in one walk
+    #need to strip BOM marks if they exist
+    root = ET.fromstring(irsFile.read().decode('utf-8-sig'))
+
+    extractor = FieldExtractor()
+    extractor.walk(root)
+
+    return extractor.result()
+
+def readStream(irsFile):
+    # walk the return as a stream of events straight from the zip member,
+    # only the open path and the direct children of open nodes are kept
+    extractor = FieldExtractor()
+    stack = []
+    ctr = 0
+    for (event, elem) in ET.iterparse(irsFile, events=("start", "end")):
+        if event == "start":
+            stack.append((elem, ctr))
+            ctr += 1
+            continue
+
+        (elem, pos) = stack.pop()
+        extractor.end(elem, stack[-1][0] if len(stack) > 0 else None, pos)
+
+        # the children have been consumed, release them
+        del elem[:]
+
+    return extractor.result()
+
+engines = {
+    "findall": readFindall,
+    "tree": readTree,
+    "stream": readStream
+    }
+
+def readTimed(irsFile, metrics, engine="tree"):
+    # the tree reader split into its stages so each can be timed, the other engines
+    # read, decode and parse in one go so their whole read is timed as parse
+    if not engine == "tree":
+        tm = metrics.clock()
+        result = engines[engine](irsFile)
+        metrics.lap("parse", tm)
+        metrics.count("bytes_read", irsFile.tell())
+
+        return result
+
+    tm = metrics.clock()
+    raw = irsFile.read()
+    tm = metrics.lap("decompress", tm)
+    metrics.count("bytes_read", len(raw))
+
+    text = raw.decode('utf-8-sig')
+    tm = metrics.lap("decode", tm)
+
+    root = ET.fromstring(text)
+    tm = metrics.lap("parse", tm)
+
+    extractor = FieldExtractor()
+    extractor.walk(root)
+    result = extractor.result()
+    metrics.lap("extract", tm)
+
+    return result
+
+def scanFile(irsFile, unknownTags=[], zf=None, data_logger=None, engine="tree", metrics=None):
+    if zf is None:
+        return [], unknownTags
+    else:
+        irsFile=zf.open(irsFile)
+
+    try:
+        if metrics is not None:
+            metrics.count("returns")
+            (fields, addresses) = readTimed(irsFile, metrics, engine)
+        else:
+            (fields, addresses) = engines[engine](irsFile)
+    except:
+        if metrics is not None:
+            metrics.count("failures")
+
+        # log the errors immediately so we have them if thing truely crash later
+        if data_logger is not None:
+            f = io.StringIO()
+            traceback.print_exc(file=f)
+
+            # reset the file pointer to the top
+            f.seek(0)
+            data_logger.log_validity(irsFile.name, f.read())
+            
+        logging.warning("failed to read {}".format(irsFile.name))
+        #return nothing as if the file was readable
+        return [], unknownTags
+    finally:
+        irsFile.close()
+
+    newUnknownTags = []
+
+    data = []
+
+    if metrics is not None:
+        tm = metrics.clock()
+
+    # the values of the return are set once and shared by each of its rows
+    template = [None] * len(csvHeaders)
+    for fld in ["EIN", "BusinessName", "TaxYr", "NumEmployees", "YearFormation"]:
+        template[columnIndex[fld]] = fields[fld]
+    template[columnIndex["ReturnFile"]] = os.path.basename(irsFile.name)
+
+    for (context, addressComponents) in addresses:
+        item = template.copy()
+        item[columnIndex["AddrType"]] = context
+
+        for (componentTag, componentText) in addressComponents:
+            col = componentColumns.get(componentTag)
+            if col is not None:
+                item[col] = componentText
+            elif not componentTag in unknownTags:
+                unknownTags += [componentTag]
+                newUnknownTags += [componentTag]
+
+        ## the special value "RESTRICTED" is used to indicate redacted info
+        if not item[columnIndex["Addr1"]] == "RESTRICTED":
+            for col in internColumns:
+                if type(item[col]) is str:
+                    item[col] = sys.intern(item[col])
+            data.append(AddressRecord._make(item))
 
     if len(newUnknownTags) > 0:
         logging.info(newUnknownTags)
 
+    if metrics is not None:
+        metrics.lap("extract", tm)
+        metrics.count("rows", len(data))
+        metrics.count("unknown_tags", len(newUnknownTags))
+
     return data, unknownTags
 
-def scan_year(yr, dbname=':memory:', sampleSize=False, refresh=False):
+class ErrorCollector():
+    # stand in for a DBLOG inside worker processes, errors are handed back
+    # to the parent to be written to the run DB
+    def __init__(self):
+        self.errors = []
+
+    def log_validity(self, name, msg):
+        self.errors.append((name, msg))
 
-    ocsv = csvData(yr, refresh=refresh)
+# each worker process keeps its own handle on the archives
+_worker_zf = None
+_worker_engine = "tree"
+_worker_timings = False
+
+def _init_worker(archives, engine="tree", timings=False):
+    global _worker_zf, _worker_engine, _worker_timings
+    _worker_zf = return_source.ReturnSource(archives)
+    _worker_engine = engine
+    _worker_timings = timings
+
+def _scan_shard(shard):
+    unknownTags = []
+    data = []
+    collector = ErrorCollector()
+    metrics = run_metrics.RunMetrics() if _worker_timings else None
+    for irsReturn in shard:
+        (newData, unknownTags) = scanFile(irsReturn, unknownTags=unknownTags, zf=_worker_zf, data_logger=collector, engine=_worker_engine, metrics=metrics)
+        data += newData
+
+    return shard, data, collector.errors, metrics.snapshot() if metrics is not None else None
+
+def scan_serial(zf, files, data_logger=None, engine="tree", metrics=None, profiler=None):
+    unknownTags = []
+    for (i, irsReturn) in enumerate(files):
+        if profiler is not None:
+            profiler.enter(i)
+        (newData, unknownTags) = scanFile(irsReturn, unknownTags=unknownTags, zf=zf, data_logger=data_logger, engine=engine, metrics=metrics)
+        if profiler is not None:
+            profiler.leave(i)
+        yield [irsReturn], newData
+
+def scan_parallel(archives, files, workers, data_logger=None, engine="tree", metrics=None):
+    shards = [files[i:i + SHARD_SIZE] for i in range(0, len(files), SHARD_SIZE)]
+    logging.info(f"scanning {len(files)} returns in {len(shards)} shards using {workers} workers")
+
+    with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(archives, engine, metrics is not None)) as pool:
+        # imap hands the shards back in submission order, so the output
+        # matches a serial run row for row
+        for (shard, newData, errors, snapshot) in pool.imap(_scan_shard, shards):
+            if data_logger is not None:
+                for (name, msg) in errors:
+                    data_logger.log_validity(name, msg)
+            if metrics is not None:
+                metrics.merge(snapshot)
+            yield shard, newData
+
+def manifest_entry(info):
+    return [info.filename, os.path.basename(info.filename), info.CRC, info.file_size]
+
+def new_members(members, dblog, ocsv):
+    # compare the zip directory to what has already been extracted
+    done = dblog.manifest()
+    fresh = [d for d in members if not d.filename in done]
+    changed = [d for d in members if d.filename in done and not done[d.filename] == (d.CRC, d.file_size)]
+
+    if len(changed) > 0:
+        logging.info(f"dropping the rows of {len(changed)} changed returns")
+        ocsv.drop_returns(set([os.path.basename(d.filename) for d in changed]))
+        dblog.forget([d.filename for d in changed])
+        # the csv was rewritten, so record where it now ends
+        dblog.checkpoint([], [], 0, 0, ocsv.flush())
+
+    logging.info(f"{len(fresh)} new and {len(changed)} changed returns of {len(members)}")
+    rescan = set([d.filename for d in fresh + changed])
+    return [d for d in members if d.filename in rescan]
+
+def restore_checkpoint(dblog, ocsv):
+    # roll both outputs back to the last consistent point of an earlier run
+    checkpoint = dblog.last_checkpoint()
+    if checkpoint is None:
+        logging.warning("no checkpoint found to restore")
+        return False
+
+    if ocsv.size() < checkpoint["csv_offset"]:
+        logging.warning(f"{ocsv.filename} is shorter than its checkpoint")
+        return False
+
+    if checkpoint["member_index"] < checkpoint["member_count"]:
+        logging.info(f"resuming a run stopped after {checkpoint['member_index']} of {checkpoint['member_count']} returns")
+
+    ocsv.truncate(checkpoint["csv_offset"])
+    dblog.rollback_to(checkpoint)
+    return True
+
+def save_outputs(data, extracted, ctr, count, ocsv, opq, dblog, metrics=None):
+    if metrics is not None:
+        tm = metrics.clock()
+    ocsv.save_data(data)
+    if opq is not None:
+        opq.save_data(data)
+    csvOffset = ocsv.flush()
+    if metrics is not None:
+        tm = metrics.lap("csv", tm)
+
+    dblog.checkpoint(data, extracted, ctr, count, csvOffset)
+    if metrics is not None:
+        metrics.lap("sqlite", tm)
+
+def scan_year(yr, dbname=None, sampleSize=False, refresh=False, workers=1, engine="tree", incremental=False, resume=False, parquet=False, normalize=False, profile=None, archives=None, store=True):
+
+    ocsv = csvData(yr, refresh=refresh, append=incremental or resume)
     if ocsv.exists is True:
         logging.info(f"skipping the build of a csv for year {yr}, as it already exists")
         return
 
     logging.info(f"importing tax year {yr}")
     # materialize the file list to keep from re-scanning the dirs
-    archivefile = f"tmpdata/irs_f990_{yr}.zip"
-    try:
-        zf = zipfile.ZipFile(archivefile, "r")
-    except FileNotFoundError:
-        logging.warning(f"archive {archivefile} not found")
+    # the year archive, or any zips and globs of them such as the downloaded download990xml_{yr}_N.zip
+    patterns = [d.format(yr=yr) for d in archives or ["tmpdata/irs_f990_{yr}.zip"]]
+    zf = return_source.ReturnSource(patterns)
+    if len(zf.archives) == 0:
+        logging.warning(f"no archive found for year {yr}")
+        ocsv.close()
         return
 
-    files = list([d for d in zf.namelist() if d.endswith(".xml")])
+    members = list([d for d in zf.infolist() if d.filename.endswith(".xml")])
+
+    # delete any existing DB, unless we are adding to it
+    dbname = dbname or f"data/my_{yr}.db"
+    dblog = db_logging.DBLOG(dbname=dbname, preserve=ocsv.appending, bulk=True)
+
+    if ocsv.appending:
+        if not restore_checkpoint(dblog, ocsv) or len(dblog.manifest()) == 0:
+            logging.warning(f"no usable extract manifest for year {yr}, rebuilding it from scratch")
+            ocsv.close()
+            dblog.close()
+            ocsv = csvData(yr, refresh=True)
+            dblog = db_logging.DBLOG(dbname=dbname, preserve=False, bulk=True)
+        else:
+            members = new_members(members, dblog, ocsv)
+
+    if parquet and pyarrow is None:
+        logging.warning("pyarrow is not installed, skipping the parquet output")
+        parquet = False
+
+    opq = None
+    if parquet and not ocsv.appending:
+        opq = parquetData(yr)
+
+    # only read a sampling of returns
+    if sampleSize:
+        members = members[:sampleSize + 1]
+
+    infos = {d.filename: d for d in members}
+    files = [d.filename for d in members]
+
+    normalizer = None
+    if normalize:
+        normalizer = normalize_address.AddressNormalizer()
+
+    metrics = None
+    if TIMINGS:
+        metrics = run_metrics.RunMetrics()
+
+    # profile is a (start, count) slice of the returns of the run
+    profiler = None
+    if profile is not None:
+        if workers > 1:
+            logging.warning("profiling needs --workers 1, skipping it")
+        else:
+            profiler = run_metrics.SliceProfiler(*profile)
+
     ctr = 0
-    unknownTags = []
     data = []
-    # delete any existing DB
-    dblog = db_logging.DBLOG(dbname=f"data/my_{yr}.db", preserve=False)
+    extracted = []
+
+    if workers > 1:
+        returns = scan_parallel(zf.archives, files, workers, data_logger=dblog, engine=engine, metrics=metrics)
+    else:
+        returns = scan_serial(zf, files, data_logger=dblog, engine=engine, metrics=metrics, profiler=profiler)
 
-    for irsReturn in files:
-        (newData, unknownTags) = scanFile(irsReturn, unknownTags=unknownTags, zf=zf, data_logger=dblog)
+    for (scanned, newData) in returns:
+        if normalizer is not None:
+            newData = normalizer.normalize(newData)
         data += newData
-        ctr += 1
+        extracted += [manifest_entry(infos[d]) for d in scanned]
+        ctr += len(scanned)
         if (ctr % 10000) == 0:
             logging.debug(".", )
-            ocsv.save_data(data)
-            dblog.save_data(data)
+            save_outputs(data, extracted, ctr, len(files), ocsv, opq, dblog, metrics)
+            if metrics is not None:
+                metrics.report(yr, dblog)
             data = []
-
-        # only read a sampling of returns
-        if sampleSize and sampleSize < ctr:
-            break
-
-    ocsv.save_data(data)
-    dblog.save_data(data)
+            extracted = []
+
+    save_outputs(data, extracted, ctr, len(files), ocsv, opq, dblog, metrics)
+    if opq is not None:
+        opq.close()
+    if metrics is not None:
+        metrics.report(yr, dblog)
+    if profiler is not None:
+        profiler.dump(f"build/profile_{yr}.prof")
     ocsv.close()
     dblog.close()
+    zf.close()
+
+    if normalizer is not None:
+        stats = normalizer.stats()
+        logging.info(f"normalized addresses {stats['hits']} cache hits, {stats['misses']} misses, hit rate {stats['hit_rate']:.1%}")
+
+    if parquet and ocsv.appending:
+        logging.info(f"rebuilding the parquet output for {yr} from {ocsv.filename}")
+        opq = parquetData(yr)
+        opq.from_csv(ocsv.filename)
+        opq.close()
+
+    # swap the year into the address store, a sample would replace the whole year with part of it
+    if store and not sampleSize:
+        ostore = address_store.AddressStore()
+        ostore.publish(yr, srcdb=dbname, source_archive=",".join(zf.archives),
+            extract_version=EXTRACT_VERSION + ("+normalize" if normalize else ""))
+        ostore.close()
 
 def years():
     yrs = []
@@ -304,20 +811,75 @@ def main(args):
     else:
         refreshData = False
 
+    # only extract the returns added to the archive since the last run
+    if "--incremental" in args:
+        incremental = True
+    else:
+        incremental = False
+
+    # also write the addresses as a columnar parquet file
+    if "--parquet" in args:
+        parquet = True
+    else:
+        parquet = False
+
+    # standardize the address fields before they are written
+    if "--normalize" in args:
+        normalize = True
+    else:
+        normalize = False
+
+    # pick up a run that stopped part way through at its last checkpoint
+    if "--resume" in args:
+        resume = True
+    else:
+        resume = False
+
     if "--sampleSize" in args:
         sampleSize = int(args[args.index("--sampleSize") + 1])
     else:
         sampleSize = False
 
+    if "--workers" in args:
+        workers = int(args[args.index("--workers") + 1])
+    else:
+        workers = 1
+
+    # tree reads each return into memory, stream parses it straight from the archive
+    if "--engine" in args:
+        engine = args[args.index("--engine") + 1]
+    else:
+        engine = "tree"
+
+    # time the stages of each return and log the throughput as the run goes
+    if "--timings" in args:
+        global TIMINGS
+        TIMINGS = True
+
+    # profile a slice of the returns, either --profile 1000 or --profile 5000:1000
+    if "--profile" in args:
+        spec = args[args.index("--profile") + 1].split(":")
+        profile = (int(spec[0]), int(spec[1])) if len(spec) > 1 else (0, int(spec[0]))
+    else:
+        profile = None
+
+    # comma separated zips or globs to read instead of the year archive, {yr} is the tax year
+    if "--archives" in args:
+        archives = args[args.index("--archives") + 1].split(",")
+    else:
+        archives = None
+
+    # leave data/address_store as it is
+    store = not "--nostore" in args
+
     if "--taxyear" in args:
         taxyrs = [args[args.index("--taxyear") + 1]]
     else:
         taxyrs = years()
 
     for yr in taxyrs:
-        dbname = f"data/filing_addresses_${yr}.db"
         starttm = time.time()
-        scan_year(yr, dbname=dbname, sampleSize=sampleSize, refresh=refreshData)
+        scan_year(yr, sampleSize=sampleSize, refresh=refreshData, workers=workers, engine=engine, incremental=incremental, resume=resume, parquet=parquet, normalize=normalize, profile=profile, archives=archives, store=store)
         duration = time.time() - starttm
         logging.info(f"Records for {yr} imported in {duration}")
 
@@ -2,6 +2,8 @@
 
 # call this as
 #  find tmpdata/2017 -exec bash ./file_check.sh {} \;
+# for loose XML files only, the returns inside the year archives are checked with
+#  python3 check_returns.py --taxyear 2017
 
 fil="$1"
 
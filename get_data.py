@@ -1,44 +1,58 @@
-
-
 import sys
 import os
-import requests
 import logging
 
+import data_downloader
+
 logger = logging.getLogger(__file__)
 
 
 def get_file(rfile, dest):
     logger.debug(f"downloading {dest}")
 
-    req = requests.get(rfile, stream=True)
-    if req.status_code in (200, 201, 202):
-        with open(dest, 'wb') as w:
-            for chunk in req.iter_content(chunk_size=512 * 1024):
-                if chunk:
-                    w.write(chunk)
-        logger.info(f"downloaded {dest}")
-    else:
-        logger.warning(f"failed to download {rfile}")
+    downloader = data_downloader.Downloader()
+    try:
+        return downloader.fetch(rfile, dest)
+    finally:
+        downloader.close()
 
 
-def get_filelist(flist):
+def get_filelist(flist, workers=4, files=2):
+    items = []
     with open(flist, 'r') as fl:
         for itm in fl:
             itm =  itm.strip()
-            dest = f'rawdata/{os.path.basename(itm)}'
             if itm.startswith('#') or itm == '':
                 continue
             dest = f'rawdata/{os.path.basename(itm)}'
-            if not os.path.exists(dest):
-                get_file(itm, dest)
-            else:
-                logger.debug(f"skipping download of {dest}")
+            items.append((itm, dest))
+
+    # finished files are skipped with a conditional request, partial ones are resumed
+    downloader = data_downloader.Downloader(workers=workers, files=files)
+    try:
+        results = downloader.fetch_all(items)
+    finally:
+        downloader.close()
+
+    for status in sorted(set(results.values())):
+        logger.info(f"{status}: {len([d for d in results.values() if d == status])} files")
+
+    return results
 
 
 def main(args=[]):
 
-    get_filelist("2021_2022_urls.txt")
+    if "--workers" in args:
+        workers = int(args[args.index("--workers") + 1])
+    else:
+        workers = 4
+
+    if "--files" in args:
+        files = int(args[args.index("--files") + 1])
+    else:
+        files = 2
+
+    get_filelist("2021_2022_urls.txt", workers=workers, files=files)
 
     logger.info("All Done")
 
@@ -194,172 +194,24 @@ get_years_listings() {
     get_aws_indexes
 }
 
-setup_retrieve_log() {
-    echo "CREATE TABLE IF NOT EXISTS retrieve_log (path TEXT);
-    CREATE TABLE IF NOT EXISTS local_index (object_id TEXT, fullpath TEXT, taxyr TEXT );
-    CREATE UNIQUE INDEX IF NOT EXISTS retrieve_log__path__ind ON retrieve_log(path);
-    CREATE UNIQUE INDEX IF NOT EXISTS local_index__fullpath__ind ON local_index(fullpath);
-    "
-}
-
-build_simple_object_listing() {
-    yr=$1
-    # build inserts for retrieve_log
-    pushd tmpdata;
-    ( 
-      find ${yr} -name "*xml" | sed -e 's/.*\/..\///' 
-      zf="irs_f990_${yr}.zip"
-      if [ -s "$zf" ]; then
-         unzip -l ${{zf} | awk -e '/./ { a=split($4,p,"/"); print p[a]; }'
-      fi ) | sort -u | grep -e '\.xml' > listing/status_${yr}.lst
-    popd
-}
-
-build_object_lisitng() {
-    yr=$1
-    # build inserts for local_index based on the superset of packaged and unpackaged listings
-
-    pushd tmpdata;
-    ( 
-      find ${yr} -type f | awk -e '/./ {  a=split($0,p,"/"); print p[a] "," $0 "," '${yr}';}' 
-      zf="irs_f990_${yr}.zip"
-      if [ -s "$zf" ]; then
-        # the ZIPfile listing has a preamble and postamble to the lisitng
-         unzip -l ${zf} | awk -e 'NR>4 { a=split($4,p,"/"); if (substr($0,1,1) == " " && p[a] != "") {  print p[a] "," $4 "," '$yr'; }}'
-      fi ) | sort -u  > ../listing/local_status_${yr}.lst
-    popd
-}
-
 refresh_status() {
     if [ -z "$1" ]; then
         echo "refresh_status requires a year or years"
         return
     fi
 
-    pushd .
-    for yr in $1; do
-
-    #build_simple_object_listing $yr
-    build_object_lisitng $yr
- 
-    ( setup_retrieve_log  
-    echo "PRAGMA SYNCHRONOUS=off;
-
-.headers off
-.mode csv
-
- DROP TABLE IF EXISTS import_tmp;
- CREATE TABLE import_tmp AS SELECT * FROM local_index;
-.import \"listing/local_status_${yr}.lst\" import_tmp
-
- INSERT INTO local_index (object_id, fullpath, taxyr)
-     SELECT object_id, fullpath, taxyr from import_tmp p
-         WHERE NOT EXISTS (SELECT 1 FROM local_index r WHERE r.fullpath = p.fullpath);
-
- -- we need the DISTINCT clause here because some returns are encoded in multiple years
- INSERT INTO retrieve_log (path)
-     SELECT DISTINCT object_id from import_tmp p
-         WHERE p.object_id like '%.xml' and
-         NOT EXISTS (SELECT 1 FROM retrieve_log r WHERE r.path = p.object_id);
-
- DROP TABLE IF EXISTS import_tmp;
-
-       ") | tee scripts/refresh_status_${yr}.sql |  sqlite3 data/listing.db
-    done
-    popd
-}
-
-load_yr_from_aws_listing() {
-    # merge the most recent S3 scan
-    echo "
-PRAGMA SYNCHRONOUS=off;
-
-ATTACH DATABASE 'data/s3_catalog.db' as s3;
-
-CREATE TABLE IF NOT EXISTS aws_listing (date TEXT, time TEXT, size INTEGER, path TEXT PRIMARY KEY);
-CREATE UNIQUE INDEX IF NOT EXISTS aws_listing__path__ind on aws_listing(path);
-
-INSERT INTO aws_listing (date, time, size, path)
-    SELECT date(object_date), time(object_date), size, key
-        FROM s3.s3_listing s
-        WHERE s.key > '' and
-           NOT EXISTS (SELECT 1 from aws_listing l WHERE l.path = s.key);
-
-SELECT changes();
-DETACH DATABASE s3;
-
-    " | sqlite3 data/listing.db > new_records.txt
-
-    cat new_records.txt
-
+    # local_index and retrieve_log from the loose downloads and the year archives in tmpdata
+    python3 build_listing.py --local --taxyear "$1"
 }
 
 load_from_aws_listings() {
-    setup_filings | sqlite3 data/listing.db
-
-    load_yr_from_aws_listing
-
-    (
-    echo "
-PRAGMA SYNCHRONOUS=off;
-CREATE INDEX IF NOT EXISTS filings__object_id__ind on filings(object_id);
-CREATE INDEX IF NOT EXISTS aws_listing__path__ind on aws_listing(path);
-
-INSERT INTO filings (object_id, tax_period, return_type)
-  SELECT DISTINCT a.path, substr(a.path,1,4) | '00', 'AWS listing'
-    FROM aws_listing a
-    WHERE 
-        length(a.path) = 29 and
-        NOT EXISTS (SELECT 1 FROM filings f WHERE f.object_id = a.path);
-
-    " ) | sqlite3 data/listing.db
-}
-
-setup_filings() {
-    echo "
-PRAGMA synchronous=off;
-
-CREATE TABLE IF NOT EXISTS filings (return_id TEXT,
-    filing_type TEXT,
-    ein text,
-    tax_period TEXT,
-    sub_date TEXT,
-    taxpayer_name TEXT,
-    return_type TEXT,
-    dln TEXT,
-    object_id TEXT );
-
-    "
+    # merge the most recent S3 scan of data/s3_catalog.db into aws_listing and filings
+    python3 build_listing.py --aws
 }
 
 build_db() {
-  
-  (setup_filings
-  echo "
-
-.headers off
-.mode csv
-"
-
-for yr in `get_years`; do
-ifil="index/index_${yr}.csv"
-  if [ -s "$fil" ]; then
-    echo ".import ${ifil} filings"
-  fi
-done
-
-echo "
-DELETE FROM filings WHERE object_id is NULL;
-
-UPDATE filings SET object_id = object_id || '_public.xml' WHERE not object_id like '%_public.xml';
-CREATE INDEX IF NOT EXISTS filings__object_id__ind on filings(object_id);
-
-DELETE FROM filings as fo 
-    WHERE rowid < (SELECT max(rowid) FROM filings f WHERE f.object_id = fo.object_id)
-  ") | tee -a scripts/build_data.sql | sqlite3 data/listing.db
-
-  # merge in data from the aws S3 listing
-  load_from_aws_listings
+    # filings from index/index_{yr}.json and .csv, then the S3 listing
+    python3 build_listing.py --indexes --aws
 }
 
 build_cleanup_script() {
@@ -408,47 +260,9 @@ SELECT 'popd';
 accumulate_redownloads() {
     yr="$1"
 
-  (
-  echo "CREATE TABLE IF NOT EXISTS redownload (url TEXT, key TEXT);
-  CREATE UNIQUE INDEX IF NOT EXISTS redownload__url__ind on redownload(url);"
-
-
-  if [ -s "data/my_${yr}.db" ]; then
-
-  echo "starting extract" >&2
-  echo "
-ATTACH DATABASE 'data/my_${yr}.db' as a;
-
-CREATE TEMP TABLE ierr_tmp as 
-    SELECT substr(xml_file,9) as key,
-        substr(xml_file,6,2) as seg,
-        xml_file
-      FROM a.import_errors;
-
-.mode column
-.headers off
-.output  'tmp/retrieve_aws.sh'
-SELECT 'mkdir -p tmpdata/${yr}/' || s.seg || ';'
-    FROM  (SELECT DISTINCT
-         seg
-      FROM ierr_tmp f
-      WHERE xml_file like '${yr}%.xml' ) as s;
-
-SELECT 'pushd tmpdata/${yr}';
-SELECT 'idx=0';
-SELECT 'if [ ! -s '|| s.seg || '/' || s.key|| ' ]; then idx=\$((idx + 1)); (cd ' || s.seg || '; curl -R -O ' || s.fullurl || ' &); fi'
-    FROM (SELECT 'https://s3.amazonaws.com/irs-form-990/' || key as fullurl, 
-        xml_file, key, seg
-      FROM ierr_tmp f
-      WHERE xml_file like '${yr}%.xml' ) as s
-    ORDER BY key;
-
-DETACH DATABASE a;
-  " 
-  fi  ) | tee scripts/build_redl_script_${yr}.sql | sqlite3 data/listing.db
-
-finalize_downloads
-
+    # re-fetch the returns in data/my_${yr}.db import_errors straight into the year archive,
+    # a following extract_addresses.py --incremental picks them up
+    python3 refetch_returns.py --taxyear "$yr" --workers 8
 }
 
 finalize_downloads() {
@@ -0,0 +1,243 @@
+## build a synthetic, reproducible archive of 990, 990EZ and 990PF returns for benchmarks
+
+import sys
+import os
+import random
+import zipfile
+import logging
+
+logger = logging.getLogger(__name__)
+
+# a fixed member timestamp keeps the archive byte for byte the same for a seed
+MEMBER_TIME = (2020, 1, 1, 0, 0, 0)
+
+# share of the returns with each quirk found in the real archives
+NEW_SCHEMA = 0.7
+BOM = 0.05
+RESTRICTED = 0.03
+FOREIGN = 0.04
+MALFORMED = 0.01
+
+returnTypes = [("990", 0.55), ("990EZ", 0.3), ("990PF", 0.15)]
+
+# the tags that changed name with the 2013 schemas, (old, new)
+schemaTags = {
+    "line1": ("AddressLine1", "AddressLine1Txt"),
+    "line2": ("AddressLine2", "AddressLine2Txt"),
+    "city": ("City", "CityNm"),
+    "state": ("State", "StateAbbreviationCd"),
+    "zip": ("ZIPCode", "ZIPCd"),
+    "name1": ("BusinessNameLine1", "BusinessNameLine1Txt"),
+    "name2": ("BusinessNameLine2", "BusinessNameLine2Txt"),
+    "taxyr": ("TaxYear", "TaxYr"),
+    "timestamp": ("Timestamp", "ReturnTs"),
+    "employees": ("TotalNbrEmployees", "TotalEmployeeCnt"),
+    "formation": ("YearFormation", "FormationYr"),
+    "person": ("NamePerson", "PersonNm"),
+    "title": ("Title", "TitleTxt"),
+    "hours": ("AverageHoursPerWeek", "AverageHoursPerWeekRt"),
+    "comp": ("ReportableCompFromOrganization", "ReportableCompFromOrgAmt"),
+    "preparer": ("PreparerFirmUSAddress", "PreparerFirmUSAdrress"),
+    }
+
+cities = [
+    ("Springfield", "IL", "627"), ("Portland", "OR", "972"), ("Austin", "TX", "787"),
+    ("Columbus", "OH", "432"), ("Albany", "NY", "122"), ("Boise", "ID", "837"),
+    ("Richmond", "VA", "232"), ("Madison", "WI", "537"), ("Denver", "CO", "802"),
+    ("Jackson", "MS", "392"), ("Salem", "MA", "019"), ("Dover", "DE", "199"),
+    ("Saint Paul", "MN", "551"), ("Little Rock", "AR", "722"), ("Santa Fe", "NM", "875"),
+    ("Washington", "DC", "200"), ("Burlington", "VT", "054"), ("Helena", "MT", "596"),
+    ]
+
+foreignCities = [
+    ("Toronto", "ON", "CA", "M5V 2T6"), ("London", None, "UK", "SW1A 1AA"),
+    ("Paris", None, "FR", "75001"), ("Mexico City", "CDMX", "MX", "06000"),
+    ]
+
+streets = ["Main", "Oak", "Maple", "Washington", "Park", "Lake", "Hill", "Church", "Market",
+    "Elm", "Pine", "Cedar", "River", "Spring", "Franklin", "Lincoln", "Mill", "Center"]
+suffixes = ["Street", "St", "Avenue", "AVE.", "Road", "Rd", "Boulevard", "Blvd", "Drive", "Lane", "Way", "Court"]
+directionals = ["", "", "", "N ", "S ", "E ", "W ", "NW "]
+units = ["", "", "", "", "Suite 100", "STE 210", "Apt 4", "# 12", "PO Box 55", "Floor 3"]
+orgWords = ["Community", "Foundation", "Friends", "of the", "Library", "Historical", "Society",
+    "Youth", "Soccer", "Club", "Health", "Alliance", "Arts", "Council", "Education", "Fund",
+    "Veterans", "Association", "Animal", "Rescue", "Trust", "Charitable", "Mission", "Center"]
+firstNames = ["Mary", "John", "Linda", "James", "Patricia", "Robert", "Maria", "David", "Susan", "Wei"]
+lastNames = ["Smith", "Johnson", "Garcia", "Brown", "Lee", "Miller", "Davis", "Nguyen", "Lopez", "Clark"]
+titles = ["President", "Treasurer", "Secretary", "Director", "Executive Director", "Board Member"]
+
+
+class ReturnMaker():
+
+    def __init__(self, yr, seed):
+        self.yr = int(yr)
+        self.rnd = random.Random(seed)
+
+    def tag(self, key, new):
+        return schemaTags[key][1 if new else 0]
+
+    def element(self, key, new, text):
+        t = self.tag(key, new)
+        return f"<{t}>{text}</{t}>"
+
+    def org_name(self):
+        return " ".join(self.rnd.sample(orgWords, self.rnd.randint(2, 4))) + self.rnd.choice(["", " Inc", " Inc.", ", Inc"])
+
+    def us_address(self, new, tag="USAddress", restricted=False):
+        (city, state, zip3) = self.rnd.choice(cities)
+        line1 = "RESTRICTED" if restricted else \
+            f"{self.rnd.randint(1, 9999)} {self.rnd.choice(directionals)}{self.rnd.choice(streets)} {self.rnd.choice(suffixes)}"
+        zipCode = f"{zip3}{self.rnd.randint(0, 99):02d}"
+        if self.rnd.random() < 0.4:
+            zipCode += f"{self.rnd.randint(0, 9999):04d}"
+        # the case and spacing of the real filings is not consistent
+        if self.rnd.random() < 0.2:
+            city = city.upper()
+        unit = self.rnd.choice(units)
+        parts = [self.element("line1", new, line1)]
+        if unit:
+            parts.append(self.element("line2", new, unit))
+        parts += [self.element("city", new, city), self.element("state", new, state), self.element("zip", new, zipCode)]
+
+        return f"<{tag}>{''.join(parts)}</{tag}>"
+
+    def foreign_address(self, new, tag="ForeignAddress"):
+        (city, province, country, postal) = self.rnd.choice(foreignCities)
+        parts = [self.element("line1", new, f"{self.rnd.randint(1, 300)} {self.rnd.choice(streets)} Road"),
+            self.element("city", new, city)]
+        if province:
+            parts.append(f"<ProvinceOrStateNm>{province}</ProvinceOrStateNm>")
+        parts += [f"<CountryCd>{country}</CountryCd>", f"<ForeignPostalCd>{postal}</ForeignPostalCd>"]
+
+        return f"<{tag}>{''.join(parts)}</{tag}>"
+
+    def filer_address(self, new, restricted):
+        if self.rnd.random() < FOREIGN:
+            return self.foreign_address(new)
+        return self.us_address(new, restricted=restricted)
+
+    def officers(self, new, count):
+        # the bulk of a real return is repeated groups like this one
+        rows = []
+        for i in range(count):
+            rows.append("<Form990PartVIISectionAGrp>" +
+                self.element("person", new, f"{self.rnd.choice(firstNames)} {self.rnd.choice(lastNames)}") +
+                self.element("title", new, self.rnd.choice(titles)) +
+                self.element("hours", new, f"{self.rnd.choice([1, 2, 5, 10, 40])}.00") +
+                "<IndividualTrusteeOrDirectorInd>X</IndividualTrusteeOrDirectorInd>" +
+                self.element("comp", new, self.rnd.choice([0, 0, 0, 45000, 82000])) +
+                "</Form990PartVIISectionAGrp>")
+
+        return "".join(rows)
+
+    def body(self, returnType, new):
+        employees = self.element("employees", new, self.rnd.randint(0, 250))
+        formation = self.element("formation", new, self.rnd.randint(1900, self.yr - 1))
+        revenue = f"<TotalRevenueAmt>{self.rnd.randint(0, 5000000)}</TotalRevenueAmt>"
+        if returnType == "990":
+            books = ""
+            if self.rnd.random() < 0.3:
+                books = f"<BooksInCareOfDetail><BusinessName>{self.element('name1', new, self.org_name())}</BusinessName>" + \
+                    self.us_address(new) + "</BooksInCareOfDetail>"
+            return f"<IRS990>{employees}{formation}{revenue}{books}{self.officers(new, self.rnd.randint(3, 30))}" + \
+                f"<MissionDesc>{' '.join(self.rnd.choices(orgWords, k=40))}</MissionDesc></IRS990>"
+        elif returnType == "990EZ":
+            return f"<IRS990EZ>{revenue}{self.officers(new, self.rnd.randint(1, 8))}" + \
+                f"<PrimaryExemptPurposeTxt>{' '.join(self.rnd.choices(orgWords, k=12))}</PrimaryExemptPurposeTxt></IRS990EZ>"
+        else:
+            grants = "".join([f"<GrantOrContributionPdDurYrGrp><RecipientBusinessName>{self.element('name1', new, self.org_name())}" +
+                f"</RecipientBusinessName>{self.us_address(new, tag='RecipientUSAddress')}<Amt>{self.rnd.randint(100, 50000)}</Amt>" +
+                "</GrantOrContributionPdDurYrGrp>" for i in range(self.rnd.randint(0, 25))])
+            return f"<IRS990PF>{revenue}{self.officers(new, self.rnd.randint(1, 6))}{grants}</IRS990PF>"
+
+    def make(self, i):
+        returnType = self.rnd.choices([d[0] for d in returnTypes], weights=[d[1] for d in returnTypes])[0]
+        # the filings before 2013 use the old tag names
+        new = self.rnd.random() < NEW_SCHEMA
+        restricted = self.rnd.random() < RESTRICTED
+        version = f"{self.yr}v{self.rnd.randint(1, 5)}.{self.rnd.randint(0, 3)}" if new else "2011v1.2"
+
+        preparer = ""
+        if self.rnd.random() < 0.5:
+            preparer = f"<PreparerFirmGrp><PreparerFirmName>{self.element('name1', new, self.org_name())}</PreparerFirmName>" + \
+                self.us_address(new, tag=self.tag("preparer", new)) + "</PreparerFirmGrp>"
+
+        name = self.element("name1", new, self.org_name())
+        if self.rnd.random() < 0.2:
+            name += self.element("name2", new, "C/O " + self.rnd.choice(lastNames))
+
+        xml = f"""<?xml version="1.0" encoding="utf-8"?>
+<Return xmlns="http://www.irs.gov/efile" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" returnVersion="{version}">
+<ReturnHeader binaryAttachmentCnt="0">{self.element('timestamp', new, f'{self.yr + 1}-05-{self.rnd.randint(1, 28):02d}T10:00:00-05:00')}
+<ReturnTypeCd>{returnType}</ReturnTypeCd>{self.element('taxyr', new, self.yr)}
+<Filer><EIN>{self.rnd.randint(10000000, 999999999):09d}</EIN><BusinessName>{name}</BusinessName>
+<BusinessNameControlTxt>XXXX</BusinessNameControlTxt><PhoneNum>5555551212</PhoneNum>{self.filer_address(new, restricted)}</Filer>
+{preparer}</ReturnHeader>
+<ReturnData documentCnt="1">{self.body(returnType, new)}</ReturnData>
+</Return>
+"""
+        data = xml.encode("utf-8")
+        if self.rnd.random() < BOM:
+            data = b"\xef\xbb\xbf" + data
+
+        return data
+
+    def malformed(self, data):
+        kind = self.rnd.choice(["truncated", "empty", "html", "garbage"])
+        if kind == "truncated":
+            return data[:self.rnd.randint(50, len(data) - 20)]
+        elif kind == "empty":
+            return b""
+        elif kind == "html":
+            return b"<html><head><title>503 Service Unavailable</title></head><body>Slow Down</body></html>"
+        return bytes(self.rnd.getrandbits(8) for i in range(200))
+
+
+def make_corpus(archivefile, returns=1000, yr=2019, seed=1):
+    maker = ReturnMaker(yr, seed)
+    if os.path.dirname(archivefile):
+        os.makedirs(os.path.dirname(archivefile), exist_ok=True)
+
+    ctr = 0
+    with zipfile.ZipFile(archivefile, "w", zipfile.ZIP_DEFLATED) as zf:
+        for i in range(returns):
+            data = maker.make(i)
+            if maker.rnd.random() < MALFORMED:
+                data = maker.malformed(data)
+                ctr += 1
+            objectId = f"{yr}{i % 100:02d}{i:012d}"
+            zf.writestr(zipfile.ZipInfo(f"{yr}/{objectId[4:6]}/{objectId}_public.xml", MEMBER_TIME), data,
+                compress_type=zipfile.ZIP_DEFLATED)
+
+    logger.info(f"wrote {returns} returns, {ctr} malformed, to {archivefile}")
+    return archivefile
+
+
+def main(args):
+
+    if "--returns" in args:
+        returns = int(args[args.index("--returns") + 1])
+    else:
+        returns = 1000
+
+    if "--taxyear" in args:
+        yr = int(args[args.index("--taxyear") + 1])
+    else:
+        yr = 2019
+
+    if "--seed" in args:
+        seed = int(args[args.index("--seed") + 1])
+    else:
+        seed = 1
+
+    if "--out" in args:
+        archivefile = args[args.index("--out") + 1]
+    else:
+        archivefile = f"bench/tmpdata/irs_f990_{yr}.zip"
+
+    make_corpus(archivefile, returns=returns, yr=yr, seed=seed)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main(sys.argv)
@@ -0,0 +1,302 @@
+## match the extracted IRS addresses against the National Address Database (NAD)
+
+import sys
+import os
+import re
+import logging
+import sqlite3
+import tempfile
+import difflib
+import multiprocessing
+
+import normalize_address
+
+logger = logging.getLogger(__name__)
+
+MATCH_DB = "data/nad_matches.db"
+
+# rows below this confidence are recorded as unmatched
+MIN_CONFIDENCE = 0.5
+
+# how much each piece of evidence adds to the confidence of a candidate
+STREET_WEIGHT = 0.6
+ZIP_WEIGHT = 0.25
+CITY_WEIGHT = 0.15
+
+# the NAD table and the names of the columns used, as found in nad.gpkg
+nadTable = "address"
+nadColumns = {
+    "objectid": "objectid",
+    "state": "state",
+    "zip_code": "zip_code",
+    "add_number": "add_number",
+    "streetname": "streetname",
+    "stn_postyp": "stn_postyp",
+    "post_comm": "post_comm"
+    }
+
+houseNumber = re.compile(r'^(\d+)(?:-?[A-Z]|-\d+| 1/2)?\s+(.+)$')
+
+
+def parse_addr1(addr1):
+    # split a normalized first address line into house number and street
+    if addr1 is None:
+        return None, None
+
+    m = houseNumber.match(addr1)
+    if m is None:
+        return None, None
+
+    return str(int(m.group(1))), m.group(2)
+
+
+def street_key(street):
+    # the blocking prefix of a street, ignoring a leading directional
+    words = street.split()
+    if len(words) > 1 and words[0] in normalize_address.directionals:
+        words = words[1:]
+
+    return words[0][:4]
+
+
+def zip5(postalCode):
+    if postalCode is None:
+        return None
+
+    return postalCode[:5]
+
+
+def stage_irs(irs_db, staging_db):
+    # normalize, parse and partition the IRS rows by state in one pass
+    normalizer = normalize_address.AddressNormalizer()
+    src = sqlite3.connect(f"file:{irs_db}?mode=ro", uri=True)
+    dest = sqlite3.connect(staging_db)
+    dest.execute("""CREATE TABLE irs_block (irs_rowid INTEGER, state TEXT, zip5 TEXT, house TEXT,
+        street_key TEXT, street TEXT, locality TEXT)""")
+    # the foreign and state-less rows, which fall in no block
+    dest.execute("""CREATE TABLE irs_skipped (irs_rowid INTEGER)""")
+
+    cur = src.cursor()
+    cur.execute("""SELECT rowid, Addr1, Addr2, Addr3, Locality, StateorProvince, Country, PostalCode FROM irs_address""")
+    ctr = 0
+    while True:
+        rows = cur.fetchmany(10000)
+        if len(rows) == 0:
+            break
+
+        staged = []
+        skipped = []
+        for row in rows:
+            (addr1, addr2, addr3, locality, state, country, postalCode) = normalizer.normalize_fields(tuple(row[1:]))
+            if not country in (None, "US") or state is None:
+                skipped.append([row[0]])
+                continue
+            (house, street) = parse_addr1(addr1)
+            staged.append([row[0], state, zip5(postalCode), house, street_key(street) if street else None, street, locality])
+        dest.executemany("""INSERT INTO irs_block VALUES (?,?,?,?,?,?,?)""", staged)
+        dest.executemany("""INSERT INTO irs_skipped VALUES (?)""", skipped)
+        ctr += len(staged)
+
+    dest.execute("""CREATE INDEX irs_block__state__ind on irs_block(state)""")
+    dest.commit()
+    dest.close()
+    src.close()
+
+    return ctr
+
+
+def staged_states(staging_db):
+    db = sqlite3.connect(staging_db)
+    states = [d[0] for d in db.execute("""SELECT DISTINCT state FROM irs_block ORDER BY 1""")]
+    db.close()
+
+    return states
+
+
+def load_nad_blocks(nad_db, state):
+    # hash the NAD rows of a state on both blocking keys
+    c = nadColumns
+    db = sqlite3.connect(f"file:{nad_db}?mode=ro", uri=True)
+    cur = db.cursor()
+    cur.execute(f"""SELECT {c['objectid']}, {c['zip_code']}, {c['add_number']}, {c['streetname']},
+        {c['stn_postyp']}, {c['post_comm']}
+        FROM {nadTable} WHERE {c['state']} = ?""", [state])
+
+    byStreet = {}
+    byZip = {}
+    for (objectid, zipCode, addNumber, streetName, postType, postComm) in cur:
+        if addNumber is None or streetName is None:
+            continue
+        street = normalize_address.normalize_street(" ".join([d for d in [streetName, postType] if d]))
+        # a blank street name has nothing to match on
+        if street is None:
+            continue
+        nad = (objectid, zip5(str(zipCode)) if zipCode else None, street, normalize_address.clean_text(postComm))
+        house = str(int(addNumber)) if str(addNumber).isdigit() else str(addNumber)
+        byStreet.setdefault((house, street_key(street)), []).append(nad)
+        if nad[1] is not None:
+            byZip.setdefault((nad[1], house), []).append(nad)
+    db.close()
+
+    return byStreet, byZip
+
+
+def score(irs, nad):
+    (irs_rowid, zipCode, house, skey, street, locality) = irs
+    (objectid, nadZip, nadStreet, nadCity) = nad
+
+    confidence = STREET_WEIGHT * difflib.SequenceMatcher(None, street, nadStreet).ratio()
+    if zipCode is not None and zipCode == nadZip:
+        confidence += ZIP_WEIGHT
+    if locality is not None and locality == nadCity:
+        confidence += CITY_WEIGHT
+
+    return confidence
+
+
+def match_state(args):
+    (state, staging_db, nad_db) = args
+    (byStreet, byZip) = load_nad_blocks(nad_db, state)
+
+    db = sqlite3.connect(f"file:{staging_db}?mode=ro", uri=True)
+    cur = db.cursor()
+    cur.execute("""SELECT irs_rowid, zip5, house, street_key, street, locality FROM irs_block WHERE state = ?""", [state])
+
+    results = []
+    for irs in cur:
+        (irs_rowid, zipCode, house, skey, street, locality) = irs
+        if house is None:
+            results.append([irs_rowid, None, 0.0, "unparsed"])
+            continue
+
+        # candidates come only from the two blocks the row falls in
+        best = (None, 0.0, "none")
+        for (method, candidates) in [("street", byStreet.get((house, skey), [])), ("zip", byZip.get((zipCode, house), []))]:
+            for nad in candidates:
+                confidence = score(irs, nad)
+                if confidence > best[1]:
+                    best = (nad[0], confidence, method)
+
+        if best[1] < MIN_CONFIDENCE:
+            best = (None, best[1], "none")
+        results.append([irs_rowid, best[0], round(best[1], 4), best[2]])
+    db.close()
+
+    return state, results
+
+
+def setup_matches(db):
+    cur = db.cursor()
+    cur.execute("""CREATE TABLE IF NOT EXISTS nad_match (irs_db TEXT, irs_rowid INTEGER, nad_objectid INTEGER,
+    confidence REAL, method TEXT, match_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP)
+    """)
+    cur.execute("""CREATE UNIQUE INDEX IF NOT EXISTS nad_match__irs_db__irs_rowid__ind on nad_match(irs_db, irs_rowid)
+    """)
+    assert cur.fetchall() is not None, "unable to create the match tables"
+
+
+def clear_matches(db, irs_db, staging_db, states):
+    # the rows of the states being run, the skipped rows and those of irs_address rows that are gone, as
+    # a refreshed or incremental run reassigns and removes rowids
+    cur = db.cursor()
+    cur.execute("""ATTACH DATABASE ? as staged""", [staging_db])
+    cur.execute("""ATTACH DATABASE ? as irs""", [irs_db])
+    cur.execute(f"""DELETE FROM nad_match WHERE irs_db = ? and (
+        irs_rowid IN (SELECT irs_rowid FROM staged.irs_block WHERE state IN ({",".join(['?' for d in states])}))
+        or irs_rowid IN (SELECT irs_rowid FROM staged.irs_skipped)
+        or irs_rowid NOT IN (SELECT rowid FROM irs.irs_address))
+        """, [irs_db] + list(states))
+    removed = cur.rowcount
+    db.commit()
+    cur.execute("""DETACH DATABASE staged""")
+    cur.execute("""DETACH DATABASE irs""")
+
+    return removed
+
+
+def skipped_rows(staging_db):
+    db = sqlite3.connect(staging_db)
+    results = [[d[0], None, 0.0, "skipped"] for d in db.execute("""SELECT irs_rowid FROM irs_skipped ORDER BY 1""")]
+    db.close()
+
+    return results
+
+
+def save_matches(db, irs_db, results):
+    cur = db.cursor()
+    cur.executemany("""INSERT INTO nad_match (irs_db, irs_rowid, nad_objectid, confidence, method) VALUES (?,?,?,?,?)
+    ON CONFLICT (irs_db, irs_rowid) DO
+    UPDATE SET nad_objectid = excluded.nad_objectid, confidence = excluded.confidence,
+        method = excluded.method, match_time = CURRENT_TIMESTAMP
+    """, [[irs_db] + d for d in results])
+    db.commit()
+
+
+def match_nad(irs_db, nad_db, match_db=MATCH_DB, states=None, workers=4):
+    (fd, staging_db) = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    os.remove(staging_db)
+
+    try:
+        ctr = stage_irs(irs_db, staging_db)
+        logger.info(f"staged {ctr} US addresses from {irs_db}")
+        if states is None:
+            states = staged_states(staging_db)
+
+        db = sqlite3.connect(match_db)
+        setup_matches(db)
+        removed = clear_matches(db, irs_db, staging_db, states)
+        logger.info(f"cleared {removed} earlier matches of {irs_db}")
+
+        # every irs_address row gets a result, the ones in no block an unmatched one
+        skipped = skipped_rows(staging_db)
+        save_matches(db, irs_db, skipped)
+        logger.info(f"skipped {len(skipped)} foreign or state-less addresses")
+
+        tasks = [(st, staging_db, nad_db) for st in states]
+        with multiprocessing.Pool(workers) as pool:
+            for (state, results) in pool.imap_unordered(match_state, tasks):
+                matched = len([d for d in results if d[1] is not None])
+                logger.info(f"{state}: matched {matched} of {len(results)} addresses")
+                save_matches(db, irs_db, results)
+        db.close()
+    finally:
+        if os.path.exists(staging_db):
+            os.remove(staging_db)
+
+
+def main(args):
+
+    if not "--irs" in args or not "--nad" in args:
+        usage()
+        return
+
+    irs_db = args[args.index("--irs") + 1]
+    nad_db = args[args.index("--nad") + 1]
+
+    if "--out" in args:
+        match_db = args[args.index("--out") + 1]
+    else:
+        match_db = MATCH_DB
+
+    if "--states" in args:
+        states = args[args.index("--states") + 1].split()
+    else:
+        states = None
+
+    if "--workers" in args:
+        workers = int(args[args.index("--workers") + 1])
+    else:
+        workers = 4
+
+    match_nad(irs_db, nad_db, match_db=match_db, states=states, workers=workers)
+    logger.info("All Done")
+
+
+def usage():
+    logger.warning("usage: python3 match_nad.py --irs data/my_2019.db --nad nad.gpkg [--out data/nad_matches.db] [--states \"AR CA\"] [--workers 4]")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main(sys.argv)
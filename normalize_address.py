@@ -0,0 +1,188 @@
+## standardize the address fields pulled from the returns
+
+import sys
+import re
+import logging
+import functools
+
+logger = logging.getLogger(__name__)
+
+# the default number of distinct raw addresses remembered
+CACHE_SIZE = 200000
+
+addressFields = [
+    'Addr1', 'Addr2', 'Addr3', 'Locality',
+    'StateorProvince', 'Country', 'PostalCode'
+    ]
+
+stateNames = {
+    "ALABAMA": "AL", "ALASKA": "AK", "ARIZONA": "AZ", "ARKANSAS": "AR",
+    "CALIFORNIA": "CA", "COLORADO": "CO", "CONNECTICUT": "CT", "DELAWARE": "DE",
+    "DISTRICT OF COLUMBIA": "DC", "FLORIDA": "FL", "GEORGIA": "GA", "HAWAII": "HI",
+    "IDAHO": "ID", "ILLINOIS": "IL", "INDIANA": "IN", "IOWA": "IA",
+    "KANSAS": "KS", "KENTUCKY": "KY", "LOUISIANA": "LA", "MAINE": "ME",
+    "MARYLAND": "MD", "MASSACHUSETTS": "MA", "MICHIGAN": "MI", "MINNESOTA": "MN",
+    "MISSISSIPPI": "MS", "MISSOURI": "MO", "MONTANA": "MT", "NEBRASKA": "NE",
+    "NEVADA": "NV", "NEW HAMPSHIRE": "NH", "NEW JERSEY": "NJ", "NEW MEXICO": "NM",
+    "NEW YORK": "NY", "NORTH CAROLINA": "NC", "NORTH DAKOTA": "ND", "OHIO": "OH",
+    "OKLAHOMA": "OK", "OREGON": "OR", "PENNSYLVANIA": "PA", "RHODE ISLAND": "RI",
+    "SOUTH CAROLINA": "SC", "SOUTH DAKOTA": "SD", "TENNESSEE": "TN", "TEXAS": "TX",
+    "UTAH": "UT", "VERMONT": "VT", "VIRGINIA": "VA", "WASHINGTON": "WA",
+    "WEST VIRGINIA": "WV", "WISCONSIN": "WI", "WYOMING": "WY",
+    "AMERICAN SAMOA": "AS", "GUAM": "GU", "NORTHERN MARIANA ISLANDS": "MP",
+    "PUERTO RICO": "PR", "VIRGIN ISLANDS": "VI", "U.S. VIRGIN ISLANDS": "VI"
+    }
+
+countryNames = {
+    "UNITED STATES": "US", "UNITED STATES OF AMERICA": "US",
+    "USA": "US", "U.S.A.": "US", "U.S.": "US"
+    }
+
+# USPS Publication 28 abbreviations
+streetSuffixes = {
+    "ALLEY": "ALY", "AVENUE": "AVE", "AV": "AVE", "BOULEVARD": "BLVD", "CIRCLE": "CIR",
+    "COURT": "CT", "CENTER": "CTR", "DRIVE": "DR", "EXPRESSWAY": "EXPY", "FREEWAY": "FWY",
+    "HIGHWAY": "HWY", "LANE": "LN", "PARKWAY": "PKWY", "PLACE": "PL", "PLAZA": "PLZ",
+    "ROAD": "RD", "ROUTE": "RTE", "SQUARE": "SQ", "STREET": "ST", "STR": "ST",
+    "TERRACE": "TER", "TRAIL": "TRL", "TURNPIKE": "TPKE", "WAY": "WAY"
+    }
+
+directionals = {
+    "NORTH": "N", "SOUTH": "S", "EAST": "E", "WEST": "W",
+    "NORTHEAST": "NE", "NORTHWEST": "NW", "SOUTHEAST": "SE", "SOUTHWEST": "SW"
+    }
+
+unitDesignators = {
+    "APARTMENT": "APT", "BUILDING": "BLDG", "FLOOR": "FL", "ROOM": "RM",
+    "SUITE": "STE", "UNIT": "UNIT", "APT": "APT", "BLDG": "BLDG", "FL": "FL",
+    "RM": "RM", "STE": "STE", "#": "#"
+    }
+
+# accept the abbreviations themselves so "ST." is tidied to "ST"
+streetSuffixes.update({v: v for v in list(streetSuffixes.values())})
+directionals.update({v: v for v in list(directionals.values())})
+
+spaces = re.compile(r'\s+')
+nonDigits = re.compile(r'[^0-9]')
+
+
+def clean_text(value):
+    # collapse runs of whitespace and use upper case, empty values become None
+    if value is None:
+        return None
+
+    value = spaces.sub(' ', value).strip(' ,').upper()
+    if value == '':
+        return None
+
+    return value
+
+
+def normalize_country(value):
+    value = clean_text(value)
+    return countryNames.get(value, value)
+
+
+def normalize_state(value):
+    value = clean_text(value)
+    if value is None:
+        return None
+
+    return stateNames.get(value.rstrip('.'), value.rstrip('.'))
+
+
+def normalize_zip(value):
+    # 5 digit ZIPs stay as is, ZIP+4 are written as 12345-6789
+    value = clean_text(value)
+    if value is None:
+        return None
+
+    digits = nonDigits.sub('', value)
+    if len(digits) == 5 and len(value) <= 6:
+        return digits
+    elif len(digits) == 9 and len(value) <= 10:
+        return digits[:5] + '-' + digits[5:]
+
+    return value
+
+
+def normalize_street(value):
+    value = clean_text(value)
+    if value is None:
+        return None
+
+    words = value.replace(',', ' ').split()
+    keys = [w.rstrip('.') for w in words]
+
+    # the unit designator and anything after it
+    end = len(words)
+    for (i, key) in enumerate(keys):
+        if i > 0 and key in unitDesignators:
+            words[i] = unitDesignators[key]
+            end = i
+            break
+
+    # a trailing directional, then the street suffix in front of it
+    if end > 2 and keys[end - 1] in directionals:
+        words[end - 1] = directionals[keys[end - 1]]
+        end -= 1
+    if end > 1 and keys[end - 1] in streetSuffixes:
+        words[end - 1] = streetSuffixes[keys[end - 1]]
+        end -= 1
+
+    # a leading directional following the house number
+    if end > 2 and words[0][0].isdigit() and keys[1] in directionals:
+        words[1] = directionals[keys[1]]
+
+    return ' '.join(words)
+
+
+def normalize_fields(raw):
+    # raw is a tuple of the addressFields values
+    (addr1, addr2, addr3, locality, state, country, postalCode) = raw
+
+    country = normalize_country(country)
+    if country is None or country == "US":
+        return (normalize_street(addr1), normalize_street(addr2), normalize_street(addr3),
+            clean_text(locality), normalize_state(state), country, normalize_zip(postalCode))
+
+    # only tidy the text of foreign addresses
+    return (clean_text(addr1), clean_text(addr2), clean_text(addr3),
+        clean_text(locality), clean_text(state), country, clean_text(postalCode))
+
+
+class AddressNormalizer():
+
+    def __init__(self, maxsize=CACHE_SIZE):
+        # repeated addresses (preparers, books in care of) come straight from the cache
+        self.normalize_fields = functools.lru_cache(maxsize=maxsize)(normalize_fields)
+
+    def normalize(self, data):
+        # dicts are changed in place, the extract_addresses.AddressRecord tuples are replaced in the list
+        for (i, itm) in enumerate(data):
+            if isinstance(itm, dict):
+                fixed = self.normalize_fields(tuple([itm[f] for f in addressFields]))
+                itm.update(zip(addressFields, fixed))
+            else:
+                fixed = self.normalize_fields(tuple([getattr(itm, f) for f in addressFields]))
+                data[i] = itm._replace(**dict(zip(addressFields, fixed)))
+
+        return data
+
+    def stats(self):
+        info = self.normalize_fields.cache_info()
+        lookups = info.hits + info.misses
+        return {"hits": info.hits, "misses": info.misses,
+                "size": info.currsize, "maxsize": info.maxsize,
+                "hit_rate": info.hits / lookups if lookups > 0 else 0.0}
+
+
+def main(args):
+    normalizer = AddressNormalizer()
+    for itm in args[1:]:
+        logger.info(normalizer.normalize_fields((itm, None, None, None, None, None, None))[0])
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main(sys.argv)
@@ -11,22 +11,11 @@ else
 fi
 
 archive_year() {
-    pushd $WD
-    #pushd bk
-    
-    echo "archiving year $1"
     yr="$1"
-    for i in $yr/*; do
-        echo "archiving segment $i"
-        j=`basename "$i"`
-        if [ -d "$i" -a -n "$j" ]; then
-            echo "zip returns from prefix $i"
-            zip -u -q -r irs_f990_${yr}_${j}.zip ${i}
-        fi
-    done
-    
-    popd
- 
+    echo "archiving year $yr"
+    # appends the new returns to irs_f990_${yr}.zip in place and removes the XML files,
+    # returns already in the archive with the same CRC are skipped
+    python3 `dirname $0`/archive_returns.py --taxyear "$yr" --wd "$WD"
 }
 
 archive_years() {
@@ -36,7 +25,6 @@ archive_years() {
     for yr in $yrs; do
         echo "archiving year $yr"
         archive_year $yr
-        merge_year $yr
     done
 }
 
@@ -50,54 +38,6 @@ clean_year() {
     popd
 }
 
-merge_year() {
-    
-    echo "checking for data segments for the year $yr"
-    pushd $WD
-    
-    yr="$1"
-    for x in irs_f990_${yr}_*.zip; do
-        if [ -s "$x" ]; then
-            s="1"
-        else
-            s=""
-        fi
-    done
-    
-    if [ -n "$s" ]; then
-        # do not attempt to merge if there are no candidates
-        echo "merging the detected segments for the year ${yr}"
-        
-        dest="irs_f990_${yr}.zip"
-        if [ -s "$dest" ]; then
-            mv $dest ziptmp.zip
-            orig="ziptmp.zip"
-        else
-            orig=""
-        fi
-        
-        zipmerge irs_f990_${yr}.zip $orig irs_f990_${yr}_*.zip
-        
-        if [ -n "$orig" ]; then
-            rm $orig | :
-        fi
-    fi
-    
-    ## remove the segments of returns for the year
-    flgs="-i"
-    flgs=""
-    
-    echo "removing the constituent zipfiles that were merged"
-    rm $flgs irs_f990_${yr}_*.zip
-
-    echo "removing the constituent xmlfiles that were merged"
-    rm -rf ${yr}/*
-
-    popd
-    
-}
-
-
 if [ "$0" == "bash" -o "$0" == "-bash" ]; then
     echo "code is sourced,  call 
     archive_years"
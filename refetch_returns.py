@@ -0,0 +1,252 @@
+## fetch again the returns that failed to parse and put the repaired copies into the year archive
+
+import sys
+import os
+import time
+import random
+import logging
+import zlib
+import sqlite3
+import threading
+import urllib.parse
+import concurrent.futures
+import xml.etree.ElementTree as ET
+
+import requests
+
+import archive_returns
+import check_returns
+import data_downloader
+import extract_addresses
+import return_source
+
+logger = logging.getLogger(__name__)
+
+S3_URL = "https://s3.amazonaws.com/irs-form-990/"
+
+# attempts per return, waiting BACKOFF * 2 ** attempt seconds between them
+RETRIES = 5
+BACKOFF = 1.0
+# requests per second sent to any one host
+HOST_RATE = 10.0
+
+# responses worth trying again, anything else is a final answer
+retryStatus = [429, 500, 502, 503, 504]
+
+
+class HostLimiter():
+    # spaces out the requests to each host, shared by all the workers
+
+    def __init__(self, rate=HOST_RATE):
+        self.interval = 1.0 / rate
+        self.next = {}
+        self.lock = threading.Lock()
+
+    def wait(self, url):
+        host = urllib.parse.urlsplit(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next.get(host, now))
+            self.next[host] = slot + self.interval
+
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def failed_members(dblog):
+    # returns with a logged error that were not already re-fetched since the error, the run DB
+    # holds a single year so every logged member is one of its returns
+    cur = dblog.cursor()
+    cur.execute("""SELECT e.xml_file, max(e.log_time) FROM import_errors e
+        WHERE NOT EXISTS (SELECT 1 FROM refetch_log r WHERE r.member = e.xml_file and
+                r.status in ('repaired', 'missing', 'unchanged') and r.fetch_time >= e.log_time)
+        GROUP BY e.xml_file ORDER BY e.xml_file""")
+
+    return [d[0] for d in cur.fetchall()]
+
+
+def checked_members(yr, dblog, listing_db):
+    # returns the archive checker found truncated or corrupt, see check_returns.py
+    if not os.path.exists(listing_db):
+        return []
+
+    cur = dblog.cursor()
+    cur.execute("""ATTACH DATABASE ? as l""", [listing_db])
+    cur.execute("""SELECT c.member FROM l.return_check c
+        WHERE c.taxyr = ? and c.status <> 'ok' and
+            NOT EXISTS (SELECT 1 FROM refetch_log r WHERE r.member = c.member and
+                r.status in ('repaired', 'missing', 'unchanged') and r.fetch_time >= c.check_time)
+        ORDER BY c.member""", [str(yr)])
+    members = [d[0] for d in cur.fetchall()]
+    cur.execute("""DETACH DATABASE l""")
+
+    return members
+
+
+def setup_log(dblog):
+    cur = dblog.cursor()
+    cur.execute("""CREATE TABLE IF NOT EXISTS refetch_log (member TEXT PRIMARY KEY, url TEXT, status TEXT,
+    attempts INTEGER, http_status INTEGER, crc INTEGER, fetch_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+    """)
+    assert cur.fetchall() is not None, "unable to create the refetch_log table"
+    dblog.commit()
+
+
+def save_log(dblog, rows):
+    cur = dblog.cursor()
+    cur.executemany("""INSERT INTO refetch_log (member, url, status, attempts, http_status, crc) VALUES (?,?,?,?,?,?)
+    ON CONFLICT (member) DO
+    UPDATE SET url = excluded.url, status = excluded.status, attempts = excluded.attempts,
+        http_status = excluded.http_status, crc = excluded.crc, fetch_time = CURRENT_TIMESTAMP
+    """, rows)
+    dblog.commit()
+
+
+def member_url(member):
+    # archive members end in {object_id}_public.xml whatever the layout of the archive, the bucket is flat
+    return S3_URL + os.path.basename(member)
+
+
+def valid_return(body):
+    try:
+        root = ET.fromstring(body)
+    except ET.ParseError:
+        return False
+
+    return root.tag.endswith("Return")
+
+
+def fetch_return(session, limiter, url, retries=RETRIES):
+    # returns (status, attempts, http status, body)
+    httpStatus = None
+    for attempt in range(retries):
+        if attempt > 0:
+            time.sleep(BACKOFF * 2 ** (attempt - 1) * (1 + random.random()))
+        limiter.wait(url)
+
+        try:
+            r = session.get(url, timeout=data_downloader.TIMEOUT)
+        except requests.RequestException as e:
+            logger.debug(f"{url}: {e}")
+            continue
+
+        httpStatus = r.status_code
+        if r.status_code == 200:
+            if valid_return(r.content):
+                return "fetched", attempt + 1, httpStatus, r.content
+            # a truncated body is as likely to be transient as a 503
+            logger.debug(f"{url}: the body is not a complete return")
+            continue
+        elif r.status_code in (403, 404):
+            return "missing", attempt + 1, httpStatus, None
+        elif not r.status_code in retryStatus:
+            return "failed", attempt + 1, httpStatus, None
+
+    return "failed", retries, httpStatus, None
+
+
+def refetch_year(yr, workers=8, rate=HOST_RATE, retries=RETRIES, checked=False, archives=None):
+    dbname = f"data/my_{yr}.db"
+    patterns = [d.format(yr=yr) for d in archives or ["tmpdata/irs_f990_{yr}.zip"]]
+    if not os.path.exists(dbname):
+        logger.warning(f"skipping {yr}, {dbname} not found")
+        return {}
+
+    # the archives the returns were extracted from, as extract_addresses.py --archives read them
+    src = return_source.ReturnSource(patterns)
+    if len(src.archives) == 0:
+        logger.warning(f"skipping {yr}, no archive found for {patterns}")
+        return {}
+    crcs = {d.filename: d.CRC for d in src.infolist()}
+    owners = {d: src.archive_of(d) for d in crcs}
+    src.close()
+
+    dblog = sqlite3.connect(dbname)
+    setup_log(dblog)
+    members = failed_members(dblog)
+    if checked:
+        members = sorted(set(members + checked_members(yr, dblog, check_returns.LISTING_DB)))
+    # only the members the archives still hold can be put back
+    members = [d for d in members if d in crcs]
+    logger.info(f"re-fetching {len(members)} returns for {yr} with {workers} workers")
+    if len(members) == 0:
+        dblog.close()
+        return {}
+
+    session = data_downloader.make_session(workers, retries=0)
+    limiter = HostLimiter(rate)
+    counts = {}
+    log = []
+    repaired = {}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(fetch_return, session, limiter, member_url(d), retries): d for d in members}
+        for fut in concurrent.futures.as_completed(futures):
+            member = futures[fut]
+            (status, attempts, httpStatus, body) = fut.result()
+            crc = None
+            if body is not None:
+                crc = zlib.crc32(body)
+                if crc == crcs.get(member):
+                    # the source itself is what fails to parse
+                    status = "unchanged"
+                else:
+                    status = "repaired"
+                    repaired.setdefault(owners[member], []).append((member, body))
+            counts[status] = counts.get(status, 0) + 1
+            log.append([member, member_url(member), status, attempts, httpStatus, crc])
+
+    # only this thread writes to the archives, the broken members are replaced in place in the one they came from
+    for (archivefile, items) in repaired.items():
+        archive = archive_returns.ReturnArchive(archivefile)
+        archive.add([(member, body, None) for (member, body) in items])
+        archive.close()
+
+    save_log(dblog, log)
+    dblog.close()
+    session.close()
+    logger.info(f"{yr}: {counts}")
+
+    return counts
+
+
+def main(args):
+
+    if "--taxyear" in args:
+        taxyrs = [args[args.index("--taxyear") + 1]]
+    else:
+        taxyrs = extract_addresses.years()
+
+    if "--workers" in args:
+        workers = int(args[args.index("--workers") + 1])
+    else:
+        workers = 8
+
+    if "--rate" in args:
+        rate = float(args[args.index("--rate") + 1])
+    else:
+        rate = HOST_RATE
+
+    if "--retries" in args:
+        retries = int(args[args.index("--retries") + 1])
+    else:
+        retries = RETRIES
+
+    # also re-fetch the returns check_returns.py found bad in the archive
+    checked = "--checked" in args
+
+    # the same comma separated zips or globs given to extract_addresses.py --archives, {yr} is the tax year
+    if "--archives" in args:
+        archives = args[args.index("--archives") + 1].split(",")
+    else:
+        archives = None
+
+    for yr in taxyrs:
+        refetch_year(yr, workers=workers, rate=rate, retries=retries, checked=checked, archives=archives)
+
+    logger.info("All Done")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main(sys.argv)
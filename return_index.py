@@ -0,0 +1,200 @@
+## a sidecar index of each year archive, to read a single return without walking the zip
+
+import sys
+import os
+import re
+import glob
+import zlib
+import struct
+import logging
+import sqlite3
+import zipfile
+
+logger = logging.getLogger(__name__)
+
+# the fixed part of a zip local file header
+LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+LOCAL_MAGIC = b"PK\x03\x04"
+
+objectId = re.compile(r'^(\d+)(?:_public)?(?:\.xml)?$')
+
+
+def object_id(member):
+    m = objectId.match(os.path.basename(member))
+    return m.group(1) if m is not None else None
+
+
+def data_offset(f, offset):
+    # where the data of the member whose local header is at offset starts
+    f.seek(offset)
+    header = LOCAL_HEADER.unpack(f.read(LOCAL_HEADER.size))
+    if not header[0] == LOCAL_MAGIC:
+        raise zipfile.BadZipFile(f"no local header at {offset} of {f.name}")
+
+    # the local name and extra field lengths can differ from the central directory
+    return offset + LOCAL_HEADER.size + header[9] + header[10]
+
+
+def archive_file(yr, wd="tmpdata"):
+    return f"{wd}/irs_f990_{yr}.zip"
+
+
+class ReturnIndex():
+    # maps object_id and EIN to where a return lives in the archive
+
+    def __init__(self, archivefile, dbname=None):
+        self.archivefile = archivefile
+        self.db = sqlite3.connect(dbname or archivefile + ".idx.db")
+        self.setup()
+        if self.stale():
+            self.build()
+
+    def setup(self):
+        cur = self.db.cursor()
+        cur.execute("""CREATE TABLE IF NOT EXISTS return_member (object_id TEXT PRIMARY KEY, member TEXT,
+    header_offset INTEGER, compress_size INTEGER, file_size INTEGER, crc INTEGER, compress_type INTEGER, ein TEXT);
+        """)
+        cur.execute("""CREATE INDEX IF NOT EXISTS return_member__ein__ind on return_member(ein)
+        """)
+        # the archive the index was built from, a changed archive is indexed again
+        cur.execute("""CREATE TABLE IF NOT EXISTS index_source (archive TEXT, size INTEGER, mtime REAL,
+    build_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+        """)
+        assert cur.fetchall() is not None, "unable to create the return index tables"
+        self.db.commit()
+
+    def stale(self):
+        cur = self.db.cursor()
+        cur.execute("""SELECT size, mtime FROM index_source""")
+        res = cur.fetchone()
+        st = os.stat(self.archivefile)
+
+        return res is None or not res == (st.st_size, st.st_mtime)
+
+    def build(self):
+        # only the central directory is read
+        st = os.stat(self.archivefile)
+        with zipfile.ZipFile(self.archivefile, "r") as zf:
+            rows = [[object_id(d.filename), d.filename, d.header_offset, d.compress_size, d.file_size, d.CRC, d.compress_type]
+                    for d in zf.infolist() if object_id(d.filename) is not None]
+
+        cur = self.db.cursor()
+        # a return that was replaced keeps its row but loses the EIN of the old copy
+        cur.executemany("""INSERT INTO return_member (object_id, member, header_offset, compress_size, file_size, crc, compress_type)
+            VALUES (?,?,?,?,?,?,?)
+            ON CONFLICT (object_id) DO
+            UPDATE SET member = excluded.member, header_offset = excluded.header_offset, compress_size = excluded.compress_size,
+                file_size = excluded.file_size, ein = CASE WHEN crc = excluded.crc THEN ein END,
+                crc = excluded.crc, compress_type = excluded.compress_type
+            """, rows)
+        cur.execute("""CREATE TEMP TABLE archive_member (object_id TEXT PRIMARY KEY)""")
+        cur.executemany("""INSERT OR IGNORE INTO archive_member VALUES (?)""", [[d[0]] for d in rows])
+        cur.execute("""DELETE FROM return_member WHERE object_id NOT IN (SELECT object_id FROM archive_member)""")
+        cur.execute("""DROP TABLE archive_member""")
+        cur.execute("""DELETE FROM index_source""")
+        cur.execute("""INSERT INTO index_source (archive, size, mtime) VALUES (?,?,?)""", [self.archivefile, st.st_size, st.st_mtime])
+        self.db.commit()
+        logger.info(f"indexed {len(rows)} returns of {self.archivefile}")
+
+    def add_eins(self, dbname):
+        # fill in the EIN of each return from an extraction run DB
+        if not os.path.exists(dbname):
+            return 0
+
+        src = sqlite3.connect(f"file:{dbname}?mode=ro", uri=True)
+        eins = [[d[1], object_id(d[0])] for d in src.execute("""SELECT ReturnFile, max(EIN) FROM irs_address GROUP BY ReturnFile""")]
+        src.close()
+
+        cur = self.db.cursor()
+        cur.executemany("""UPDATE return_member SET ein = ? WHERE object_id = ?""", eins)
+        self.db.commit()
+
+        return len(eins)
+
+    def lookup(self, objectid):
+        cur = self.db.cursor()
+        cur.execute("""SELECT member, header_offset, compress_size, file_size, crc, compress_type
+            FROM return_member WHERE object_id = ?""", [object_id(objectid)])
+
+        return cur.fetchone()
+
+    def members_for_ein(self, ein):
+        cur = self.db.cursor()
+        cur.execute("""SELECT object_id FROM return_member WHERE ein = ? ORDER BY object_id""", [ein])
+
+        return [d[0] for d in cur.fetchall()]
+
+    def get_return(self, objectid):
+        # seek straight to the member and decompress just that one
+        res = self.lookup(objectid)
+        if res is None:
+            return None
+
+        (member, offset, compressSize, fileSize, crc, compressType) = res
+        with open(self.archivefile, "rb") as f:
+            f.seek(data_offset(f, offset))
+            raw = f.read(compressSize)
+
+        if compressType == zipfile.ZIP_DEFLATED:
+            data = zlib.decompress(raw, -15)
+        elif compressType == zipfile.ZIP_STORED:
+            data = raw
+        else:
+            # leave the rarer methods to zipfile
+            with zipfile.ZipFile(self.archivefile, "r") as zf:
+                data = zf.read(member)
+
+        if not zlib.crc32(data) == crc:
+            raise zipfile.BadZipFile(f"bad CRC for {member} in {self.archivefile}")
+
+        return data
+
+    def close(self):
+        self.db.close()
+
+
+def get_return(objectid, wd="tmpdata"):
+    # returns are archived under the year their object_id starts with
+    idx = ReturnIndex(archive_file(object_id(objectid)[:4], wd))
+    try:
+        return idx.get_return(objectid)
+    finally:
+        idx.close()
+
+
+def main(args):
+
+    if "--taxyear" in args:
+        taxyrs = [args[args.index("--taxyear") + 1]]
+    else:
+        # every year archive there is
+        taxyrs = sorted([os.path.basename(d)[len("irs_f990_"):-len(".zip")] for d in glob.glob(archive_file("*"))])
+
+    if "--get" in args:
+        data = get_return(args[args.index("--get") + 1])
+        if data is None:
+            logger.warning("return not found")
+        else:
+            sys.stdout.buffer.write(data)
+        return
+
+    for yr in taxyrs:
+        archivefile = archive_file(yr)
+        if not os.path.exists(archivefile):
+            logger.warning(f"{archivefile} not found")
+            continue
+
+        idx = ReturnIndex(archivefile)
+        ctr = idx.add_eins(f"data/my_{yr}.db")
+        logger.info(f"added the EIN of {ctr} returns for {yr}")
+        if "--ein" in args:
+            for itm in idx.members_for_ein(args[args.index("--ein") + 1]):
+                print(itm)
+        idx.close()
+
+    logger.info("All Done")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main(sys.argv)
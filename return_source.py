@@ -0,0 +1,101 @@
+## read any set of zip archives, named or by glob, as one set of returns
+
+import sys
+import os
+import glob
+import logging
+import zipfile
+
+import return_index
+
+logger = logging.getLogger(__name__)
+
+
+def archive_list(patterns):
+    # the archives in the order given, a glob in name order, each archive once
+    archives = []
+    for itm in patterns:
+        if glob.has_magic(itm):
+            found = sorted(glob.glob(itm))
+        elif os.path.exists(itm):
+            found = [itm]
+        else:
+            found = []
+
+        if len(found) == 0:
+            logger.warning(f"no archive found for {itm}")
+        archives += [d for d in found if not d in archives]
+
+    return archives
+
+
+class ReturnSource():
+    # reads like a single ZipFile, a return in more than one archive is read from the last one listed,
+    # the members of a single archive are all read as a ZipFile would
+
+    def __init__(self, patterns):
+        self.archives = archive_list(patterns)
+        self.zfs = []
+        self.members = {}
+        for (i, archivefile) in enumerate(self.archives):
+            zf = zipfile.ZipFile(archivefile, "r")
+            self.zfs.append(zf)
+            seen = set()
+            for (j, d) in enumerate(zf.infolist()):
+                if d.is_dir():
+                    continue
+                # members that are not returns are only the same when their names are
+                key = return_index.object_id(d.filename) or d.filename
+                if key in seen:
+                    # the same return twice in one archive, under another segment, is kept as it is
+                    key = d.filename
+                seen.add(key)
+                self.members[key] = (i, j, d)
+
+        self.owner = {d.filename: self.zfs[i] for (i, j, d) in self.members.values()}
+        logger.info(f"{len(self.members)} members in {len(self.archives)} archives")
+
+    def infolist(self):
+        # in archive order, then in the order of each archive
+        return [d for (i, j, d) in sorted(self.members.values(), key=lambda x: x[:2])]
+
+    def namelist(self):
+        return [d.filename for d in self.infolist()]
+
+    def open(self, name):
+        return self.owner[name].open(name)
+
+    def read(self, name):
+        return self.owner[name].read(name)
+
+    def archive_of(self, name):
+        # the archive a member is read from
+        return self.owner[name].filename
+
+    def close(self):
+        for zf in self.zfs:
+            zf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def main(args):
+
+    # list the returns a set of archives would be read as, --archives takes a comma separated list
+    if "--archives" in args:
+        patterns = args[args.index("--archives") + 1].split(",")
+    else:
+        patterns = ["tmpdata/irs_f990_*.zip"]
+
+    with ReturnSource(patterns) as src:
+        for itm in src.namelist():
+            print(itm)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main(sys.argv)
@@ -0,0 +1,94 @@
+## where the time of an extraction run goes, collected when extract_addresses.TIMINGS is set
+
+import io
+import time
+import pstats
+import logging
+import cProfile
+
+logger = logging.getLogger(__name__)
+
+# the stages a return passes through, in order
+stageNames = ["decompress", "decode", "parse", "extract", "csv", "sqlite"]
+counterNames = ["returns", "rows", "failures", "unknown_tags", "bytes_read"]
+
+
+class RunMetrics():
+
+    def __init__(self):
+        self.times = dict.fromkeys(stageNames, 0.0)
+        self.counts = dict.fromkeys(counterNames, 0)
+        self.starttm = time.perf_counter()
+        self.clock = time.perf_counter
+
+    def lap(self, stage, since):
+        # adds the time from since to now to a stage, and returns now for the next one
+        now = self.clock()
+        self.times[stage] += now - since
+        return now
+
+    def count(self, name, n=1):
+        self.counts[name] += n
+
+    def snapshot(self):
+        # what a worker process hands back to the parent
+        return {"times": dict(self.times), "counts": dict(self.counts)}
+
+    def merge(self, snapshot):
+        for (k, v) in snapshot["times"].items():
+            self.times[k] += v
+        for (k, v) in snapshot["counts"].items():
+            self.counts[k] += v
+
+    def row(self, yr):
+        elapsed = time.perf_counter() - self.starttm
+        row = {"tax_year": str(yr), "elapsed": elapsed}
+        row.update(self.counts)
+        row.update({f"{k}_s": v for (k, v) in self.times.items()})
+        row["returns_per_sec"] = self.counts["returns"] / elapsed if elapsed > 0 else None
+        row["rows_per_sec"] = self.counts["rows"] / elapsed if elapsed > 0 else None
+
+        return row
+
+    def report(self, yr, dblog=None):
+        row = self.row(yr)
+        # the stage times of parallel workers add up to more than the elapsed time
+        total = sum(self.times.values()) or 1
+        split = "  ".join([f"{k} {v / total:.0%}" for (k, v) in self.times.items()])
+        logger.info(f"{yr}: {row['returns']} returns {row['rows']} rows in {row['elapsed']:.1f} s, " +
+            f"{row['returns_per_sec'] or 0:.0f} returns/s {row['rows_per_sec'] or 0:.0f} rows/s " +
+            f"{row['bytes_read'] / (row['elapsed'] or 1) / 1048576:.1f} MB/s, {row['failures']} failures, " +
+            f"{row['unknown_tags']} unknown tags | {split}")
+        if dblog is not None:
+            dblog.save_metrics(row)
+
+        return row
+
+
+class SliceProfiler():
+    # profiles only the returns in [start, start + count) of a run
+
+    def __init__(self, start, count):
+        self.start = start
+        self.end = start + count
+        self.profile = cProfile.Profile()
+        self.used = False
+
+    def enter(self, index):
+        if self.start <= index < self.end:
+            self.profile.enable()
+            self.used = True
+
+    def leave(self, index):
+        if self.start <= index < self.end:
+            self.profile.disable()
+
+    def dump(self, filename, top=25):
+        if not self.used:
+            logger.warning("no returns were profiled, the slice is past the end of the run")
+            return
+
+        self.profile.dump_stats(filename)
+        out = io.StringIO()
+        pstats.Stats(self.profile, stream=out).sort_stats("cumulative").print_stats(top)
+        logger.info(f"profile of returns {self.start} to {self.end} saved to {filename}\n{out.getvalue()}")
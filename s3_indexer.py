@@ -13,45 +13,34 @@ import datetime
 import dateutil.parser
 import time
 import multiprocessing
+import concurrent.futures
+import botocore.config
 
 logger = logging.getLogger(__name__)
 
+# the characters a busy key range is split on when a page gives no better hint
+SPLIT_CHARS = sorted("0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz")
 
-def aws_s3_listing(s3client, bucket, prefix="", cToken=None, restartAt=""):
+# S3 returns at most 1000 keys per list call
+PAGE_SIZE = 1000
+
+# listing rows are written to the DB in batches of this size
+SAVE_BATCH = 10000
+
+
+def aws_s3_listing(s3client, bucket, prefix="", cToken=None, restartAt="", maxKeys=5000):
 #def aws_s3_listing(bucket, prefix="", cToken=None, restartAt=None):
     logger.debug(f"{bucket} {prefix} {cToken}")
 
-    s3client = boto3.client('s3')
+    # botocore url encodes the request and decodes the keys itself
+    kwargs = {"Bucket": bucket, "Delimiter": '/', "MaxKeys": maxKeys,
+        "Prefix": prefix, "FetchOwner": False}
     if cToken is not None:
-        response = s3client.list_objects_v2(
-            Bucket=bucket,
-            Delimiter='/',
-            EncodingType='url',
-            MaxKeys=5000,
-            Prefix=prefix,
-            ContinuationToken=cToken,
-            FetchOwner=False
-        )
-    else:
-        if restartAt > '':
-            response = s3client.list_objects_v2(
-                Bucket=bucket,
-                Delimiter='/',
-                EncodingType='url',
-                MaxKeys=5000,
-                Prefix=prefix,
-                FetchOwner=False,
-                StartAfter=restartAt
-            )
-        else:
-            response = s3client.list_objects_v2(
-                Bucket=bucket,
-                Delimiter='/',
-                EncodingType='url',
-                MaxKeys=5000,
-                Prefix=prefix,
-                FetchOwner=False
-            )
+        kwargs["ContinuationToken"] = cToken
+    elif restartAt is not None and restartAt > '':
+        kwargs["StartAfter"] = restartAt
+
+    response = s3client.list_objects_v2(**kwargs)
 
     return { "Contents": response.get("Contents") or [], 
         "Prefixes": response.get("CommonPrefixes") or [], 
@@ -69,6 +58,11 @@ def s3_listing_ddl(db):
     """)
     cur.execute("""CREATE UNIQUE INDEX IF NOT EXISTS s3_listing_scan__bucket__prefix__ind on s3_listing_scan(bucket, prefix)
     """)
+    # the keys each listing run found that were not listed before
+    cur.execute("""CREATE TABLE IF NOT EXISTS s3_listing_new (run_id INTEGER, bucket TEXT, key TEXT)
+    """)
+    cur.execute("""CREATE INDEX IF NOT EXISTS s3_listing_new__run_id__ind on s3_listing_new(run_id)
+    """)
 
     assert cur.fetchall() is not None, "unable to create s3 listing tables"
 
@@ -137,23 +131,94 @@ def scan_s3(db, bucket, prefixes):
         ## Pool.add(resp["Prefixes"])
 
 
+def prefix_end(prefix):
+    # the smallest string above every key that starts with prefix
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
 def update_scan_info(db, prefixes):
+    # key range predicates let the (bucket, key) index find the max directly
     cur = db.cursor()
     for itm in prefixes:
-        cmd = f"""UPDATE s3_listing_scan as u 
+        logging.info(f"recomputing the last key of {itm}")
+        cur.execute("""UPDATE s3_listing_scan as u 
             SET last_key = (SELECT max(l.key) 
                 FROM s3_listing l 
-                WHERE l.key like '{itm}%' and
-                  l.bucket = u.bucket )
-            WHERE u.prefix = '{itm}'
-        """
-        logging.info(cmd)
-        cur.execute(cmd)
+                WHERE l.bucket = u.bucket and
+                  l.key >= ? and l.key < ? )
+            WHERE u.prefix = ?
+        """, [itm, prefix_end(itm), itm])
 
         # wait for the update command to complete 
         assert cur.fetchall() is not None, "problems computing info"
 
 
+def known_prefixes(db, bucket):
+    cur = db.cursor()
+    cur.execute("""SELECT prefix FROM s3_listing_scan WHERE bucket = ? ORDER BY prefix""", [bucket])
+    return [d[0] for d in cur.fetchall()]
+
+
+def new_keys(db, bucket, keys):
+    # keys is a sorted page of a listing, compare it to the same key range in the DB
+    if len(keys) == 0:
+        return []
+
+    cur = db.cursor()
+    cur.execute("""SELECT key FROM s3_listing WHERE bucket = ? and key >= ? and key <= ?""", [bucket, keys[0], keys[-1]])
+    known = set([d[0] for d in cur.fetchall()])
+
+    return [d for d in keys if not d in known]
+
+
+def save_scan_marks(db, bucket, marks):
+    # only move a high water mark forward
+    cur = db.cursor()
+    cur.executemany("""UPDATE s3_listing_scan SET last_key = ?
+        WHERE bucket = ? and prefix = ? and (last_key IS NULL or last_key < ?)
+    """, [[mark, bucket, pfx, mark] for (pfx, mark) in marks.items() if mark is not None])
+
+
+class ScanFrontier():
+    # tracks how far each prefix has been listed without gaps, while its
+    # key ranges complete out of order
+
+    def __init__(self):
+        self.start = {}
+        self.covered = {}
+        self.max_key = {}
+        self.complete = set()
+
+    def add_prefix(self, prefix, start):
+        self.start[prefix] = start or ""
+        self.covered[prefix] = {}
+
+    def reached(self, prefix, lo, upto, last_key=None):
+        # the keys of prefix after lo and up to upto have all been listed
+        self.covered[prefix][lo or ""] = upto
+        if last_key is not None and last_key > self.max_key.get(prefix, ""):
+            self.max_key[prefix] = last_key
+
+    def finished(self, prefix, lo):
+        # the range starting at lo runs to the end of the prefix
+        self.complete.add((prefix, lo or ""))
+
+    def mark(self, prefix):
+        pos = self.start[prefix]
+        covered = self.covered[prefix]
+        while (prefix, pos) not in self.complete and pos in covered and covered[pos] > pos:
+            pos = covered[pos]
+
+        if (prefix, pos) in self.complete:
+            # everything is listed, the highest key seen is the mark
+            return self.max_key.get(prefix) or (pos if pos > "" else None)
+
+        return pos if pos > "" else None
+
+    def marks(self):
+        return {pfx: self.mark(pfx) for pfx in self.start}
+
+
 def indexing_worker(input, output):
     # per thread variables go here
 
@@ -226,6 +291,142 @@ def scan_s3_using_pool(db, bucket, prefixes):
     save_s3_listing_data(db, data)
 
 
+def split_range(last, prefix, hi=None, chars=SPLIT_CHARS):
+    # split the keys after last (up to hi) into ranges at the shallowest
+    # character position that gives more than one part, any choice of chars
+    # still covers every key but the ones in use give the fewest empty ranges
+    if hi is None:
+        pos = len(prefix)
+    else:
+        pos = len(os.path.commonprefix([last, hi]))
+
+    while pos <= len(last):
+        base = last[:pos]
+        bounds = [base + c for c in chars if base + c > last and (hi is None or base + c < hi)]
+        if len(bounds) > 1:
+            return bounds
+        pos += 1
+
+    return []
+
+
+def list_range(s3client, bucket, task):
+    # task covers the keys of a prefix after lo, up to and including hi
+    resp = aws_s3_listing(s3client, bucket, prefix=task["prefix"], cToken=task["token"], restartAt=task["lo"], maxKeys=PAGE_SIZE)
+
+    return task, resp
+
+
+def scan_s3_threaded(db, bucket, prefixes, workers=16, s3client=None, delta=False):
+    # create missing tables
+    s3_listing_ddl(db)
+
+    if s3client is None:
+        # one client shared by all threads, with a connection per thread
+        s3client = boto3.client('s3', config=botocore.config.Config(max_pool_connections=workers))
+
+    if delta:
+        # also pick up the sub prefixes found by earlier runs
+        prefixes = prefixes + [d for d in known_prefixes(db, bucket) if not d in prefixes]
+
+    cur = db.cursor()
+    cur.execute("""SELECT coalesce(max(run_id), 0) + 1 FROM s3_listing_new""")
+    run_id = cur.fetchone()[0]
+
+    seen = set(prefixes)
+    frontier = ScanFrontier()
+    data = []
+    added = []
+    ctr = 0
+    calls = 0
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = set()
+        for pfx in prefixes:
+            start_key = save_s3_listing_scan_info(db, bucket, pfx)
+            if not delta:
+                start_key = None
+            frontier.add_prefix(pfx, start_key)
+            task = {"prefix": pfx, "lo": start_key, "hi": None, "token": None}
+            pending.add(pool.submit(list_range, s3client, bucket, task))
+
+        while len(pending) > 0:
+            (done, pending) = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for fut in done:
+                (task, resp) = fut.result()
+                calls += 1
+                hi = task["hi"]
+
+                contents = [d for d in resp["Contents"] if hi is None or d["Key"] <= hi]
+                keys = [d['Key'] for d in contents]
+                data += [[d['Key'], bucket, d["LastModified"].isoformat(), d["Size"]] for d in contents]
+                added += new_keys(db, bucket, keys)
+
+                for itm in resp["Prefixes"]:
+                    pfx = itm["Prefix"]
+                    if not pfx in seen and (hi is None or pfx <= hi):
+                        seen.add(pfx)
+                        save_s3_listing_scan_info(db, bucket, pfx)
+                        frontier.add_prefix(pfx, None)
+                        pending.add(pool.submit(list_range, s3client, bucket, {"prefix": pfx, "lo": None, "hi": None, "token": None}))
+
+                # the range is done once the page runs past hi or the listing ends
+                if len(contents) < len(resp["Contents"]) or resp["ContinuationToken"] is None:
+                    if hi is None:
+                        frontier.reached(task["prefix"], task["lo"], task["lo"] or "", keys[-1] if keys else None)
+                        frontier.finished(task["prefix"], task["lo"])
+                    else:
+                        frontier.reached(task["prefix"], task["lo"], hi, keys[-1] if keys else None)
+                    continue
+
+                if len(keys) > 0:
+                    frontier.reached(task["prefix"], task["lo"], keys[-1], keys[-1])
+
+                bounds = []
+                if len(keys) > 0:
+                    # split on the characters the keys of this page actually use
+                    chars = sorted(set("".join([d[len(task["prefix"]):] for d in keys])))
+                    bounds = split_range(keys[-1], task["prefix"], hi, chars=chars)
+
+                if len(bounds) > 0:
+                    logger.debug(f"""splitting {task["prefix"]} after {keys[-1]} into {len(bounds) + 1} ranges""")
+                    for (lo, upper) in zip([keys[-1]] + bounds, bounds + [hi]):
+                        subtask = {"prefix": task["prefix"], "lo": lo, "hi": upper, "token": None}
+                        pending.add(pool.submit(list_range, s3client, bucket, subtask))
+                else:
+                    pending.add(pool.submit(list_range, s3client, bucket, dict(task, token=resp["ContinuationToken"])))
+
+            # write the pages as they arrive, along with how far each prefix now reaches
+            if len(data) >= SAVE_BATCH:
+                ctr += save_scan_progress(db, bucket, run_id, data, added, frontier)
+                data = []
+                added = []
+
+    ctr += save_scan_progress(db, bucket, run_id, data, added, frontier)
+
+    cur.execute("""SELECT count(*) FROM s3_listing_new WHERE run_id = ?""", [run_id])
+    nnew = cur.fetchone()[0]
+    logger.info(f"listed {ctr} keys from {bucket} with {calls} list calls, {nnew} new keys recorded as run {run_id}")
+
+    return run_id
+
+
+def save_scan_progress(db, bucket, run_id, data, added, frontier):
+    save_s3_listing_data(db, data)
+    cur = db.cursor()
+    cur.executemany("""INSERT INTO s3_listing_new (run_id, bucket, key) VALUES (?,?,?)""", [[run_id, bucket, d] for d in added])
+    save_scan_marks(db, bucket, frontier.marks())
+    db.commit()
+
+    return len(data)
+
+
+def listed_new_keys(db, bucket, run_id):
+    cur = db.cursor()
+    cur.execute("""SELECT key FROM s3_listing_new WHERE run_id = ? and bucket = ? ORDER BY key""", [run_id, bucket])
+    return [d[0] for d in cur.fetchall()]
+
+
 def parse_args(args):
     pass
 
@@ -276,10 +477,26 @@ def main(args=[]):
         # The unthreaded version
         #scan_s3(db, 'irs-form-990', prefixes=prefixes)
 
-        # The threaded version
-        scan_s3_using_pool(db, s3_bucket, prefixes=prefixes)
+        # The multiprocess version
+        #scan_s3_using_pool(db, s3_bucket, prefixes=prefixes)
+
+        if "--workers" in args:
+            workers = int(args[args.index("--workers") + 1])
+        else:
+            workers = 16
+
+        # only list the keys after the last key recorded for each prefix
+        delta = "--delta" in args
+
+        # The threaded version, splits busy prefixes into ranges listed in parallel
+        # and keeps the last key of each prefix up to date as it goes
+        run_id = scan_s3_threaded(db, s3_bucket, prefixes=prefixes, workers=workers, delta=delta)
+
+        if "--new-keys" in args:
+            with open(args[args.index("--new-keys") + 1], "w") as f:
+                for itm in listed_new_keys(db, s3_bucket, run_id):
+                    f.write(itm + "\n")
 
-        update_scan_info(db, prefixes)
         db.commit()
         logger.info("All Done")
 